@@ -0,0 +1,258 @@
+"""
+Benchmarks of the ndb_audit put and read paths on the testbed datastore stub
+
+    python benchmarks/bench_ndb_audit.py [--quick] [--output results.json] [--baseline baseline.json]
+                                         [--threshold 0.25] [--update-baseline]
+
+Needs the App Engine SDK importable (or GAE_LIB_ROOT set to it, like tests.sh).  Prints one JSON document with a
+result per benchmark.  Timings are per entity (or per operation for single-entity benchmarks), the best of --repeat
+runs.  They are only comparable on the same machine, so no baseline is kept in the repository: record one with
+--baseline FILE --update-baseline, then later runs on that same host given --baseline FILE exit with status 1 if any
+benchmark is slower than it by more than threshold (a fraction)
+"""
+
+import argparse
+import json
+import os
+import random
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def _setup_path():
+    sys.path.insert(0, ROOT)
+    if os.environ.get('GAE_LIB_ROOT'):
+        sys.path.insert(0, os.environ['GAE_LIB_ROOT'])
+    import dev_appserver
+    dev_appserver.fix_sys_path()
+
+
+_setup_path()
+
+from google.appengine.datastore import datastore_stub_util  # noqa
+from google.appengine.ext import ndb, testbed  # noqa
+
+from ndb_audit import (Audit, AuditMixin, Tag, audit_put_bulk_async, audit_put_multi_async,  # noqa
+                       tag_multi_from_rev_hash_async, _entity_dict, _PutSnapshot)
+
+
+class BenchLeaf(ndb.Model):
+    x = ndb.IntegerProperty()
+    y = ndb.StringProperty()
+
+
+class BenchBranch(ndb.Model):
+    z = ndb.FloatProperty()
+    leaf = ndb.StructuredProperty(BenchLeaf)
+
+
+class BenchNode(ndb.Model):
+    name = ndb.StringProperty()
+    branch = ndb.StructuredProperty(BenchBranch)
+
+
+class BenchWideExpando(AuditMixin, ndb.Expando):
+    def _account(self):
+        return 'bench'
+
+
+class BenchBlob(AuditMixin, ndb.Model):
+    name = ndb.StringProperty()
+    data = ndb.BlobProperty()
+
+    def _account(self):
+        return 'bench'
+
+
+class BenchStructured(AuditMixin, ndb.Model):
+    name = ndb.StringProperty()
+    nodes = ndb.StructuredProperty(BenchNode, repeated=True)
+
+    def _account(self):
+        return 'bench'
+
+
+def _wide(key, rnd):
+    e = BenchWideExpando(key=key)
+    e.populate(**dict([('p%03d' % i, rnd.choice([rnd.randint(0, 1 << 30), 'v%d' % rnd.randint(0, 1000)]))
+                       for i in xrange(200)]))
+    return e
+
+
+def _blob(key, rnd):
+    # printable bytes, expando audit records store blob values as (UTF-8) strings
+    return BenchBlob(key=key, name='blob', data=''.join([chr(rnd.randint(32, 126)) for _ in xrange(256 * 1024)]))
+
+
+def _structured(key, rnd):
+    return BenchStructured(key=key, name='tree', nodes=[
+        BenchNode(name='n%d' % i, branch=BenchBranch(z=rnd.random(), leaf=BenchLeaf(x=rnd.randint(0, 1000), y='l')))
+        for i in xrange(100)])
+
+
+# name -> (model, factory, largest batch it is worth putting)
+SHAPES = {
+    'wide_expando': (BenchWideExpando, _wide, 10000),
+    'large_blob': (BenchBlob, _blob, 100),
+    'deep_structured': (BenchStructured, _structured, 1000),
+}
+
+
+class Bench(object):
+
+    def __init__(self, repeat, quick):
+        self.repeat = repeat
+        self.batch_sizes = [1, 10, 100] if quick else [1, 10, 100, 1000, 10000]
+        self.results = []
+
+    def setup(self):
+        self.testbed = testbed.Testbed()
+        self.testbed.activate()
+        self.testbed.init_datastore_v3_stub(
+            consistency_policy=datastore_stub_util.PseudoRandomHRConsistencyPolicy(probability=1))
+        self.testbed.init_memcache_stub()
+        ndb.get_context().set_cache_policy(False)
+        ndb.get_context().set_memcache_policy(False)
+
+    def teardown(self):
+        self.testbed.deactivate()
+
+    def time(self, name, shape, batch, fn, make=None):
+        """ fn(state) is timed, make() builds its state fresh for every run outside of the timing """
+        best = None
+        for _ in xrange(self.repeat):
+            self.setup()
+            try:
+                state = make() if make else None
+                start = time.time()
+                fn(state)
+                elapsed = time.time() - start
+            finally:
+                self.teardown()
+            best = elapsed if best is None else min(best, elapsed)
+        self.results.append({'name': name, 'shape': shape, 'batch': batch,
+                             'us_per_entity': round(best * 1e6 / batch, 1)})
+        sys.stderr.write('%-20s %-16s %6d %12.1f us/entity\n' % (name, shape, batch, best * 1e6 / batch))
+
+    def run(self):
+        for shape in sorted(SHAPES):
+            model, factory, max_batch = SHAPES[shape]
+
+            def entities(n, model=model, factory=factory):
+                rnd = random.Random(n) # the same entities every run
+                return [factory(ndb.Key(model, 'e%d' % i), rnd) for i in xrange(n)]
+
+            self.time('update_data_hash', shape, 100, lambda es: [e._update_data_hash() for e in es],
+                      lambda: entities(100))
+            self.time('entity_dict', shape, 100, lambda es: [_entity_dict(e) for e in es], lambda: entities(100))
+            # what a 'delta' or tracked property put of a 'v2' entity works out: its data_hash, properties and digests
+            self.time('put_snapshot_v2', shape, 100, self._put_snapshot_v2, lambda: entities(100))
+            self.time('create_from_entity', shape, 100, lambda es: [Audit.create_from_entity(e, None) for e in es],
+                      lambda: [e for e in entities(100) if e._update_data_hash()])
+
+            for batch in [b for b in self.batch_sizes if b <= max_batch]:
+                # one entity group per transaction, up to the limit of 25
+                if batch <= 25:
+                    self.time('put_multi', shape, batch,
+                              lambda es: ndb.transaction(lambda: audit_put_multi_async(es).get_result(), xg=True),
+                              lambda batch=batch: entities(batch))
+                self.time('put_bulk', shape, batch, lambda es: audit_put_bulk_async(es).get_result(),
+                          lambda batch=batch: entities(batch))
+
+        for batch in [b for b in self.batch_sizes if b >= 10]:
+            self.time('tag_multi', 'wide_expando', batch, self._tag_multi, lambda batch=batch: self._put(batch))
+            self.time('tag_get_multi', 'wide_expando', batch, self._tag_get_multi,
+                      lambda batch=batch: self._tagged(batch))
+
+        for revisions in (10, 100):
+            self.time('history_fetch', 'wide_expando', revisions,
+                      lambda key: Audit.query_history(key).fetch(), lambda n=revisions: self._history(n))
+            self.time('history_pages', 'wide_expando', revisions,
+                      lambda key: [page for page, _ in Audit.iter_history(key, page_size=10)],
+                      lambda n=revisions: self._history(n))
+
+    def _put_snapshot_v2(self, es):
+        for e in es:
+            snapshot = _PutSnapshot(e, account='bench')
+            e.data_hash = e._compute_data_hash(snapshot, version='v2')
+            snapshot.props, snapshot.digests
+
+    def _put(self, n):
+        rnd = random.Random(n)
+        es = [_wide(ndb.Key(BenchWideExpando, 'tag%d' % i), rnd) for i in xrange(n)]
+        audit_put_bulk_async(es).get_result()
+        return es
+
+    def _tagged(self, n):
+        es = self._put(n)
+        ndb.Future.wait_all(tag_multi_from_rev_hash_async([e.key for e in es], [e.rev_hash for e in es], 'bench',
+                                                          'label'))
+        return es
+
+    def _tag_multi(self, es):
+        ndb.Future.wait_all(tag_multi_from_rev_hash_async([e.key for e in es], [e.rev_hash for e in es], 'bench',
+                                                          'label'))
+
+    def _tag_get_multi(self, es):
+        ndb.get_multi([Tag._build_tag_key(e, 'label') for e in es])
+
+    def _history(self, n):
+        rnd = random.Random(n)
+        e = _wide(ndb.Key(BenchWideExpando, 'history'), rnd)
+        for i in xrange(n):
+            e.p000 = i
+            ndb.transaction(e.put, xg=True)
+        return e.key
+
+
+def compare(results, baseline, threshold):
+    """ :returns list of (result, baseline us_per_entity) for results slower than baseline by more than threshold """
+    base = dict([((b['name'], b['shape'], b['batch']), b['us_per_entity']) for b in baseline.get('results', [])])
+    regressions = []
+    for r in results:
+        b = base.get((r['name'], r['shape'], r['batch']))
+        if b and r['us_per_entity'] > b * (1 + threshold):
+            regressions.append((r, b))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='ndb_audit benchmarks')
+    parser.add_argument('--quick', action='store_true', help='batches up to 100 only')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--output', help='also write the results JSON to this file')
+    parser.add_argument('--baseline', help='compare with the results recorded in this file on the same machine')
+    parser.add_argument('--threshold', type=float, default=0.25,
+                        help='fail when slower than the baseline by more than this fraction')
+    parser.add_argument('--update-baseline', action='store_true', help='write the results as the new baseline')
+    args = parser.parse_args(argv)
+    if args.update_baseline and not args.baseline:
+        parser.error('--update-baseline needs --baseline')
+
+    bench = Bench(args.repeat, args.quick)
+    bench.run()
+    doc = {'threshold': args.threshold, 'results': bench.results}
+    text = json.dumps(doc, indent=2, sort_keys=True)
+    print text
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+    if args.update_baseline:
+        with open(args.baseline, 'w') as f:
+            f.write(text + '\n')
+        return 0
+    if args.baseline and os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            regressions = compare(bench.results, json.load(f), args.threshold)
+        for r, b in regressions:
+            sys.stderr.write('REGRESSION %s %s batch %d: %.1f us/entity, baseline %.1f\n' %
+                             (r['name'], r['shape'], r['batch'], r['us_per_entity'], b))
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -8,14 +8,71 @@ import datetime
 import hashlib
 import logging
 import os
+import random
+import struct
 import time
+import zlib
 
+from google.appengine.api import datastore_errors
+from google.appengine.datastore import entity_pb
 from google.appengine.ext import ndb
 
+try:
+    from hashlib import blake2b as _blake2b
+except ImportError:
+    try:
+        from pyblake2 import blake2b as _blake2b # optional on python 2
+    except ImportError:
+        _blake2b = None
+
 __version__ = '1.1.10'
 
 HASH_LENGTH = 8 # (in bytes out of 20 bytes for SHA-1)
 
+
+class AuditMetrics(object):
+    """ receives measurements of the audit pipeline once installed with set_metrics().  Every method does nothing,
+    override the ones you need to forward to your metrics/tracing system.  While none is installed nothing is measured
+
+    counters (increment):
+        audit_records     revisions written (Audit records, or AuditJournal entries for _audit_write = 'outbox')
+        puts_unchanged    puts which wrote no revision because the data_hash was unchanged
+        tags_written      Tag entities put
+        rev_conflicts     entities put_if_rev_multi_async did not put because their revision had moved on
+    histograms (observe):
+        hash_ms                 time spent computing the data_hash of an entity
+        snapshot_bytes          encoded size of each revision written
+        put_multi_batch_size    entities per audit_put_multi_async call
+        history_query_ms        latency of history reads (fetch_history_page_async, latest_revisions_async)
+        history_query_results   audit records returned by each history read
+    kind is the kind of the audited entity, None for put_multi_batch_size
+    """
+
+    def increment(self, name, value=1, kind=None):
+        pass
+
+    def observe(self, name, value, kind=None):
+        pass
+
+    def start_span(self, name, key):
+        """ called when the put of the entity with the given key starts building its revision ('put').  May return an
+        object whose finish(error) is called once the put completes, error is the exception it failed with or None """
+        return None
+
+
+_metrics = None
+
+
+def set_metrics(metrics):
+    """ installs an AuditMetrics instance for all puts and reads from now on, None (the default) turns it off """
+    global _metrics
+    _metrics = metrics
+
+
+def get_metrics():
+    return _metrics
+
+
 class AuditMixin(object):
     """ a mixin for adding audit to NDB models, see file docstring for more information """
 
@@ -35,33 +92,227 @@ class AuditMixin(object):
     # can be set to true during batch updates
     _skip_pre_hook = False
 
-    def _update_data_hash(self):
+    # which data_hash algorithm this model uses.  'v1' rebuilds and hashes the full property string on every put.
+    # 'v2' caches a digest per property, recomputes only those assigned since load or the last put and combines them
+    # Merkle-style, so a put costs what changed rather than the size of the entity.  Changing the version changes the
+    # data_hash of every entity so the next put of each one writes a new audit record
+    # 'v3' works like 'v2' but feeds a canonical, type-aware binary encoding of each value straight into the hasher
+    # instead of str() of it, and hashes with _data_hash_algorithm (any hashlib algorithm, or 'blake2b' which needs
+    # python 3 or the pyblake2 package)
+    _data_hash_version = 'v1'
+    _data_hash_algorithm = 'sha1'
+
+    # how audit records are stored.  'full' copies every property into each audit record.  'delta' only stores the
+    # properties added, changed or removed since the parent revision and writes a full checkpoint record every
+    # _audit_checkpoint_revisions revisions, or sooner once _audit_checkpoint_bytes of deltas have been written since
+    # the last one.  Audit.entity_dict_async() returns the full properties of a revision stored either way.  'delta'
+    # keeps an AuditHead entity under each audited entity and reads it before each put, so wait on put_async()
+    # futures before the enclosing transaction ends
+    _audit_storage = 'full'
+    _audit_checkpoint_revisions = 20
+    _audit_checkpoint_bytes = 1000000
+
+    # how the properties are laid out in an audit record.  'expando' stores each one as its own property of the Audit
+    # Expando.  'blob' serializes all of them into a single compressed payload property which is only decoded when
+    # one is read, which makes wide records smaller and faster to load.  Readers handle both, so it can be changed
+    # at any time
+    _audit_payload_format = 'expando'
+
+    # where audit records are stored.  'entity_group' makes them children of the audited entity.  'log' puts them (and
+    # the AuditHead of 'delta' storage) under an AuditLog root of their own, one per audited entity, so audit writes
+    # and history queries don't compete with the entity's own entity group.  The put of the entity and its audit record
+    # stay atomic in one cross-group transaction.  Read APIs work the same for both, but changing it leaves the
+    # history already written under the other root
+    _audit_log = 'entity_group'
+
+    # when audit records are written.  'transactional' writes them in the transaction of the put.  'outbox' only adds
+    # an AuditJournal entry to the entity's own entity group (the revision header and the compressed entity) and
+    # ndb_audit.outbox builds and writes the Audit records later, so commits need no other entity group (the entry is
+    # about as large as a full audit record).  _audit_outbox_queue, if set, is told which entities to drain once each
+    # put commits (see ndb_audit.outbox.InProcessOutboxQueue and DeferredOutboxQueue).  Audit records only show up once
+    # drained
+    _audit_write = 'transactional'
+    _audit_outbox_queue = None
+
+    # stores the properties of each distinct state once instead of copying them into every 'full' audit record.
+    # 'entity' keeps one AuditContent per data_hash of the entity next to its audit records, 'kind' one per data_hash
+    # of the kind in a root entity group of its own (one more entity group per put, and contention between entities
+    # reaching the same state at once).  The records of revisions which go back to an earlier state then only hold
+    # their header and a reference.  Finding out whether the content exists takes computing the data_hash before the
+    # put as well (cheap for 'v2'/'v3').  Ignored by 'delta' storage.  See ndb_audit.retention.prune_content_async for
+    # cleaning up content no longer referenced
+    _audit_payload_dedup = None
+
+    # code names of properties whose changes are indexed: each revision that changes one of them (or is the first to
+    # set it) also writes an AuditValueChange, so ndb_audit.value_index can find the revisions that set a property to
+    # a value without reading any history.  They must be indexed and neither repeated nor structured, which the first
+    # put checks.  The previous values are known from the entity's AuditHead, which is also kept for 'full' storage then
+    _audit_tracked_properties = ()
+
+    # keeps the AuditHead, which holds the id of the latest audit record, for 'full' storage as well ('delta' storage
+    # and _audit_tracked_properties always keep it).  It is written along with each audit record without being read,
+    # and lets put_if_rev_multi_async read the latest revision with a get instead of a query by timestamp
+    _audit_keep_head = False
+
+    # the AuditMetrics span of the put in progress, if any
+    _audit_span = None
+
+    # the _PutSnapshot of the next put, started while reading the bookkeeping entities it needs (see
+    # _audit_prefetch_keys) and handed to _batch_put_hook.  Dropped when a property is assigned meanwhile
+    _audit_snapshot = None
+
+    def _update_data_hash(self, snapshot=None):
         """ modelled after git commit/parent hashes, although merging not implemented yet """
-        props = _entity_dict(self)
-        prop_str = '{v1}%s' % '|'.join(['%s=%s' % (k,str(props[k])) for k in sorted(props.iterkeys())])
-        self.data_hash = _hash_str(prop_str)
+        if snapshot is not None and snapshot.data_hash is not None:
+            self.data_hash = snapshot.data_hash # worked out before the put, see _audit_prefetch_keys
+        else:
+            self.data_hash = self._compute_data_hash(snapshot)
         return self.data_hash
 
-    def _build_audit_entity(self, parent_hash):
-        return Audit.create_from_entity(self, parent_hash)
+    def _compute_data_hash(self, snapshot=None, version=None):
+        """ the data_hash of the entity's current properties, without setting it.  version overrides
+        _data_hash_version """
+        metrics = _metrics
+        start = time.time() if metrics is not None else None
+        version = version or self._data_hash_version
+        if version in ('v2', 'v3'):
+            data_hash = _merkle_data_hash(self, version, self._data_hash_algorithm, snapshot)
+        else:
+            data_hash = _v1_data_hash(snapshot.props if snapshot else _entity_dict(self))
+        if metrics is not None:
+            metrics.observe('hash_ms', (time.time() - start) * 1000, self._get_kind())
+        return data_hash
+
+    def _drop_property_digest(self, name):
+        """ forget what was worked out about the property with the given code name before it was assigned: its cached
+        'v2' digest, and the _audit_snapshot of the next put """
+        prop = getattr(self.__class__, name, None)
+        if not isinstance(prop, ndb.Property):
+            prop = self._properties.get(name) # Expando dynamic property
+        if prop is None:
+            return
+        self.__dict__.pop('_audit_snapshot', None)
+        values = self._values
+        if isinstance(values, _DigestTrackingDict):
+            values.digests.pop(prop._name, None)
+
+    def _build_audit_entity(self, parent_hash, snapshot=None):
+        return Audit.create_from_entity(self, parent_hash, snapshot=snapshot)
+
+    def _build_audit_entities(self, parent_hash, snapshot=None):
+        """ returns the audit entity for this revision followed by any bookkeeping entities to save along with it """
+        snapshot = snapshot or _PutSnapshot(self)
+        changes = []
+        if self._audit_tracked_properties:
+            # before the AuditHead is replaced by a 'delta' revision
+            changes = AuditValueChange.create_from_entity(self, parent_hash, snapshot)
+        if self._audit_storage == 'delta':
+            # which keeps the AuditHead up to date itself
+            return Audit.create_delta_from_entity(self, parent_hash, snapshot=snapshot) + changes
+        if self._audit_payload_dedup:
+            to_put = Audit.create_dedup_from_entity(self, parent_hash, snapshot=snapshot)
+        else:
+            to_put = [self._build_audit_entity(parent_hash, snapshot)]
+        if self._audit_keep_head or self._audit_tracked_properties:
+            digests = snapshot.digests if self._audit_tracked_properties else {}
+            tracked = dict([(k, digests[k]) for k in self._audit_tracked_properties if k in digests])
+            changes.append(AuditHead(key=AuditHead._build_head_key(snapshot.key),
+                                     chain=[to_put[0].key.string_id()], digests=tracked))
+        return to_put + changes
+
+    @classmethod
+    def _check_tracked_properties(cls):
+        """ raises ValueError for _audit_tracked_properties an AuditValueChange can't hold or be queried by, once per
+        model """
+        if cls.__dict__.get('_audit_tracked_checked') is cls._audit_tracked_properties:
+            return
+        props = dict([(p._code_name, p) for p in cls._properties.itervalues()])
+        for name in cls._audit_tracked_properties:
+            prop = props.get(name)
+            if prop is None:
+                if issubclass(cls, ndb.Expando):
+                    continue # a dynamic property
+                raise ValueError('tracked property %r is not a property of %s' % (name, cls._get_kind()))
+            if prop._repeated or isinstance(prop, (ndb.StructuredProperty, ndb.LocalStructuredProperty)):
+                raise ValueError('tracked property %r of %s must not be repeated or structured' %
+                                 (name, cls._get_kind()))
+            if not prop._indexed:
+                raise ValueError('tracked property %r of %s must be indexed' % (name, cls._get_kind()))
+        cls._audit_tracked_checked = cls._audit_tracked_properties
+
+    @classmethod
+    def _keeps_audit_head(cls):
+        """ whether an AuditHead is kept up to date for entities of this model """
+        return cls._audit_storage == 'delta' or bool(cls._audit_tracked_properties) or cls._audit_keep_head
+
+    def _audit_prefetch_keys(self, data_hash=None):
+        """ keys of the bookkeeping entities building the audit entities reads: the AuditHead of 'delta' storage and
+        _audit_tracked_properties, and the AuditContent of _audit_payload_dedup for data_hash (by default the one the
+        next put will have, which is then worked out on the _audit_snapshot of the put).  The pre put hook must not
+        wait on an RPC, so these are read before the put, see _set_audit_prefetched """
+        self._audit_snapshot = None
+        keys = []
+        if self._audit_storage == 'delta' or self._audit_tracked_properties:
+            keys.append(AuditHead._build_head_key(self))
+        if self._audit_storage != 'delta' and self._audit_payload_dedup:
+            if data_hash is None:
+                snapshot = self._audit_snapshot = _PutSnapshot(self)
+                data_hash = snapshot.data_hash = self._compute_data_hash(snapshot)
+                if data_hash == self.data_hash:
+                    return [] # unchanged, no audit entity will be written
+            keys.append(AuditContent.build_key(self.key, data_hash))
+        return keys
+
+    def _set_audit_prefetched(self, prefetched):
+        """ hands the bookkeeping entities read for the next put, by key, to its _batch_put_hook """
+        snapshot = self._audit_snapshot = self._audit_snapshot or _PutSnapshot(self)
+        snapshot.prefetched = prefetched
 
-    def _batch_put_hook(self):
-        """ sets new data_hash, turns off regular put hook and returns audit entity ready for saving """
+    def _batch_put_hook(self, timestamp=None, account=None):
+        """ sets new data_hash, turns off regular put hook and returns list of audit entities ready for saving """
+        snapshot = self._audit_snapshot
+        self._audit_snapshot = None
+        metrics = _metrics
+        if metrics is not None:
+            self._finish_audit_span(None)
+            self._audit_span = metrics.start_span('put', self.key)
         try:
+            if self._audit_tracked_properties:
+                self._check_tracked_properties()
+            if snapshot is None:
+                snapshot = _PutSnapshot(self, timestamp, account)
+            else:
+                snapshot.timestamp = timestamp or datetime.datetime.utcnow()
+                snapshot._account = account
             cur_data_hash = self.data_hash
-            new_data_hash = self._update_data_hash()
+            new_data_hash = self._update_data_hash(snapshot)
             if cur_data_hash == new_data_hash:
                 logging.debug('ndb_audit put_hook data_hash unchanged for %s, %s' % (self.key, self.data_hash))
-                new_aud = None # do not write an audit entity
+                to_put = [] # do not write an audit entity
+            elif self._audit_write == 'outbox':
+                to_put = [AuditJournal.create_from_entity(self, self.rev_hash, snapshot)]
+                self.rev_hash = to_put[0].rev_hash
             else:
-                new_aud = self._build_audit_entity(self.rev_hash)
-                self.rev_hash = new_aud.rev_hash
+                to_put = self._build_audit_entities(self.rev_hash, snapshot)
+                self.rev_hash = to_put[0].rev_hash
+            if metrics is not None:
+                if to_put:
+                    metrics.increment('audit_records', kind=snapshot.kind)
+                else:
+                    metrics.increment('puts_unchanged', kind=snapshot.kind)
             self._skip_pre_hook = True
-            return new_aud
+            return to_put
         except Exception, e:
             logging.exception('failed ndb_audit batch put')
+            self._finish_audit_span(e)
             raise e
 
+    def _finish_audit_span(self, error):
+        span = self._audit_span
+        if span is not None:
+            self._audit_span = None
+            span.finish(error)
+
     def _account(self):
         # users must implement this in each model to let the ndb_audit framework know which account is associated
         # with a given change.  in the mixin this function is not implemented
@@ -69,74 +320,474 @@ class AuditMixin(object):
 
     # NDB model hooks
 
-    @ndb.transactional_async(xg=True, propagation=ndb.TransactionOptions.MANDATORY)
+    def __setattr__(self, name, value):
+        super(AuditMixin, self).__setattr__(name, value)
+        self._drop_property_digest(name)
+
+    def _set_attributes(self, kwds):
+        # used by the constructor and populate(), which bypass __setattr__ on non-Expando models
+        super(AuditMixin, self)._set_attributes(kwds)
+        for name in kwds:
+            self._drop_property_digest(name)
+
     def _pre_put_hook(self):
         if self._skip_pre_hook:
+            # audits already built by _batch_put_hook, which is also how ndb_audit.backfill puts outside a transaction
             self._skip_pre_hook = False
             return
+        # the hook runs synchronously, raise its errors so that the put fails instead of going ahead without an audit
+        self._audit_pre_put_hook().check_success()
+
+    @ndb.transactional_async(xg=True, propagation=ndb.TransactionOptions.MANDATORY)
+    def _audit_pre_put_hook(self):
         # TODO: think through exception handling here
-        new_aud = self._batch_put_hook()
-        if new_aud:
-            ndb.put_multi_async([new_aud])
+        to_put = self._batch_put_hook()
+        if to_put:
+            ndb.put_multi_async(to_put)
 
     def _post_put_hook(self, future):
         self._skip_pre_hook = False
+        if self._audit_span is not None:
+            self._finish_audit_span(future.get_exception())
+        queue = self._audit_outbox_queue
+        if self._audit_write == 'outbox' and queue is not None:
+            key = self.key
+            ndb.get_context().call_on_commit(lambda: queue.add([key]))
+
+    def _put_async(self, **ctx_options):
+        if self._audit_write != 'outbox' and not self._skip_pre_hook:
+            prefetch_keys = self._audit_prefetch_keys()
+            if prefetch_keys:
+                return self._put_prefetched_async(prefetch_keys, **ctx_options)
+        return super(AuditMixin, self)._put_async(**ctx_options)
+    put_async = _put_async
+
+    @ndb.tasklet
+    def _put_prefetched_async(self, prefetch_keys, **ctx_options):
+        # the pre put hook must not block on an RPC, that would flush the put before the hook has updated the entity.
+        # so read what it needs first
+        fetched = yield ndb.get_multi_async(prefetch_keys)
+        self._set_audit_prefetched(dict(zip(prefetch_keys, fetched)))
+        key = yield super(AuditMixin, self)._put_async(**ctx_options)
+        raise ndb.Return(key)
 
 
 @ndb.transactional_async(xg=True)
 def audit_put_multi_async(entities, **ctx_options):
     """ a version of ndb's put_multi_async which writes the audit entities transactionally in batch """
+    # fetch delta and dedup bookkeeping in one batch.  this blocks so that callers which don't wait on the returned
+    # future still get everything queued before their transaction commits
+    _prefetch_audit_async(entities).check_success()
+    if _metrics is not None:
+        _metrics.observe('put_multi_batch_size', len(entities))
     audits = []
+    timestamp = datetime.datetime.utcnow()
     for e in entities:
-        new_aud = e._batch_put_hook()
-        if new_aud:
-            audits.append(new_aud)
-    # audits = [e._batch_put_hook() for e in entities]
+        audits.extend(e._batch_put_hook(timestamp))
     ndb.put_multi_async(audits, **ctx_options)
     entity_keys = ndb.put_multi_async(entities, **ctx_options)
     return entity_keys
 
 
+@ndb.tasklet
+def _prefetch_audit_async(entities):
+    """ reads the bookkeeping entities the next put of each of the entities needs in one batch, and hands them to its
+    _batch_put_hook """
+    prefetch_keys = [e._audit_prefetch_keys() if e._audit_write != 'outbox' else [] for e in entities]
+    keys = [k for entity_keys in prefetch_keys for k in entity_keys]
+    fetched = iter((yield ndb.get_multi_async(keys)) if keys else [])
+    for e, entity_keys in zip(entities, prefetch_keys):
+        if entity_keys:
+            e._set_audit_prefetched(dict([(k, next(fetched)) for k in entity_keys]))
+
+
+class RevConflict(object):
+    """ an entity passed to put_if_rev_multi_async that was not put because its latest revision is rev_hash (None when
+    it has none) rather than expected_rev_hash """
+
+    def __init__(self, entity, expected_rev_hash, rev_hash):
+        self.entity = entity
+        self.expected_rev_hash = expected_rev_hash
+        self.rev_hash = rev_hash
+
+    def __repr__(self):
+        return 'RevConflict(key=%r, expected_rev_hash=%r, rev_hash=%r)' % (
+            self.entity.key, self.expected_rev_hash, self.rev_hash)
+
+
+@ndb.tasklet
+def put_if_rev_multi_async(entities, expected_rev_hashes, **ctx_options):
+    """ audit_put_multi_async of those of the entities whose latest revision is still the one with the expected
+    rev_hash (None for entities expected to have no history yet), in one transaction, joining the current one if any.
+    The latest revision is read in the transaction as _latest_revisions_async does, so a put of one of the entities
+    committed meanwhile makes it retry.  The entities put are chained to the expected revision even if they were not
+    read first, so this never starts a new chain like a blind put does.  All the entity groups written share the
+    transaction, which allows at most 25: each entity's own, and its AuditLog root for _audit_log = 'log' and the
+    kind's AuditContent root for _audit_payload_dedup = 'kind' (see _entity_group_count)
+
+    :returns NDB Future for a list with None for each entity put and a RevConflict for each that was not
+    """
+    if len(entities) != len(expected_rev_hashes):
+        raise ValueError('%d entities but %d expected rev_hashes' % (len(entities), len(expected_rev_hashes)))
+    hashes = [(e.data_hash, e.rev_hash) for e in entities]
+
+    @ndb.tasklet
+    def txn():
+        # a retry starts again from the hashes the entities had, _batch_put_hook has updated them
+        _restore_hashes(entities, hashes)
+        current = yield _latest_rev_hashes_async([e.key for e in entities])
+        conflicts = []
+        to_put = []
+        for e, expected, rev_hash in zip(entities, expected_rev_hashes, current):
+            if rev_hash == expected:
+                e.rev_hash = rev_hash
+                to_put.append(e)
+                conflicts.append(None)
+            else:
+                conflicts.append(RevConflict(e, expected, rev_hash))
+        if to_put:
+            key_futures = yield audit_put_multi_async(to_put, **ctx_options)
+            yield key_futures
+        raise ndb.Return(conflicts)
+
+    try:
+        conflicts = yield ndb.transaction_async(txn, xg=True, propagation=ndb.TransactionOptions.ALLOWED)
+    except Exception:
+        _restore_hashes(entities, hashes)
+        raise
+    if _metrics is not None:
+        for c in conflicts:
+            if c is not None:
+                _metrics.increment('rev_conflicts', kind=c.entity._get_kind())
+    raise ndb.Return(conflicts)
+
+
+@ndb.tasklet
+def _latest_rev_hashes_async(keys):
+    """ the rev_hash of the latest revision of each entity, None when it has none """
+    latest = yield _latest_revisions_async(keys)
+    raise ndb.Return([r[0] if r else None for r in latest])
+
+
+@ndb.tasklet
+def _latest_revisions_async(keys):
+    """ (rev_hash, data_hash) of the latest revision of each audited entity, None when it has none.  All the reads run
+    concurrently, and none of them queries where it can be avoided:
+    - the entity's AuditHead, with a get, for models that keep one ('delta' storage, _audit_tracked_properties or
+      _audit_keep_head).  Use one of these when possible
+    - the entity itself for _audit_write = 'outbox', whose audit records may not be written yet
+    - otherwise the newest audit record by timestamp, with a keys only query (see
+      Audit.latest_revision_keys_multi_async), and the entity itself when that finds none, e.g. for histories written
+      before the timestamp was indexed (see Audit.reindex_history_async).  Puts at about the same time on machines
+      with skewed clocks can be ordered wrongly this way
+    Entities are read past the context cache, which may hold copies being put
+
+    :returns NDB Future for a list in the same order as keys
+    """
+    models = [ndb.Model._kind_map.get(k.kind()) for k in keys]
+    audited = [m is not None and issubclass(m, AuditMixin) for m in models]
+    outbox = [i for i, m in enumerate(models) if audited[i] and m._audit_write == 'outbox']
+    with_head = [i for i, m in enumerate(models)
+                 if audited[i] and m._audit_write != 'outbox' and m._keeps_audit_head()]
+    stored, heads = yield (ndb.get_multi_async([keys[i] for i in outbox], use_cache=False) if outbox else [],
+                           ndb.get_multi_async([AuditHead._build_head_key(keys[i]) for i in with_head])
+                           if with_head else [])
+    latest = [None] * len(keys)
+    found = set(outbox)
+    for i, e in zip(outbox, stored):
+        latest[i] = _entity_revision(e)
+    for i, h in zip(with_head, heads):
+        if h is not None: # no head yet when the history was written before the model kept one
+            latest[i] = _audit_id_revision(h.chain[-1])
+            found.add(i)
+    queried = [i for i in xrange(len(keys)) if i not in found]
+    audit_keys = (yield Audit.latest_revision_keys_multi_async([keys[i] for i in queried])) if queried else []
+    unindexed = []
+    for i, k in zip(queried, audit_keys):
+        if k is not None:
+            latest[i] = _audit_id_revision(k.string_id())
+        elif audited[i]:
+            unindexed.append(i)
+    stored = (yield ndb.get_multi_async([keys[i] for i in unindexed], use_cache=False)) if unindexed else []
+    for i, e in zip(unindexed, stored):
+        latest[i] = _entity_revision(e)
+    raise ndb.Return(latest)
+
+
+def _audit_id_revision(audit_id):
+    # audit record ids end with the data_hash, see Audit.build_audit_record_key
+    return _hash_str(audit_id), audit_id.rsplit('|', 1)[1]
+
+
+def _entity_revision(entity):
+    return (entity.rev_hash, entity.data_hash) if entity is not None and entity.rev_hash else None
+
+
+class AuditPutResult(object):
+    """ the outcome of writing one of the entities passed to audit_put_bulk_async """
+
+    def __init__(self, entity):
+        self.entity = entity
+        self.key = None
+        self.rev_hash = None
+        self.error = None
+
+    @property
+    def ok(self):
+        return self.error is None
+
+
+@ndb.tasklet
+def audit_put_bulk_async(entities, max_entity_groups=25, max_entities=150, max_in_flight=10, retries=3,
+                         backoff=0.1, **ctx_options):
+    """ writes any number of entities along with their audit entities.  They are split into transactions of at most
+    max_entity_groups entity groups (the cross-group transaction limit) and max_entities entities (each can write up
+    to 3 entities and a commit is limited to 500), of which up to max_in_flight run at once.  Transactions that fail
+    from contention are retried up to retries times with exponential backoff starting at backoff seconds.  Those that
+    fail for another reason are retried one entity at a time so that only the entities at fault fail.
+    this is not transactional as a whole, and must not be called in a transaction
+
+    :returns NDB Future for a list of AuditPutResult in the same order as entities
+    """
+    results = [AuditPutResult(e) for e in entities]
+    chunks = _chunk_by_entity_group(results, max_entity_groups, max_entities)
+    chunks.reverse()
+
+    @ndb.tasklet
+    def worker():
+        while chunks:
+            yield _audit_put_results_async(chunks.pop(), retries, backoff, ctx_options)
+
+    yield [worker() for _ in xrange(min(max_in_flight, len(chunks)))]
+    raise ndb.Return(results)
+
+
+def _chunk_by_entity_group(results, max_entity_groups, max_entities):
+    groups = {}
+    for r in results:
+        groups.setdefault(r.entity.key.root(), []).append(r)
+    chunks = []
+    chunk = []
+    chunk_groups = 0
+    for root in sorted(groups.iterkeys()):
+        group = groups[root]
+        if chunk and (chunk_groups + _entity_group_count(group) > max_entity_groups or
+                      len(chunk) + len(group) > max_entities):
+            chunks.append(chunk)
+            chunk = []
+            chunk_groups = 0
+        # an entity group with more than max_entities entities is split over several transactions
+        while (len(chunk) + len(group) > max_entities or
+               chunk_groups + _entity_group_count(group) > max_entity_groups) and len(group) > 1:
+            split = max_entities - len(chunk)
+            while split > 1 and chunk_groups + _entity_group_count(group[:split]) > max_entity_groups:
+                split -= 1
+            chunks.append(chunk + group[:split])
+            chunk = []
+            chunk_groups = 0
+            group = group[split:]
+        chunk.extend(group)
+        chunk_groups += _entity_group_count(group)
+    if chunk:
+        chunks.append(chunk)
+    return chunks
+
+
+def _entity_group_count(results):
+    """ entity groups written by a put of results that share a root, each _audit_log = 'log' entity adds its own and
+    so may each _audit_payload_dedup = 'kind' one """
+    count = 1
+    for r in results:
+        e = r.entity
+        if e._audit_write != 'outbox':
+            count += (e._audit_log == 'log') + (e._audit_payload_dedup == 'kind' and e._audit_storage == 'full')
+    return count
+
+
+@ndb.tasklet
+def _audit_put_results_async(results, retries, backoff, ctx_options):
+    entities = [r.entity for r in results]
+    attempt = 0
+    while True:
+        # _batch_put_hook updates the hashes before the transaction commits, undo that if it doesn't
+        hashes = [(e.data_hash, e.rev_hash) for e in entities]
+        try:
+            keys = yield ndb.transaction_async(lambda: _audit_put_chunk_async(entities, ctx_options), xg=True,
+                                               retries=0, propagation=ndb.TransactionOptions.INDEPENDENT)
+        except (datastore_errors.TransactionFailedError, datastore_errors.Timeout), e:
+            _restore_hashes(entities, hashes)
+            if attempt < retries:
+                yield ndb.sleep(backoff * (2 ** attempt) * (1 + random.random()))
+                attempt += 1
+                continue
+            error = e
+        except Exception, e:
+            _restore_hashes(entities, hashes)
+            if len(results) > 1:
+                logging.warning('ndb_audit bulk put of %d entities failed, retrying one at a time: %s' %
+                                (len(results), e))
+                for r in results:
+                    yield _audit_put_results_async([r], retries, backoff, ctx_options)
+                return
+            error = e
+        else:
+            for r, k in zip(results, keys):
+                r.key = k
+                r.rev_hash = r.entity.rev_hash
+            return
+        for r in results:
+            r.error = error
+        return
+
+
+@ndb.tasklet
+def _audit_put_chunk_async(entities, ctx_options):
+    key_futures = yield audit_put_multi_async(entities, **ctx_options)
+    keys = yield key_futures
+    raise ndb.Return(keys)
+
+
+def _restore_hashes(entities, hashes):
+    for e, (data_hash, rev_hash) in zip(entities, hashes):
+        e.data_hash = data_hash
+        e.rev_hash = rev_hash
+        e._skip_pre_hook = False
+
+
 class Audit(ndb.Expando):
     """ an audit record with a full copy of the entity -- see file docstring for more information
     should not be directly instantiated
 
-    index.yaml entry required for this entity:
-    TODO
+    index.yaml entries required for this entity (for the ordered history queries):
+    - kind: Audit
+      ancestor: yes
+      properties:
+      - name: ts
+    - kind: Audit
+      ancestor: yes
+      properties:
+      - name: ts
+        direction: desc
+    and to follow a single kind in ndb_audit.feed:
+    - kind: Audit
+      properties:
+      - name: k
+      - name: ts
     """
 
     _default_indexed = False # TODO: consider making true for better query-ability of entities
 
-    kind = ndb.StringProperty(indexed=False, required=True, name='k')
+    # indexed for the change feed, see ndb_audit.feed
+    kind = ndb.StringProperty(indexed=True, required=True, name='k')
     # data hash uniquely identified the NDB properties of the entity
     data_hash = ndb.StringProperty(indexed=False, required=True, name='d')
     parent_hash = ndb.StringProperty(indexed=False, default=None, name='p')
     account = ndb.StringProperty(indexed=False, required=True, name='a')
-    timestamp = ndb.DateTimeProperty(indexed=False, required=True, name='ts')
+    # indexed for the ordered history queries, see query_history
+    timestamp = ndb.DateTimeProperty(indexed=True, required=True, name='ts')
+    # only set for 'delta' records: ids of the audit records from the last checkpoint up to the parent revision and
+    # the names of properties removed since the parent revision.  None for full records (including checkpoints)
+    delta = ndb.JsonProperty(indexed=False, default=None, name='dl')
+    # only set for records written with the 'blob' payload format, see _encode_payload()
+    payload = ndb.BlobProperty(indexed=False, default=None, name='pl')
+    # only set for records of models using _audit_log = 'log', whose parent is the AuditLog root instead of the
+    # audited entity
+    entity_key = ndb.KeyProperty(indexed=False, default=None, name='e')
+    # set on the full record that stands in for the revisions before it which were pruned, see ndb_audit.retention.
+    # its parent_hash still names the pruned parent revision
+    squashed = ndb.BooleanProperty(indexed=False, default=None, name='sq')
+    # only set for records of models using _audit_payload_dedup: the AuditContent holding the properties.  indexed to
+    # find the content no longer referenced, see ndb_audit.retention.prune_content_async
+    content = ndb.KeyProperty(indexed=True, default=None, name='c')
+
+    # decoded payload, see __getattr__
+    _payload_values = None
 
     @classmethod
-    def create_from_entity(cls, entity, parent_hash, timestamp=None):
-        start = time.time()
+    def create_from_entity(cls, entity, parent_hash, timestamp=None, snapshot=None):
         """ given an Auditable entity, create a new Audit entity suitable for storing"""
-        if not timestamp:
-            timestamp = datetime.datetime.utcnow()
+        snapshot = snapshot or _PutSnapshot(entity, timestamp)
+        a = cls._create(snapshot, parent_hash, snapshot.props)
+        a._observe_snapshot_bytes()
+        return a
+
+    @classmethod
+    def create_delta_from_entity(cls, entity, parent_hash, timestamp=None, snapshot=None):
+        """ given an Auditable entity, create a new Audit entity holding only the properties changed since the
+        parent revision, or a full checkpoint if one is due.  The entity's AuditHead (see _PutSnapshot.bookkeeping)
+        is returned updated after the audit entity, both need to be stored together """
+        snapshot = snapshot or _PutSnapshot(entity, timestamp)
+        head_key = AuditHead._build_head_key(entity)
+        head = snapshot.bookkeeping(head_key)
+        props = snapshot.props
+        digests = snapshot.digests
+        if head and head.rev_hash == parent_hash and len(head.chain) < entity._audit_checkpoint_revisions:
+            changed = dict([(k, v) for k, v in props.iteritems() if head.digests.get(k) != digests[k]])
+            a = cls._create(snapshot, parent_hash, changed)
+            a.delta = {'chain': head.chain, 'removed': sorted([k for k in head.digests if k not in digests])}
+            delta_bytes = head.delta_bytes + a._to_pb().ByteSize()
+            if delta_bytes < entity._audit_checkpoint_bytes:
+                a._observe_snapshot_bytes(delta_bytes - head.delta_bytes)
+                head = AuditHead(key=head_key, chain=head.chain + [a.key.string_id()], delta_bytes=delta_bytes,
+                                 digests=digests)
+                return [a, head]
+        # blind put, first revision or a checkpoint is due
+        a = cls._create(snapshot, parent_hash, props)
+        a._observe_snapshot_bytes()
+        return [a, AuditHead(key=head_key, chain=[a.key.string_id()], delta_bytes=0, digests=digests)]
 
-        a_key = Audit.build_audit_record_key(entity.key, entity.data_hash, parent_hash, entity._account())
+    @classmethod
+    def create_dedup_from_entity(cls, entity, parent_hash, timestamp=None, snapshot=None):
+        """ given an Auditable entity, create a new Audit entity which refers to the AuditContent holding the properties
+        of every revision with the same data_hash.  The AuditContent (see _PutSnapshot.bookkeeping) is returned after
+        the audit entity when it is new or its last_used is due to be refreshed, both need to be stored together """
+        snapshot = snapshot or _PutSnapshot(entity, timestamp)
+        content_key = AuditContent.build_key(snapshot.key, entity.data_hash)
+        a = cls._create(snapshot, parent_hash, None)
+        a.content = content_key
+        a._observe_snapshot_bytes()
+        content = snapshot.bookkeeping(content_key)
+        if content is None:
+            content = AuditContent(key=content_key, payload=_encode_payload(snapshot.props),
+                                   last_used=snapshot.timestamp)
+        elif snapshot.timestamp - content.last_used >= AuditContent.REFRESH_AFTER:
+            content.last_used = snapshot.timestamp
+        else:
+            return [a]
+        return [a, content]
+
+    @classmethod
+    def _create(cls, snapshot, parent_hash, props):
+        start = time.time()
+        entity = snapshot.entity
+        a_key = Audit.build_audit_record_key(snapshot.key, entity.data_hash, parent_hash, snapshot.account)
         a = Audit(key=a_key,
-                  kind=entity._get_kind(),
+                  kind=snapshot.kind,
                   data_hash=entity.data_hash,
                   parent_hash=parent_hash,
-                  account=entity._account(),
-                  timestamp=timestamp)
+                  account=snapshot.account,
+                  timestamp=snapshot.timestamp)
+        if a_key.parent() != snapshot.key:
+            a.entity_key = snapshot.key
 
-        a.populate(**_entity_dict(entity))
+        if props is None:
+            pass # the properties are stored elsewhere, see create_dedup_from_entity
+        elif entity._audit_payload_format == 'blob':
+            a.payload = _encode_payload(props)
+        else:
+            a._populate_payload(props)
         logging.debug('audit entity created in %s ms' % str((time.time()-start)*1000))
         return a
 
+    def _observe_snapshot_bytes(self, size=None):
+        """ records the encoded size of this audit record, once it is the one written.  size if already known """
+        if _metrics is not None:
+            _metrics.observe('snapshot_bytes', self._to_pb().ByteSize() if size is None else size, self.kind)
+
     @classmethod
     def build_audit_record_key(cls, entity_key, data_hash, parent_hash, account):
         """ returns key for audit record -- uses data_hash property which may not be up to date """
-        return ndb.Key(parent=entity_key,
+        return ndb.Key(parent=_audit_root_key(entity_key),
                        pairs=[('Audit', '{v1}%s|%s|%s' % (parent_hash, account, data_hash))])
 
     @classmethod
@@ -148,15 +799,379 @@ class Audit(ndb.Expando):
         """
         if not isinstance(entity_or_key, ndb.Key):
             entity_or_key = entity_or_key.key
-        q = Audit.query(ancestor=entity_or_key)
+        q = Audit.query(ancestor=_audit_root_key(entity_or_key))
         return q
 
+    @classmethod
+    def query_history(cls, entity_or_key, newest_first=True):
+        """ given the key of the audited entity, query its audit entries ordered by timestamp
+        returns a query object
+        Note: this is a strongly consistent query
+        Note: records written before timestamp was indexed are not returned until they are put again, see
+        reindex_history_async
+        """
+        q = cls.query_by_entity_key(entity_or_key)
+        return q.order(-Audit.timestamp if newest_first else Audit.timestamp)
+
+    @classmethod
+    def fetch_history_page_async(cls, entity_or_key, page_size, cursor=None, newest_first=True):
+        """ one page of the audited entity's history, pass the returned cursor back in to get the next one
+        :returns NDB Future for a (list of Audit entities, cursor, more) tuple like Query.fetch_page_async
+        """
+        return _observe_history(entity_or_key, cls.query_history(entity_or_key, newest_first).fetch_page_async(
+            page_size, start_cursor=cursor))
+
+    @classmethod
+    def iter_history(cls, entity_or_key, page_size=100, cursor=None, newest_first=True):
+        """ generator over the audited entity's history in pages of at most page_size records
+        yields (list of Audit entities, cursor) tuples, the cursor resumes the iteration after that page.  The next
+        page is fetched while the caller works on the current one
+        """
+        future = cls.fetch_history_page_async(entity_or_key, page_size, cursor, newest_first)
+        while future:
+            audits, cursor, more = future.get_result()
+            future = None
+            if more and cursor:
+                future = cls.fetch_history_page_async(entity_or_key, page_size, cursor, newest_first)
+            if audits:
+                yield audits, cursor
+
+    @classmethod
+    def latest_revisions_async(cls, entity_or_key, n=1):
+        """ the n most recent audit entries of the audited entity, newest first
+        :returns NDB Future for a list of Audit entities
+        """
+        return _observe_history(entity_or_key, cls.query_history(entity_or_key).fetch_async(n))
+
+    @classmethod
+    @ndb.tasklet
+    def latest_revision_keys_multi_async(cls, entity_keys):
+        """ the key of the newest audit entry of each entity (None when it has none) with concurrent keys only
+        queries.  The key id holds the parent_hash, account and data_hash and hashes to the rev_hash, see
+        build_audit_record_key
+        :returns NDB Future for a list of Audit keys in the same order as entity_keys
+        """
+        audit_keys = yield [cls.query_history(k).fetch_async(1, keys_only=True) for k in entity_keys]
+        raise ndb.Return([a[0] if a else None for a in audit_keys])
+
+    @classmethod
+    @ndb.tasklet
+    def reindex_history_async(cls, entity_or_key, page_size=100):
+        """ puts the audit entries of the audited entity back unchanged, which adds records written by earlier
+        versions of this library to the rev_hash, timestamp and kind indexes
+        :returns NDB Future for the number of records put
+        """
+        count = 0
+        cursor = None
+        more = True
+        while more:
+            audits, cursor, more = yield cls.query_by_entity_key(entity_or_key).fetch_page_async(
+                page_size, start_cursor=cursor)
+            yield ndb.put_multi_async(audits)
+            count += len(audits)
+        raise ndb.Return(count)
+
+    @classmethod
+    def get_by_rev_hash_async(cls, entity_or_key, rev_hash, legacy_scan=False):
+        """ given the key of the audited entity and one of its rev_hashes, returns a future for the Audit entity or
+        None if there is no such revision.  This is a single strongly consistent indexed query.
+        Records written before rev_hash was stored are not in the index, migrate them with reindex_history_async.
+        Until then legacy_scan looks for them among the keys of the entity's whole history if the index has no match,
+        which reads every key of the history for each revision that is not found
+        """
+        if not isinstance(entity_or_key, ndb.Key):
+            entity_or_key = entity_or_key.key
+        return cls._get_by_rev_hash_async(entity_or_key, rev_hash, legacy_scan)
+
+    @classmethod
+    def get_by_rev_hash_multi_async(cls, entity_keys, rev_hashes, legacy_scan=False):
+        """ batch version of get_by_rev_hash_async, the queries for all entities run concurrently
+        :returns list of NDB Futures
+        """
+        return [cls.get_by_rev_hash_async(k, r, legacy_scan) for k, r in zip(entity_keys, rev_hashes)]
+
+    @classmethod
+    @ndb.tasklet
+    def _get_by_rev_hash_async(cls, entity_key, rev_hash, legacy_scan):
+        a = yield cls.query_by_entity_key(entity_key).filter(Audit.rev_hash == rev_hash).get_async()
+        if a is None and legacy_scan and rev_hash:
+            keys = yield cls.query_by_entity_key(entity_key).fetch_async(keys_only=True)
+            for k in keys:
+                if _hash_str(k.string_id()) == rev_hash:
+                    a = yield k.get_async()
+                    break
+        raise ndb.Return(a)
+
     # rev hash uniquely identifies this change by parent_hash, account, and data_hash
     # may not be globally unique -- shortened for storage/performance
+    # stored and indexed so that revisions can be looked up by it, see get_by_rev_hash_async
+    rev_hash = ndb.ComputedProperty(lambda self: _hash_str(self.key.string_id()), indexed=True, name='r')
+
+    @ndb.tasklet
+    def entity_dict_async(self):
+        """ returns the audited entity's properties as of this revision.  'delta' records are rebuilt from their
+        checkpoint, which takes one batch get of at most _audit_checkpoint_revisions records """
+        if not self.delta:
+            yield Audit.load_content_multi_async([self])
+            raise ndb.Return(self._payload_dict())
+        chain = yield ndb.get_multi_async([ndb.Key(parent=self.key.parent(), pairs=[('Audit', audit_id)])
+                                           for audit_id in self.delta['chain']])
+        props = {}
+        for audit_id, a in zip(self.delta['chain'] + [self.key.string_id()], chain + [self]):
+            if a is None:
+                raise ValueError('audit record %s of %s is missing, cannot rebuild %s' %
+                                 (audit_id, self.key.parent(), self.rev_hash))
+            props.update(a._payload_dict())
+            for k in (a.delta or {}).get('removed', []):
+                props.pop(k, None)
+        raise ndb.Return(props)
+
+    @classmethod
+    @ndb.tasklet
+    def load_content_multi_async(cls, audits):
+        """ reads the AuditContent of those of the records stored with _audit_payload_dedup in one batch get, so that
+        reading their properties needs no further RPCs
+
+        :returns NDB Future for audits
+        """
+        pending = [a for a in audits if a is not None and a.content is not None and a._payload_values is None]
+        contents = yield ndb.get_multi_async([a.content for a in pending])
+        for a, c in zip(pending, contents):
+            a._payload_values = a._decode_content(c)
+        raise ndb.Return(audits)
+
+    def _payload_dict(self):
+        """ the audited entity's properties stored in this record, which is only the changed ones for deltas """
+        if self.payload is not None or self.content is not None:
+            return dict(self._decoded_payload())
+        return dict([(_unescape_payload_name(k), v)
+                     for k, v in self._to_dict(exclude=_AUDIT_HEADER_PROPS).iteritems()])
+
+    def _populate_payload(self, props):
+        """ stores the audited entity's properties as properties of this 'expando' record """
+        self.populate(**dict([(_escape_payload_name(k), v) for k, v in props.iteritems()]))
+
+    def _decoded_payload(self):
+        if self._payload_values is None:
+            if self.content is not None:
+                self._payload_values = self._decode_content(self.content.get())
+            else:
+                self._payload_values = _decode_payload(self.payload)
+        return self._payload_values
+
+    def _decode_content(self, content):
+        if content is None:
+            raise ValueError('audit content %s of %s is missing' % (self.content, self.rev_hash))
+        return _decode_payload(content.payload)
+
+    def __getattr__(self, name):
+        # makes the properties of 'blob' and dedup records readable as attributes just like those of 'expando' records.
+        # those named like the header, e.g. payload, read as the header and are only in _payload_dict
+        if not name.startswith('_') and (self.payload is not None or self.content is not None):
+            values = self._decoded_payload()
+            if name in values:
+                return values[name]
+        return super(Audit, self).__getattr__(name)
+
+
+_AUDIT_HEADER_PROPS = ('kind', 'data_hash', 'parent_hash', 'account', 'timestamp', 'delta', 'payload', 'entity_key',
+                       'squashed', 'content', 'rev_hash')
+
+# the audited entity's properties are stored alongside the header in 'expando' records, those named like a header
+# property (by code or datastore name) are stored with this prefix, as are those already starting with it
+_PAYLOAD_ESCAPE = '~'
+_AUDIT_RESERVED_NAMES = frozenset(_AUDIT_HEADER_PROPS + tuple([getattr(Audit, p)._name for p in _AUDIT_HEADER_PROPS]))
+
+
+def _escape_payload_name(name):
+    if name in _AUDIT_RESERVED_NAMES or name.startswith(_PAYLOAD_ESCAPE):
+        return _PAYLOAD_ESCAPE + name
+    return name
+
+
+def _unescape_payload_name(name):
+    return name[len(_PAYLOAD_ESCAPE):] if name.startswith(_PAYLOAD_ESCAPE) else name
+
+
+class _AuditPayload(ndb.Expando):
+    """ never stored on its own, it is the container serialized into Audit.payload """
+    _default_indexed = False
+
+
+_PAYLOAD_VERSION_1 = '\x01' # zlib compressed EntityProto of an _AuditPayload
+
+
+def _encode_payload(props):
+    p = _AuditPayload()
+    p.populate(**props)
+    return _PAYLOAD_VERSION_1 + zlib.compress(p._to_pb().Encode())
+
+
+def _decode_payload(payload):
+    if payload[:1] != _PAYLOAD_VERSION_1:
+        raise ValueError('unknown audit payload version %r' % payload[:1])
+    pb = entity_pb.EntityProto(zlib.decompress(payload[1:]))
+    return _AuditPayload._from_pb(pb)._to_dict()
+
+
+def _payload_property_pbs(payload):
+    """ the still encoded properties of a payload, grouped by top level property name.  Each value is a list of
+    (is_raw, property pb) for _decode_payload_properties """
+    if payload[:1] != _PAYLOAD_VERSION_1:
+        raise ValueError('unknown audit payload version %r' % payload[:1])
+    pb = entity_pb.EntityProto(zlib.decompress(payload[1:]))
+    groups = {}
+    for is_raw, props in ((False, pb.property_list()), (True, pb.raw_property_list())):
+        for p in props:
+            groups.setdefault(p.name().split('.', 1)[0], []).append((is_raw, p))
+    return groups
+
+
+def _decode_payload_properties(property_pbs):
+    """ decodes only the given (is_raw, property pb) pairs of a payload """
+    pb = entity_pb.EntityProto()
+    for is_raw, p in property_pbs:
+        (pb.add_raw_property() if is_raw else pb.add_property()).CopyFrom(p)
+    return _AuditPayload._from_pb(pb)._to_dict()
+
+
+class AuditJournal(ndb.Model):
+    """ outbox entry for a revision of an entity using _audit_write = 'outbox', a child of the entity so it is written
+    in the entity's own entity group.  The id is that of the revision's audit record and payload is the zlib
+    compressed entity as it was put, since the entity may change again before the Audit record is built from it.
+    Deleted once the Audit record is written, see ndb_audit.outbox
+    """
+
+    data_hash = ndb.StringProperty(indexed=False, required=True, name='d')
+    parent_hash = ndb.StringProperty(indexed=False, default=None, name='p')
+    account = ndb.StringProperty(indexed=False, required=True, name='a')
+    timestamp = ndb.DateTimeProperty(indexed=False, required=True, name='ts')
+    payload = ndb.BlobProperty(indexed=False, required=True, name='pl')
+
     @property
     def rev_hash(self):
         return _hash_str(self.key.string_id())
 
+    @property
+    def entity_key(self):
+        return self.key.parent()
+
+    @classmethod
+    def create_from_entity(cls, entity, parent_hash, snapshot=None):
+        snapshot = snapshot or _PutSnapshot(entity)
+        audit_id = Audit.build_audit_record_key(snapshot.key, entity.data_hash, parent_hash, snapshot.account).id()
+        j = cls(key=ndb.Key(parent=snapshot.key, pairs=[('AuditJournal', audit_id)]),
+                data_hash=entity.data_hash,
+                parent_hash=parent_hash,
+                account=snapshot.account,
+                timestamp=snapshot.timestamp,
+                payload=zlib.compress(entity._to_pb().Encode()))
+        if _metrics is not None:
+            _metrics.observe('snapshot_bytes', len(j.payload), snapshot.kind)
+        return j
+
+    def entity_from_payload(self):
+        """ the audited entity as it was put at this revision """
+        model = ndb.Model._lookup_model(self.entity_key.kind())
+        entity = model._from_pb(entity_pb.EntityProto(zlib.decompress(self.payload)))
+        entity.rev_hash = self.rev_hash
+        return entity
+
+
+class AuditContent(ndb.Model):
+    """ the properties of a state of an audited entity, shared by the audit records of every revision with its data_hash
+    (see AuditMixin._audit_payload_dedup), encoded like Audit.payload.  last_used is refreshed by puts which refer to
+    it once it is REFRESH_AFTER old, so that content still in use is never pruned """
+
+    payload = ndb.BlobProperty(indexed=False, required=True, name='pl')
+    last_used = ndb.DateTimeProperty(indexed=True, required=True, name='u')
+
+    REFRESH_AFTER = datetime.timedelta(days=1)
+
+    @classmethod
+    def build_key(cls, entity_key, data_hash):
+        if ndb.Model._kind_map[entity_key.kind()]._audit_payload_dedup == 'kind':
+            return ndb.Key('AuditContent', '%s|%s' % (entity_key.kind(), data_hash), app=entity_key.app(),
+                           namespace=entity_key.namespace())
+        return ndb.Key(parent=_audit_root_key(entity_key), pairs=[('AuditContent', data_hash)])
+
+
+class AuditValueChange(ndb.Model):
+    """ an entry of the index of changes to the _audit_tracked_properties of a model: the revision with the audit
+    record audit set the property name of the entity to value.  Stored in the entity group of the audit records, the
+    id is the property name and the id of the audit record.  See ndb_audit.value_index for querying them
+
+    index.yaml entry required:
+    - kind: AuditValueChange
+      properties:
+      - name: k
+      - name: n
+      - name: v
+      - name: ts
+        direction: desc
+    """
+
+    kind = ndb.StringProperty(indexed=True, required=True, name='k')
+    name = ndb.StringProperty(indexed=True, required=True, name='n')
+    value = ndb.GenericProperty(indexed=True, name='v')
+    timestamp = ndb.DateTimeProperty(indexed=True, required=True, name='ts')
+    account = ndb.StringProperty(indexed=False, required=True, name='a')
+    audit = ndb.KeyProperty(indexed=False, required=True, name='r')
+    entity_key = ndb.KeyProperty(indexed=False, required=True, name='e')
+
+    @property
+    def rev_hash(self):
+        return _hash_str(self.audit.string_id())
+
+    @classmethod
+    def build_key(cls, audit_key, name):
+        return ndb.Key(parent=audit_key.parent(), pairs=[('AuditValueChange', '%s|%s' % (name, audit_key.string_id()))])
+
+    @classmethod
+    def create_from_entity(cls, entity, parent_hash, snapshot):
+        """ the entries for the tracked properties of the entity that changed since the parent revision, or are set
+        for the first time.  The previous values are compared by their digests in the entity's AuditHead (see
+        _PutSnapshot.bookkeeping) """
+        head = snapshot.bookkeeping(AuditHead._build_head_key(snapshot.key))
+        if head is not None and head.rev_hash != parent_hash:
+            head = None # blind put, or a revision that is not the latest.  Every tracked property counts as changed
+        a_key = Audit.build_audit_record_key(snapshot.key, entity.data_hash, parent_hash, snapshot.account)
+        digests = snapshot.digests
+        to_put = []
+        for name in entity._audit_tracked_properties:
+            value = snapshot.props.get(name)
+            if head is not None:
+                unchanged = head.digests.get(name) == digests.get(name)
+            else:
+                unchanged = value is None
+            if unchanged:
+                continue
+            to_put.append(cls(key=cls.build_key(a_key, name), kind=snapshot.kind, name=name, value=value,
+                              timestamp=snapshot.timestamp, account=snapshot.account, audit=a_key,
+                              entity_key=snapshot.key))
+        return to_put
+
+
+class AuditHead(ndb.Model):
+    """ bookkeeping for 'delta' audit storage, _audit_tracked_properties and _audit_keep_head, one per audited entity
+    which is its parent.  Holds the ids of the audit records written since the last checkpoint and a digest of each
+    property of the latest one, so the next revision can be stored as a delta without reading any audit records.  For
+    'full' storage it only holds the id of the latest audit record and the digests of the tracked properties """
+
+    chain = ndb.StringProperty(indexed=False, repeated=True, name='c')
+    delta_bytes = ndb.IntegerProperty(indexed=False, default=0, name='b')
+    digests = ndb.JsonProperty(indexed=False, compressed=True, name='m')
+
+    @property
+    def rev_hash(self):
+        return _hash_str(self.chain[-1])
+
+    @classmethod
+    def _build_head_key(cls, entity_or_key):
+        if isinstance(entity_or_key, ndb.Model):
+            entity_or_key = entity_or_key.key
+        return ndb.Key(parent=_audit_root_key(entity_or_key), pairs=[('AuditHead', 'head')])
+
 
 def tag_multi_from_rev_hash_async(entity_keys, rev_hashes, account, label):
     """ tag all of the supplied entity keys at the given rev hashes with the given label
@@ -169,6 +1184,73 @@ def tag_multi_from_rev_hash_async(entity_keys, rev_hashes, account, label):
     return ndb.put_multi_async(to_put)
 
 
+_TAG_BATCH_SIZE = 500 # tags per get, put or delete RPC, and per transaction (the commit limit)
+
+
+@ndb.tasklet
+def get_tags_multi_async(entities_or_keys, labels):
+    """ the tags with each of the labels of each of the audited entities, read in concurrent batched gets
+
+    :returns NDB Future for a list with, for each entity, a list of its Tag for each label (None where not tagged)
+    """
+    entities_or_keys = list(entities_or_keys)
+    keys = [Tag._build_tag_key(e, label) for e in entities_or_keys for label in labels]
+    tags = yield [f for chunk in _batches(keys, _TAG_BATCH_SIZE) for f in ndb.get_multi_async(chunk)]
+    n = len(labels)
+    raise ndb.Return([tags[i * n:(i + 1) * n] for i in xrange(len(entities_or_keys))])
+
+
+@ndb.tasklet
+def tag_multi_async(entities, labels, account=None, atomic=False, max_in_flight=10):
+    """ points each of the labels at the current rev_hash of each of the AuditMixin entities, moving them if they
+    already exist.  account defaults to each entity's _account().  Written in concurrent batches, which is not
+    transactional.  With atomic the tags of each entity group move together in a transaction of their own (entity
+    groups with more than 500 tags need several), up to max_in_flight of them at a time.  Either way this is
+    idempotent and must be called after the puts that set the rev_hashes
+
+    :returns NDB Future for the list of Tags written, for each entity in the order of labels
+    """
+    tags = [Tag.create_from_rev_hash(e.key, account if account is not None else e._account(), label, e.rev_hash)
+            for e in entities for label in labels]
+    if not atomic:
+        yield [f for chunk in _batches(tags, _TAG_BATCH_SIZE) for f in ndb.put_multi_async(chunk)]
+        raise ndb.Return(tags)
+
+    groups = {}
+    for t in tags:
+        groups.setdefault(t.key.root(), []).append(t)
+    chunks = [chunk for root in sorted(groups.iterkeys()) for chunk in _batches(groups[root], _TAG_BATCH_SIZE)]
+    chunks.reverse()
+
+    @ndb.tasklet
+    def put_chunk(chunk):
+        yield ndb.put_multi_async(chunk)
+
+    @ndb.tasklet
+    def worker():
+        while chunks:
+            chunk = chunks.pop()
+            yield ndb.transaction_async(lambda: put_chunk(chunk), propagation=ndb.TransactionOptions.INDEPENDENT)
+
+    yield [worker() for _ in xrange(min(max_in_flight, len(chunks)))]
+    raise ndb.Return(tags)
+
+
+@ndb.tasklet
+def delete_tags_multi_async(entities_or_keys, labels):
+    """ deletes the tags with each of the labels of each of the audited entities, whether they exist or not, in
+    concurrent batches.  This is not transactional
+
+    :returns NDB Future
+    """
+    keys = [Tag._build_tag_key(e, label) for e in entities_or_keys for label in labels]
+    yield [f for chunk in _batches(keys, _TAG_BATCH_SIZE) for f in ndb.delete_multi_async(chunk)]
+
+
+def _batches(items, size):
+    return [items[i:i + size] for i in xrange(0, len(items), size)]
+
+
 class Tag(ndb.Model):
     """ a tag is a pointer to a specific rev hash with a label.  Its parent is the Auditable entity
     "labels" are flexible, they can be any string safe for use in an NDB key.  The key is composed of the parent
@@ -214,10 +1296,19 @@ class Tag(ndb.Model):
             q = q.filter(Tag.rev_hash == rev_hash)
         return q
 
+    def _post_put_hook(self, future):
+        if _metrics is not None and future.get_exception() is None:
+            _metrics.increment('tags_written', kind=self.entity_key.kind())
+
     @classmethod
     def get_by_entity_key_label_async(cls, entity_or_key, label):
         return cls._build_tag_key(entity_or_key, label).get_async()
 
+    def get_audit_async(self, legacy_scan=False):
+        """ returns a future for the Audit entity of the revision this tag points to, see Audit.get_by_rev_hash_async
+        for legacy_scan """
+        return Audit.get_by_rev_hash_async(self.entity_key, self.rev_hash, legacy_scan)
+
     @classmethod
     def _build_tag_key(cls, entity_or_key, label):
         if isinstance(entity_or_key, ndb.Model):
@@ -225,33 +1316,294 @@ class Tag(ndb.Model):
         return ndb.Key(parent=entity_or_key, pairs=[('Tag', str(label))])
 
 
-def _hash_str(data_str):
+def _observe_history(entity_or_key, future):
+    """ reports the latency and result count of a history read to the installed AuditMetrics """
+    metrics = _metrics
+    if metrics is None:
+        return future
+    kind = entity_or_key.kind() if isinstance(entity_or_key, ndb.Key) else entity_or_key._get_kind()
+    start = time.time()
+
+    def done():
+        if future.get_exception() is None:
+            result = future.get_result()
+            metrics.observe('history_query_ms', (time.time() - start) * 1000, kind)
+            metrics.observe('history_query_results', len(result[0] if isinstance(result, tuple) else result), kind)
+
+    future.add_immediate_callback(done)
+    return future
+
+
+def _audit_root_key(entity_key):
+    """ the parent of the audit records of the entity, see AuditMixin._audit_log """
+    model = ndb.Model._kind_map.get(entity_key.kind())
+    if getattr(model, '_audit_log', None) != 'log':
+        return entity_key
+    # one root per entity, named by a digest of its key path so the name is deterministic and bounded in length
+    h = hashlib.sha1()
+    _canonical_encode(entity_key.flat(), h.update)
+    return ndb.Key('AuditLog', '%s|%s' % (entity_key.kind(), base64.urlsafe_b64encode(h.digest()).rstrip('=')),
+                   app=entity_key.app(), namespace=entity_key.namespace())
+
+
+def _hash_str(data_str, algorithm='sha1'):
     if not data_str:
         return data_str
-    return base64.urlsafe_b64encode(hashlib.sha1(data_str).digest()[0:HASH_LENGTH]).rstrip('=')
-
-
-def _entity_dict(entity):
-    props = entity._to_dict(exclude=['data_hash', 'rev_hash'])
-     # special handling for special properties
-    for k,v in props.iteritems():
-        prop = entity._properties[k]
-        if isinstance(prop, ndb.StructuredProperty):
-            if prop._repeated:
-                # v is a list of dictionaries, but needs to be a list of objects
-                # just replace with actual list from entity
-                props[k] = getattr(entity, k)
-            else:
-                pass # TODO
-        elif isinstance(prop, ndb.BlobProperty):
-            # v is the unencoded/unmarshaled value but safer just to hang on to raw binary value
-            base_val = prop._get_base_value(entity)
-            if not base_val:
-                continue
+    return _short_digest(_new_hash(algorithm, data_str).digest())
+
+
+def _short_digest(digest):
+    return base64.urlsafe_b64encode(digest[0:HASH_LENGTH]).rstrip('=')
+
+
+def _new_hash(algorithm, data_str=''):
+    if algorithm == 'blake2b':
+        if _blake2b is None:
+            raise ValueError('blake2b needs python 3.6+ or the pyblake2 package')
+        return _blake2b(data_str)
+    return hashlib.new(algorithm, data_str)
+
+
+class _PutSnapshot(object):
+    """ what a put of an entity needs to know about it, worked out once and shared by the data_hash, the audit record
+    and the delta bookkeeping.  account, props and digests are only worked out when first used, a put whose data_hash
+    turns out unchanged under 'v2'/'v3' never needs them.  The 'v2'/'v3' data_hash hands over the values it converted,
+    and 'v2' its per property digests, which are those of digests, so they are not worked out again.  prefetched holds
+    the bookkeeping entities read before the put, by key, and data_hash the entity's new data_hash when it was worked
+    out then """
+
+    __slots__ = ('entity', 'key', 'kind', 'timestamp', 'prefetched', 'data_hash', '_account', '_props', '_digests',
+                 '_hashed_values')
+
+    def __init__(self, entity, timestamp=None, account=None, prefetched=None):
+        self.entity = entity
+        self.prefetched = prefetched
+        self.data_hash = None
+        self.key = entity.key
+        self.kind = entity._get_kind()
+        self.timestamp = timestamp or datetime.datetime.utcnow()
+        self._account = account
+        self._props = None
+        self._digests = None
+        self._hashed_values = {}
 
-            # TODO: pretty dependent on _BaseValue impl which is not great
-            if isinstance(base_val, list):
-                props[k] = [b.b_val for b in base_val]
-            elif hasattr(base_val, 'b_val'):
-                props[k] = base_val.b_val
+    @property
+    def account(self):
+        """ the account making the change, from the entity's _account() unless given """
+        if self._account is None:
+            self._account = self.entity._account()
+        return self._account
+
+    @property
+    def props(self):
+        """ the _entity_dict of the entity, must not be changed """
+        if self._props is None:
+            self._props = _entity_dict(self.entity, self._hashed_values)
+            self._hashed_values = None
+        return self._props
+
+    @property
+    def digests(self):
+        """ per-property digests used by 'delta' storage to find changed properties """
+        if self._digests is None:
+            self._digests = dict([(k, _hash_str('%s=%s' % (k, str(v)))) for k, v in self.props.iteritems()])
+        return self._digests
+
+    def bookkeeping(self, key):
+        """ the AuditHead or AuditContent with the key, None when there is none.  Taken from prefetched when it was
+        read before the put, which the pre put hook relies on as it must not block on an RPC (see
+        AuditMixin._put_async), otherwise it is read now """
+        if self.prefetched is not None and key in self.prefetched:
+            return self.prefetched[key]
+        return key.get()
+
+
+def _entity_dict(entity, known=None):
+    """ the entity's properties by code name, as _to_dict returns them apart from the special handling of
+    _entity_dict_value.  known maps code names to values already worked out """
+    props = {}
+    for prop in entity._properties.itervalues():
+        name = prop._code_name
+        if name in _UNHASHED_PROPS:
+            continue
+        if known and name in known:
+            props[name] = known[name]
+            continue
+        try:
+            props[name] = _entity_dict_value(entity, prop, prop._get_for_dict(entity))
+        except ndb.UnprojectedPropertyError:
+            pass
     return props
+
+
+def _entity_dict_value(entity, prop, value):
+    """ special handling for special properties, value is what _to_dict returned for prop """
+    if isinstance(prop, ndb.StructuredProperty):
+        if prop._repeated:
+            # value is a list of dictionaries, but needs to be a list of objects
+            # just replace with actual list from entity
+            return getattr(entity, prop._code_name)
+        else:
+            pass # TODO
+    elif isinstance(prop, ndb.BlobProperty):
+        # value is the unencoded/unmarshaled value but safer just to hang on to raw binary value
+        base_val = prop._get_base_value(entity)
+        if not base_val:
+            return value
+
+        # TODO: pretty dependent on _BaseValue impl which is not great
+        if isinstance(base_val, list):
+            return [b.b_val for b in base_val]
+        elif hasattr(base_val, 'b_val'):
+            return base_val.b_val
+    return value
+
+
+_UNHASHED_PROPS = ('data_hash', 'rev_hash')
+
+# values of these types cannot be changed in place, so a digest of them stays valid until the property is assigned.
+# _BaseValue is included because ndb replaces it (rather than mutating it) whenever the user value is read back
+_IMMUTABLE_VALUE_TYPES = (basestring, int, long, float, bool, type(None), datetime.datetime, datetime.date,
+                          datetime.time, ndb.Key, ndb.GeoPt, ndb.BlobKey, ndb.model._BaseValue)
+
+
+def _reads_stored_value(prop):
+    """ whether the value of prop is the one stored in the entity's _values.  Others, like a ComputedProperty, can
+    change without any assignment to them, so their digests must not be cached """
+    return type(prop)._get_value.im_func is ndb.Property._get_value.im_func
+
+
+class _DigestTrackingDict(dict):
+    """ stands in for an entity's _values to hold cached 'v2' per-property digests, keyed by datastore name.
+    Assignments drop digests through AuditMixin.__setattr__.  Here a digest is dropped when its value is deleted or
+    when ndb stores a value that could be changed in place (e.g. the user value it converts a _BaseValue back to),
+    since we cannot tell when that happens """
+
+    __slots__ = ('digests',)
+
+    def __init__(self, values):
+        super(_DigestTrackingDict, self).__init__(values)
+        self.digests = {}
+
+    def __setitem__(self, name, value):
+        if not isinstance(value, _IMMUTABLE_VALUE_TYPES):
+            self.digests.pop(name, None)
+        super(_DigestTrackingDict, self).__setitem__(name, value)
+
+    def __delitem__(self, name):
+        self.digests.pop(name, None)
+        super(_DigestTrackingDict, self).__delitem__(name)
+
+    def pop(self, name, *default):
+        self.digests.pop(name, None)
+        return super(_DigestTrackingDict, self).pop(name, *default)
+
+    def setdefault(self, name, default=None):
+        self.digests.pop(name, None)
+        return super(_DigestTrackingDict, self).setdefault(name, default)
+
+    def update(self, *args, **kwargs):
+        self.digests.clear()
+        super(_DigestTrackingDict, self).update(*args, **kwargs)
+
+    def clear(self):
+        self.digests.clear()
+        super(_DigestTrackingDict, self).clear()
+
+
+def _v1_data_hash(props):
+    prop_str = '{v1}%s' % '|'.join(['%s=%s' % (k,str(props[k])) for k in sorted(props.iterkeys())])
+    return _hash_str(prop_str)
+
+
+def _merkle_data_hash(entity, version='v2', algorithm='sha1', snapshot=None):
+    """ 'v2' and 'v3' data_hash: the hash of the sorted per-property digests.  Digests of properties that have not
+    been stored since they were last hashed are reused.  Repeated and structured values can be changed in place
+    without ndb noticing so they are always rehashed.  The values converted, and the 'v2' digests, are handed to the
+    _PutSnapshot of the put if any """
+    hashed_values = snapshot._hashed_values if snapshot is not None and snapshot._props is None else None
+    values = entity._values
+    if not isinstance(values, _DigestTrackingDict):
+        values = entity._values = _DigestTrackingDict(values)
+    digests = values.digests
+    leaves = []
+    for prop in entity._properties.itervalues():
+        name = prop._code_name
+        if name in _UNHASHED_PROPS:
+            continue
+        digest = digests.get(prop._name)
+        if digest is None:
+            try:
+                value = _entity_dict_value(entity, prop, prop._get_for_dict(entity))
+            except ndb.UnprojectedPropertyError:
+                continue
+            if hashed_values is not None:
+                hashed_values[name] = value
+            if version == 'v2':
+                digest = hashlib.sha1('%s=%s' % (name, str(value))).digest()
+            else:
+                h = _new_hash(algorithm)
+                _canonical_encode(name, h.update)
+                _canonical_encode(value, h.update)
+                digest = h.digest()
+            if (not prop._repeated and not isinstance(prop, (ndb.StructuredProperty, ndb.LocalStructuredProperty))
+                    and _reads_stored_value(prop) and isinstance(values.get(prop._name), _IMMUTABLE_VALUE_TYPES)):
+                digests[prop._name] = digest
+        leaves.append((name, digest))
+    leaves.sort()
+    if version == 'v2':
+        if snapshot is not None and snapshot._digests is None:
+            # _PutSnapshot.digests are the short form of the same sha1
+            snapshot._digests = dict([(name, _short_digest(digest)) for name, digest in leaves])
+        return _hash_str('{v2}%s' % ''.join(['%s=%s|' % leaf for leaf in leaves]))
+    h = _new_hash(algorithm, '{v3:%s}' % algorithm)
+    for name, digest in leaves:
+        _canonical_encode(name, h.update)
+        h.update(digest)
+    return _short_digest(h.digest())
+
+
+def _canonical_encode(value, write):
+    """ 'v3' encoding of a property value, passed to write in pieces so large values are never copied.  Every value
+    starts with a type tag and is self delimiting so different values never encode the same.  str and unicode encode
+    the same (as UTF-8) because ndb hands back unicode for values that were assigned as str """
+    if value is None:
+        write('N')
+    elif isinstance(value, bool):
+        write('T' if value else 'F')
+    elif isinstance(value, (int, long)):
+        write('I%d;' % value)
+    elif isinstance(value, float):
+        write('D' + struct.pack('>d', value))
+    elif isinstance(value, basestring):
+        if isinstance(value, unicode):
+            value = value.encode('utf-8')
+        write('S%d:' % len(value))
+        write(value)
+    elif isinstance(value, datetime.datetime):
+        write('t%s;' % value.isoformat())
+    elif isinstance(value, datetime.date):
+        write('a%s;' % value.isoformat())
+    elif isinstance(value, datetime.time):
+        write('m%s;' % value.isoformat())
+    elif isinstance(value, ndb.Key):
+        write('K')
+        _canonical_encode(value.namespace(), write)
+        _canonical_encode(value.flat(), write)
+    elif isinstance(value, ndb.GeoPt):
+        write('G' + struct.pack('>dd', value.lat, value.lon))
+    elif isinstance(value, (list, tuple)):
+        write('L%d:' % len(value))
+        for v in value:
+            _canonical_encode(v, write)
+    elif isinstance(value, ndb.Model):
+        _canonical_encode(value._to_dict(), write)
+    elif isinstance(value, dict):
+        write('M%d:' % len(value))
+        for k in sorted(value.iterkeys()):
+            _canonical_encode(k, write)
+            _canonical_encode(value[k], write)
+    else:
+        # BlobKey, users.User and custom types hash by their str() like 'v1'
+        write('O%s:' % type(value).__name__)
+        _canonical_encode(str(value), write)
@@ -0,0 +1,100 @@
+"""
+Brings existing entities under audit without a transaction per entity.  Audit record keys are deterministic, so a
+backfill that is interrupted and resumed (or run twice) writes the same records again rather than new ones
+"""
+
+import datetime
+import logging
+import time
+
+from google.appengine.ext import ndb
+
+from ndb_audit import _prefetch_audit_async
+
+
+class BackfillProgress(object):
+    """ running totals of a backfill, passed to its progress callback after each batch is written.  cursor is where
+    to resume from: every entity before it has been written """
+
+    def __init__(self):
+        self.scanned = 0
+        self.audited = 0
+        self.batches = 0
+        self.cursor = None
+        self.more = True
+        self.started = time.time()
+
+    @property
+    def elapsed(self):
+        return time.time() - self.started
+
+    @property
+    def entities_per_second(self):
+        return self.scanned / self.elapsed if self.elapsed else 0.0
+
+    def __repr__(self):
+        return ('BackfillProgress(scanned=%d, audited=%d, batches=%d, %.1f entities/s)' %
+                (self.scanned, self.audited, self.batches, self.entities_per_second))
+
+
+@ndb.tasklet
+def backfill_async(query, batch_size=500, max_in_flight=4, cursor=None, max_batches=None, account=None,
+                   progress=None):
+    """ streams the entities of an AuditMixin model's query a page of batch_size at a time, sets their data_hash and
+    rev_hash and writes them along with their audit records in non-transactional batches, up to max_in_flight at a
+    time.  Entities whose data_hash is already current are not written again.  Audit records are written before
+    their entities, so an interrupted batch is redone in full when resumed from the last reported cursor.
+    account overrides each entity's _account() for the baseline revision.  progress(BackfillProgress) is called after
+    each batch.  Must not be used while the entities are being changed elsewhere, there is no transaction to catch
+    concurrent puts
+
+    :returns NDB Future for the final BackfillProgress, resume with its cursor while more is True
+    """
+    state = BackfillProgress()
+    state.cursor = cursor
+    in_flight = []
+    more = True
+    fetched = 0
+    while more and (max_batches is None or fetched < max_batches):
+        entities, cursor, more = yield query.fetch_page_async(batch_size, start_cursor=cursor)
+        fetched += 1
+        if len(in_flight) >= max_in_flight:
+            yield _finish_batch_async(in_flight.pop(0), state, progress)
+        in_flight.append((_write_batch_async(entities, account), len(entities), cursor, more))
+    while in_flight:
+        yield _finish_batch_async(in_flight.pop(0), state, progress)
+    logging.info('ndb_audit backfill of %s finished: %r' % (query.kind, state))
+    raise ndb.Return(state)
+
+
+@ndb.tasklet
+def _finish_batch_async(batch, state, progress):
+    future, scanned, cursor, more = batch
+    audited = yield future
+    state.scanned += scanned
+    state.audited += audited
+    state.batches += 1
+    state.cursor = cursor
+    state.more = more
+    logging.debug('ndb_audit backfill progress: %r' % state)
+    if progress is not None:
+        progress(state)
+
+
+@ndb.tasklet
+def _write_batch_async(entities, account):
+    """ :returns NDB Future for the number of entities that needed a new revision """
+    yield _prefetch_audit_async(entities)
+    timestamp = datetime.datetime.utcnow()
+    audits = []
+    changed = []
+    for e in entities:
+        to_put = e._batch_put_hook(timestamp, account)
+        if to_put:
+            audits.extend(to_put)
+            changed.append(e)
+        else:
+            e._skip_pre_hook = False
+    yield ndb.put_multi_async(audits)
+    yield ndb.put_multi_async(changed)
+    raise ndb.Return(len(changed))
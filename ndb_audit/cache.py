@@ -0,0 +1,173 @@
+"""
+Content addressed cache of audited entities keyed by (kind, data_hash).  An entity's properties are always the same at
+a given data_hash, so cached copies never need invalidating -- a changed entity simply has a new data_hash.  Only the
+properties are cached: entities of a kind with the same properties share an entry, but each revision has its own
+rev_hash, which is set on the entities read from the cache as described in EntityCache.get_multi_async
+"""
+
+import collections
+import threading
+
+from google.appengine.datastore import entity_pb
+from google.appengine.ext import ndb
+
+from ndb_audit import AuditMixin, _latest_revisions_async
+
+_MEMCACHE_MAX_VALUE_BYTES = 1000000
+# the revision of the entity that was cached, not part of its properties
+_UNCACHED_NAMES = frozenset([AuditMixin.data_hash._name, AuditMixin.rev_hash._name])
+
+
+class EntityCache(object):
+    """ an in-process LRU holding at most max_bytes of serialized entity properties in front of memcache.  They are
+    cached by kind and data_hash, so entities of a kind with the same properties share an entry """
+
+    def __init__(self, max_bytes=10000000, memcache_namespace='ndb_audit', memcache_time=0, use_memcache=True):
+        self.max_bytes = max_bytes
+        self.memcache_namespace = memcache_namespace
+        self.memcache_time = memcache_time
+        self.use_memcache = use_memcache
+        self._lru = collections.OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def put(self, entity):
+        """ caches the entity as of its data_hash, which is only up to date once it has been put
+        :returns NDB Future for the memcache write, or None
+        """
+        if entity.data_hash is None:
+            return None
+        cache_key = _cache_key(entity._get_kind(), entity.data_hash)
+        value = _properties_pb(entity).Encode()
+        self._local_put(cache_key, value)
+        if self.use_memcache and len(value) < _MEMCACHE_MAX_VALUE_BYTES:
+            return ndb.get_context().memcache_set(cache_key, value, time=self.memcache_time,
+                                                  namespace=self.memcache_namespace)
+        return None
+
+    @ndb.tasklet
+    def get_multi_async(self, keys, data_hashes, rev_hashes=None):
+        """ read through: the entities with the given keys at the given data_hashes.  Those not cached are read from
+        the datastore and cached if they are still at the requested data_hash, otherwise whatever is current is
+        returned (None if deleted).
+        The rev_hash of the cached ones is taken from rev_hashes when given.  Otherwise it is that of the latest
+        revision of the entity, read as current_data_hashes_async does, and entities whose latest revision is at
+        another data_hash are read from the datastore instead
+
+        :returns NDB Future for a list of entities in the same order as keys
+        """
+        entities = yield self.get_cached_multi_async(keys, data_hashes, rev_hashes)
+        if rev_hashes is None:
+            cached = [i for i, e in enumerate(entities) if e is not None]
+            latest = yield _latest_revisions_async([keys[i] for i in cached])
+            for i, revision in zip(cached, latest):
+                if revision is not None and revision[1] == data_hashes[i]:
+                    entities[i].rev_hash = revision[0]
+                else:
+                    entities[i] = None
+        missing = [i for i, e in enumerate(entities) if e is None]
+        if not missing:
+            raise ndb.Return(entities)
+        loaded = yield ndb.get_multi_async([keys[i] for i in missing])
+        writes = []
+        for i, e in zip(missing, loaded):
+            entities[i] = e
+            if e is not None and e.data_hash == data_hashes[i]:
+                writes.append(self.put(e))
+        yield [w for w in writes if w is not None]
+        raise ndb.Return(entities)
+
+    @ndb.tasklet
+    def get_cached_multi_async(self, keys, data_hashes, rev_hashes=None):
+        """ the cached entities with the given keys at the given data_hashes, None for any that are not cached.  Their
+        rev_hash is taken from rev_hashes, and is None without them: set it before putting them, or an entity put
+        without it starts a new audit chain
+        :returns NDB Future for a list of entities in the same order as keys
+        """
+        cache_keys = [_cache_key(k.kind(), d) for k, d in zip(keys, data_hashes)]
+        values = [self._local_get(c) for c in cache_keys]
+        if self.use_memcache:
+            missing = [i for i, v in enumerate(values) if v is None and data_hashes[i]]
+            ctx = ndb.get_context()
+            found = yield [ctx.memcache_get(cache_keys[i], namespace=self.memcache_namespace) for i in missing]
+            for i, v in zip(missing, found):
+                if v is not None:
+                    values[i] = v
+                    self._local_put(cache_keys[i], v)
+        rev_hashes = rev_hashes or [None] * len(keys)
+        raise ndb.Return([_from_cached(k, v, d, r) if v is not None else None
+                          for k, v, d, r in zip(keys, values, data_hashes, rev_hashes)])
+
+    def _local_get(self, cache_key):
+        with self._lock:
+            value = self._lru.pop(cache_key, None)
+            if value is not None:
+                self._lru[cache_key] = value # most recently used last
+            return value
+
+    def _local_put(self, cache_key, value):
+        if len(value) > self.max_bytes:
+            return
+        with self._lock:
+            old = self._lru.pop(cache_key, None)
+            if old is not None:
+                self._bytes -= len(old)
+            self._lru[cache_key] = value
+            self._bytes += len(value)
+            while self._bytes > self.max_bytes:
+                _, evicted = self._lru.popitem(last=False)
+                self._bytes -= len(evicted)
+
+
+@ndb.tasklet
+def validate_multi_async(keys, known_data_hashes):
+    """ tells clients which of their copies of the entities are stale, with the current data_hash of each read as
+    current_data_hashes_async does
+
+    :returns NDB Future for a list of booleans, True where the known data_hash is no longer current (including
+    entities that have no audit history)
+    """
+    current = yield current_data_hashes_async(keys)
+    raise ndb.Return([c is None or c != d for c, d in zip(current, known_data_hashes)])
+
+
+def validate_multi(keys, known_data_hashes):
+    return validate_multi_async(keys, known_data_hashes).get_result()
+
+
+@ndb.tasklet
+def current_data_hashes_async(keys):
+    """ the data_hash of the latest revision of each entity, None when it has none.  It is read from the entity's
+    AuditHead where the model keeps one, otherwise from the key of its newest audit record, or from the entity itself
+    when its history is not in the timestamp index (see ndb_audit._latest_revisions_async)
+    :returns NDB Future for a list of data_hashes in the same order as keys
+    """
+    latest = yield _latest_revisions_async(keys)
+    raise ndb.Return([r[1] if r else None for r in latest])
+
+
+def _cache_key(kind, data_hash):
+    return '%s:%s' % (kind, data_hash)
+
+
+def _properties_pb(entity):
+    """ the entity's pb without its data_hash and rev_hash """
+    pb = entity._to_pb()
+    cached = entity_pb.EntityProto()
+    cached.mutable_key().CopyFrom(pb.key())
+    cached.mutable_entity_group()
+    for p in pb.property_list():
+        if p.name() not in _UNCACHED_NAMES:
+            cached.add_property().CopyFrom(p)
+    for p in pb.raw_property_list():
+        if p.name() not in _UNCACHED_NAMES:
+            cached.add_raw_property().CopyFrom(p)
+    return cached
+
+
+def _from_cached(key, value, data_hash, rev_hash):
+    entity = ndb.Model._lookup_model(key.kind())._from_pb(entity_pb.EntityProto(value), set_key=False)
+    entity.key = key
+    entity.data_hash = data_hash
+    entity.rev_hash = rev_hash
+    return entity
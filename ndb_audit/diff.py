@@ -0,0 +1,158 @@
+"""
+Property level diffs between two revisions of an audited entity
+"""
+
+import difflib
+
+from google.appengine.ext import ndb
+
+from ndb_audit import Audit, _canonical_encode, _decode_payload_properties, _payload_property_pbs
+
+
+class Change(object):
+    """ one difference between two revisions.  path is a tuple of the property name followed by the list indexes and
+    structured property names leading to the value that differs.  List indexes are into the new list for 'add' and
+    'change' and into the old list for 'remove'.  old is None for 'add' and new is None for 'remove' """
+
+    __slots__ = ('path', 'op', 'old', 'new')
+
+    def __init__(self, path, op, old, new):
+        self.path = path
+        self.op = op
+        self.old = old
+        self.new = new
+
+    def __eq__(self, other):
+        return isinstance(other, Change) and ((self.path, self.op, self.old, self.new) ==
+                                              (other.path, other.op, other.old, other.new))
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return 'Change(%r, %r, %r, %r)' % (self.path, self.op, self.old, self.new)
+
+
+class RevisionDiff(object):
+    """ the differences between two revisions of an entity, see diff_async """
+
+    def __init__(self, entity_key, from_rev_hash, to_rev_hash, changes):
+        self.entity_key = entity_key
+        self.from_rev_hash = from_rev_hash
+        self.to_rev_hash = to_rev_hash
+        self.changes = changes
+
+    @property
+    def changed_properties(self):
+        return sorted(set([c.path[0] for c in self.changes]))
+
+    def __nonzero__(self):
+        return bool(self.changes)
+
+
+@ndb.tasklet
+def diff_async(entity_key, from_rev_hash, to_rev_hash):
+    """ compares two revisions of the entity.  from_rev_hash may be None to diff against nothing, everything in
+    to_rev_hash is then an 'add'.  Revisions with the same data_hash are not compared at all and properties whose
+    stored values are the same are skipped without decoding them (for 'blob' records)
+
+    :returns NDB Future for a RevisionDiff with changes ordered by property name
+    """
+    from_future = Audit.get_by_rev_hash_async(entity_key, from_rev_hash) if from_rev_hash else None
+    to_audit = yield Audit.get_by_rev_hash_async(entity_key, to_rev_hash)
+    from_audit = (yield from_future) if from_future else None
+    for rev_hash, audit in ((from_rev_hash, from_audit), (to_rev_hash, to_audit)):
+        if rev_hash and audit is None:
+            raise ValueError('revision %s of %s not found' % (rev_hash, entity_key))
+    changes = yield _diff_audits_async(from_audit, to_audit)
+    raise ndb.Return(RevisionDiff(entity_key, from_rev_hash, to_rev_hash, changes))
+
+
+def diff_multi_async(entity_keys, from_rev_hashes, to_rev_hashes):
+    """ batch version of diff_async, all the diffs run concurrently
+    :returns list of NDB Futures
+    """
+    return [diff_async(k, f, t) for k, f, t in zip(entity_keys, from_rev_hashes, to_rev_hashes)]
+
+
+@ndb.tasklet
+def _diff_audits_async(from_audit, to_audit):
+    if from_audit is not None and from_audit.data_hash == to_audit.data_hash:
+        raise ndb.Return([])
+    if from_audit is None:
+        old_props = {}
+        new_props = yield to_audit.entity_dict_async()
+    elif _is_full_blob(from_audit) and _is_full_blob(to_audit):
+        # compare the encoded properties and only decode the ones that differ
+        old_pbs = _payload_property_pbs(from_audit.payload)
+        new_pbs = _payload_property_pbs(to_audit.payload)
+        names = [k for k in set(old_pbs) | set(new_pbs) if _encoded(old_pbs.get(k)) != _encoded(new_pbs.get(k))]
+        old_props = _decode_payload_properties(sum([old_pbs.get(k, []) for k in names], []))
+        new_props = _decode_payload_properties(sum([new_pbs.get(k, []) for k in names], []))
+    else:
+        old_props, new_props = yield from_audit.entity_dict_async(), to_audit.entity_dict_async()
+    changes = []
+    _diff_dicts((), _plain(old_props), _plain(new_props), changes)
+    raise ndb.Return(changes)
+
+
+def _is_full_blob(audit):
+    return audit.payload is not None and not audit.delta
+
+
+def _encoded(property_pbs):
+    return property_pbs and ''.join([('r' if is_raw else 'p') + p.Encode() for is_raw, p in property_pbs])
+
+
+def _plain(value):
+    """ structured values come back as model instances of either their own class or Expando, compare them as dicts """
+    if isinstance(value, ndb.Model):
+        return value._to_dict()
+    if isinstance(value, list):
+        return [_plain(v) for v in value]
+    if isinstance(value, dict):
+        return dict([(k, _plain(v)) for k, v in value.iteritems()])
+    return value
+
+
+def _diff_values(path, old, new, changes):
+    if old == new:
+        return
+    if isinstance(old, dict) and isinstance(new, dict):
+        _diff_dicts(path, old, new, changes)
+    elif isinstance(old, list) and isinstance(new, list):
+        _diff_lists(path, old, new, changes)
+    else:
+        changes.append(Change(path, 'change', old, new))
+
+
+def _diff_dicts(path, old, new, changes):
+    for k in sorted(set(old) | set(new)):
+        if k not in old:
+            changes.append(Change(path + (k,), 'add', None, new[k]))
+        elif k not in new:
+            changes.append(Change(path + (k,), 'remove', old[k], None))
+        else:
+            _diff_values(path + (k,), old[k], new[k], changes)
+
+
+def _diff_lists(path, old, new, changes):
+    matcher = difflib.SequenceMatcher(None, [_element_key(v) for v in old], [_element_key(v) for v in new],
+                                      autojunk=False)
+    for op, i1, i2, j1, j2 in matcher.get_opcodes():
+        if op == 'equal':
+            continue
+        # pair up replaced elements so changes inside structured values are reported field by field
+        paired = min(i2 - i1, j2 - j1) if op == 'replace' else 0
+        for n in xrange(paired):
+            _diff_values(path + (j1 + n,), old[i1 + n], new[j1 + n], changes)
+        for i in xrange(i1 + paired, i2):
+            changes.append(Change(path + (i,), 'remove', old[i], None))
+        for j in xrange(j1 + paired, j2):
+            changes.append(Change(path + (j,), 'add', None, new[j]))
+
+
+def _element_key(value):
+    parts = []
+    _canonical_encode(value, parts.append)
+    return ''.join(parts)
@@ -0,0 +1,82 @@
+"""
+A change feed over the audit records of every audited entity, for consumers such as search indexers, cache
+invalidators and warehouse loaders that need to know what changed since they last looked.  Changes are read in
+timestamp order from the Audit kind and timestamp indexes, optionally for a single kind, and resumed with cursors.
+
+index.yaml entry required to follow a single kind:
+- kind: Audit
+  properties:
+  - name: k
+  - name: ts
+
+These are global queries, so they are eventually consistent, and a revision's timestamp is taken before its
+transaction commits.  So only revisions older than settle are returned: a revision that shows up later than that
+behind the feed's position is missed.  Models using _audit_write = 'outbox' only have their records written when
+drained (with the timestamp of the put), so set settle comfortably above the drain delay when following them
+"""
+
+import datetime
+
+from google.appengine.ext import ndb
+
+from ndb_audit import Audit
+
+DEFAULT_SETTLE = datetime.timedelta(seconds=10)
+
+
+def query_changes(kind=None, since=None):
+    """ the audit records of kind (the kind of the audited entities, any kind when None) written at or after since,
+    oldest first.  Records written before Audit.kind was indexed are not returned for a kind until they are put again,
+    see Audit.reindex_history_async
+    returns a query object
+    """
+    q = Audit.query()
+    if kind is not None:
+        q = q.filter(Audit.kind == kind)
+    if since is not None:
+        q = q.filter(Audit.timestamp >= since)
+    return q.order(Audit.timestamp)
+
+
+@ndb.tasklet
+def fetch_changes_async(kind=None, since=None, batch_size=100, cursor=None, until=None, settle=DEFAULT_SETTLE):
+    """ the next batch of at most batch_size changes of the feed, see query_changes.  Pass the returned cursor back in
+    (with the same kind and since) to get the batch after it.  Stops before revisions newer than settle ago or than
+    until
+
+    :returns NDB Future for a (list of Audit entities, cursor, more) tuple.  more is False once the feed has caught
+    up, the cursor can still be used later to pick up revisions written since
+    """
+    cutoff = datetime.datetime.utcnow() - settle
+    if until is not None:
+        cutoff = min(cutoff, until)
+    it = query_changes(kind, since).iter(start_cursor=cursor, produce_cursors=True, batch_size=batch_size)
+    audits = []
+    while len(audits) < batch_size:
+        has_next = yield it.has_next_async()
+        if not has_next:
+            raise ndb.Return((audits, it.cursor_after() if audits else cursor, False))
+        a = it.next()
+        if a.timestamp > cutoff:
+            # not settled yet (or out of range), the next batch starts with it
+            raise ndb.Return((audits, it.cursor_before(), False))
+        audits.append(a)
+    raise ndb.Return((audits, it.cursor_after(), True))
+
+
+def iter_changes(kind=None, since=None, batch_size=100, cursor=None, until=None, settle=DEFAULT_SETTLE):
+    """ generator over the changes of the feed in order, in batches of at most batch_size, until it has caught up.
+    yields (list of Audit entities, cursor) tuples, the cursor resumes the feed after that batch.  The next batch is
+    fetched while the caller works on the current one
+    """
+    if until is None:
+        # fixed for the whole iteration, so it ends even while revisions keep being written
+        until = datetime.datetime.utcnow() - settle
+    future = fetch_changes_async(kind, since, batch_size, cursor, until, settle)
+    while future:
+        audits, cursor, more = future.get_result()
+        future = None
+        if more:
+            future = fetch_changes_async(kind, since, batch_size, cursor, until, settle)
+        if audits:
+            yield audits, cursor
@@ -0,0 +1,129 @@
+"""
+Reads audited entities as they were at a point in time or at a given revision, rebuilt from their Audit records as
+instances of their own model class
+"""
+
+from google.appengine.ext import ndb
+
+from ndb_audit import Audit
+
+
+@ndb.tasklet
+def get_as_of_multi_async(keys, timestamp, max_in_flight=100):
+    """ each entity as it was at timestamp: its newest revision written at or before then, or None if it had none.
+    One indexed history query per entity (see Audit.query_history), up to max_in_flight of them at a time.  Deletes
+    are not audited, so an entity deleted since still reads as its last revision
+
+    :returns NDB Future for a list of entities in the same order as keys
+    """
+    entities = yield _map_async(lambda k: _as_of_async(k, timestamp), keys, max_in_flight)
+    raise ndb.Return(entities)
+
+
+@ndb.tasklet
+def get_at_rev_multi_async(keys, rev_hashes, max_in_flight=100, legacy_scan=False):
+    """ each entity as it was at the revision with the given rev_hash, or None if there is no such revision.  One
+    indexed query per entity (see Audit.get_by_rev_hash_async for legacy_scan and the reindex_history_async migration
+    of older records), up to max_in_flight of them at a time
+
+    :returns NDB Future for a list of entities in the same order as keys
+    """
+    entities = yield _map_async(lambda (key, rev_hash): _at_rev_async(key, rev_hash, legacy_scan),
+                                zip(keys, rev_hashes), max_in_flight)
+    raise ndb.Return(entities)
+
+
+@ndb.tasklet
+def entity_from_audit_async(entity_key, audit):
+    """ the audited entity with the given key as of the revision of the Audit record, an instance of its model class
+    with data_hash and rev_hash set.  'delta' records are rebuilt from their checkpoint, see Audit.entity_dict_async
+
+    :returns NDB Future for the entity
+    """
+    props = yield audit.entity_dict_async()
+    entity = ndb.Model._lookup_model(entity_key.kind())(key=entity_key)
+    _restore_properties(entity, props)
+    entity.data_hash = audit.data_hash
+    entity.rev_hash = audit.rev_hash
+    raise ndb.Return(entity)
+
+
+@ndb.tasklet
+def _as_of_async(key, timestamp):
+    audit = yield Audit.query_history(key).filter(Audit.timestamp <= timestamp).get_async()
+    if audit is None:
+        raise ndb.Return(None)
+    entity = yield entity_from_audit_async(key, audit)
+    raise ndb.Return(entity)
+
+
+@ndb.tasklet
+def _at_rev_async(key, rev_hash, legacy_scan):
+    if not rev_hash:
+        raise ndb.Return(None)
+    audit = yield Audit.get_by_rev_hash_async(key, rev_hash, legacy_scan)
+    if audit is None:
+        raise ndb.Return(None)
+    entity = yield entity_from_audit_async(key, audit)
+    raise ndb.Return(entity)
+
+
+@ndb.tasklet
+def _map_async(fn, items, max_in_flight):
+    results = [None] * len(items)
+    pending = range(len(items) - 1, -1, -1)
+
+    @ndb.tasklet
+    def worker():
+        while pending:
+            i = pending.pop()
+            results[i] = yield fn(items[i])
+
+    yield [worker() for _ in xrange(min(max_in_flight, len(items)))]
+    raise ndb.Return(results)
+
+
+def _restore_properties(entity, props):
+    """ sets the properties of entity from the values an audit record stored for them, see _entity_dict """
+    for name, value in props.iteritems():
+        prop = getattr(entity.__class__, name, None)
+        if not isinstance(prop, ndb.Property):
+            # Expando dynamic property, which can hold structured values as models but not as dicts
+            setattr(entity, name, _expando_value(value))
+        elif isinstance(prop, ndb.ComputedProperty):
+            continue
+        elif isinstance(prop, ndb.StructuredProperty):
+            if prop._repeated:
+                prop._set_value(entity, [_structured_value(prop._modelclass, v) for v in value or []])
+            else:
+                prop._set_value(entity, None if value is None else _structured_value(prop._modelclass, value))
+        elif isinstance(prop, ndb.BlobProperty):
+            # stored as the already converted base value, so it must not be converted again
+            if prop._repeated:
+                prop._store_value(entity, [ndb.model._BaseValue(v) for v in value or []])
+            else:
+                prop._store_value(entity, None if value is None else ndb.model._BaseValue(value))
+        else:
+            prop._set_value(entity, value)
+
+
+def _structured_value(modelclass, value):
+    m = modelclass()
+    if isinstance(value, modelclass):
+        # the instance the record was built from, still in the context cache.  It holds user values already
+        m.populate(**value._to_dict())
+        return m
+    if isinstance(value, ndb.Model):
+        value = value._to_dict()
+    _restore_properties(m, value)
+    return m
+
+
+def _expando_value(value):
+    if isinstance(value, dict):
+        e = ndb.Expando()
+        e.populate(**dict([(k, _expando_value(v)) for k, v in value.iteritems()]))
+        return e
+    if isinstance(value, list):
+        return [_expando_value(v) for v in value]
+    return value
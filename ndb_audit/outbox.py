@@ -0,0 +1,126 @@
+"""
+Builds the Audit records of models using _audit_write = 'outbox' from their AuditJournal entries, outside of the
+request that put them.  Draining is idempotent: audit record keys are deterministic and journal entries are only
+deleted in the same transaction that writes their records
+"""
+
+import logging
+
+from google.appengine.ext import ndb
+
+from ndb_audit import AuditJournal, _PutSnapshot
+
+
+class InProcessOutboxQueue(object):
+    """ collects the keys of entities to drain until run() is called, for tests and scripts """
+
+    def __init__(self):
+        self.pending = []
+
+    def add(self, entity_keys):
+        self.pending.extend(entity_keys)
+
+    def run(self, max_in_flight=10):
+        """ drains everything added so far, including anything added while draining
+        :returns the number of audit records written
+        """
+        written = 0
+        while self.pending:
+            keys, self.pending = self.pending, []
+            written += drain_async(keys, max_in_flight).get_result()
+        return written
+
+
+class DeferredOutboxQueue(object):
+    """ drains each batch of entities in a task queue task (needs the deferred builtin enabled in app.yaml) """
+
+    def __init__(self, queue_name='default', countdown=0):
+        self.queue_name = queue_name
+        self.countdown = countdown
+
+    def add(self, entity_keys):
+        from google.appengine.ext import deferred
+        deferred.defer(_drain_task, [k.urlsafe() for k in entity_keys], _queue=self.queue_name,
+                       _countdown=self.countdown)
+
+
+def _drain_task(urlsafe_keys):
+    drain_async([ndb.Key(urlsafe=k) for k in urlsafe_keys]).get_result()
+
+
+@ndb.tasklet
+def drain_async(entity_keys, max_in_flight=10):
+    """ writes the Audit records of all journaled revisions of the entities, one transaction per entity and up to
+    max_in_flight of them at a time
+
+    :returns NDB Future for the number of audit records written
+    """
+    keys = sorted(set(entity_keys))
+    written = [0]
+
+    @ndb.tasklet
+    def worker():
+        while keys:
+            n = yield _drain_entity_async(keys.pop())
+            written[0] += n
+
+    yield [worker() for _ in xrange(min(max_in_flight, len(keys)))]
+    raise ndb.Return(written[0])
+
+
+@ndb.tasklet
+def drain_outbox_async(batch_size=100, max_in_flight=10, cursor=None):
+    """ sweeps every pending AuditJournal entry, a page of batch_size at a time.  This is a global query so entries
+    written in the last moments may be missed, run it periodically to catch entities whose queue notification was lost
+
+    :returns NDB Future for (audit records written, cursor, more)
+    """
+    journal_keys, cursor, more = yield AuditJournal.query().fetch_page_async(batch_size, start_cursor=cursor,
+                                                                             keys_only=True)
+    written = yield drain_async([k.parent() for k in journal_keys], max_in_flight)
+    raise ndb.Return((written, cursor, more))
+
+
+def _drain_entity_async(entity_key):
+    # cross-group because of _audit_log = 'log'
+    return ndb.transaction_async(lambda: _materialize_async(entity_key), xg=True,
+                                 propagation=ndb.TransactionOptions.INDEPENDENT)
+
+
+@ndb.tasklet
+def _materialize_async(entity_key):
+    journals = yield AuditJournal.query(ancestor=entity_key).fetch_async()
+    if not journals:
+        raise ndb.Return(0)
+    journals = _chain_order(journals)
+    entities = [j.entity_from_payload() for j in journals]
+    # the AuditHead and AuditContent all the revisions need are read in one batch, each revision after the first then
+    # takes those written for the one before it
+    prefetch_keys = set()
+    for j, entity in zip(journals, entities):
+        prefetch_keys.update(entity._audit_prefetch_keys(j.data_hash))
+    prefetch_keys = list(prefetch_keys)
+    prefetched = dict(zip(prefetch_keys, (yield ndb.get_multi_async(prefetch_keys)))) if prefetch_keys else {}
+    to_put = {} # by key, an AuditHead or AuditContent written again replaces the earlier one
+    for j, entity in zip(journals, entities):
+        snapshot = _PutSnapshot(entity, j.timestamp, j.account, prefetched)
+        for e in entity._build_audit_entities(j.parent_hash, snapshot):
+            to_put[e.key] = prefetched[e.key] = e
+    yield ndb.put_multi_async(to_put.values()), ndb.delete_multi_async([j.key for j in journals])
+    logging.debug('ndb_audit drained %d journal entries of %s' % (len(journals), entity_key))
+    raise ndb.Return(len(journals))
+
+
+def _chain_order(journals):
+    """ oldest revision first, following the parent_hash of each """
+    by_parent = dict([(j.parent_hash, j) for j in journals])
+    rev_hashes = set([j.rev_hash for j in journals])
+    roots = [j for j in journals if j.parent_hash not in rev_hashes]
+    ordered = []
+    for j in sorted(roots, key=lambda j: j.timestamp):
+        while j is not None and j not in ordered:
+            ordered.append(j)
+            j = by_parent.get(j.rev_hash)
+    # revisions that branch from the same parent are left out above, take them by timestamp
+    ordered.extend(sorted([j for j in journals if j not in ordered], key=lambda j: j.timestamp))
+    return ordered
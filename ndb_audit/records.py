@@ -0,0 +1,208 @@
+"""
+A compact, read-only view of audit records for scanning many of them.  Queries return RevisionRecords built straight
+from the datastore protocol buffers instead of Audit Expando entities: the revision header is decoded right away and
+the audited entity's properties only when one is read, and the records are not kept in the context cache.  Pass
+with_payload=False to drop the properties altogether when only the header is needed, e.g. to draw a timeline
+"""
+
+import json
+
+from google.appengine.datastore import datastore_query, datastore_rpc
+from google.appengine.ext import ndb
+
+from ndb_audit import (Audit, _decode_payload_properties, _escape_payload_name, _hash_str, _payload_property_pbs,
+                       _unescape_payload_name)
+
+_HEADER_NAMES = dict([(p._name, p._code_name) for p in Audit._properties.itervalues()])
+_GENERIC = ndb.GenericProperty()
+
+
+class RevisionRecord(object):
+    """ the header of an Audit record (key, kind, data_hash, parent_hash, account, timestamp, rev_hash, entity_key,
+    squashed, content, delta) as plain attributes, and the audited entity's properties stored in it as attributes that
+    are decoded when first read.  Structured values read as Expando instances, like those of 'blob' Audit records.
+    Only the changed properties are stored in 'delta' records, see entity_dict_async, and the properties of records
+    referring to an AuditContent are read from it when first needed """
+
+    __slots__ = ('key', 'kind', 'data_hash', 'parent_hash', 'account', 'timestamp', 'rev_hash', 'entity_key',
+                 'squashed', 'content', '_delta', '_payload', '_groups', '_values')
+
+    def __init__(self, key):
+        self.key = key
+        self.kind = None
+        self.data_hash = None
+        self.parent_hash = None
+        self.account = None
+        self.timestamp = None
+        self.rev_hash = _hash_str(key.string_id())
+        self.entity_key = None
+        self.squashed = None
+        self.content = None
+        self._delta = None
+        # list of (is_raw, property pb), or the encoded payload of 'blob' and dedup records.  None without payload
+        self._payload = None
+        self._groups = None
+        self._values = {}
+
+    @classmethod
+    def _from_pb(cls, pb, with_payload=True):
+        r = cls(ndb.Key(reference=pb.key()))
+        payload = []
+        for is_raw, props in ((False, pb.property_list()), (True, pb.raw_property_list())):
+            for p in props:
+                name = p.name()
+                code_name = _HEADER_NAMES.get(name)
+                if code_name is None:
+                    if with_payload:
+                        payload.append((is_raw, p))
+                elif code_name == 'delta':
+                    if p.value().has_stringvalue():
+                        r._delta = p.value().stringvalue()
+                elif code_name == 'payload':
+                    if with_payload and p.value().has_stringvalue():
+                        payload = p.value().stringvalue()
+                elif code_name != 'rev_hash':
+                    setattr(r, code_name, _GENERIC._db_get_value(p.value(), p))
+        r._payload = payload if with_payload else None
+        return r
+
+    @classmethod
+    @ndb.tasklet
+    def load_content_multi_async(cls, records):
+        """ see Audit.load_content_multi_async
+
+        :returns NDB Future for records
+        """
+        pending = [r for r in records if r is not None and r._needs_content()]
+        contents = yield ndb.get_multi_async([r.content for r in pending])
+        for r, c in zip(pending, contents):
+            r._set_content(c)
+        raise ndb.Return(records)
+
+    @property
+    def delta(self):
+        """ see Audit.delta """
+        if isinstance(self._delta, basestring):
+            self._delta = json.loads(self._delta)
+        return self._delta
+
+    def property_names(self):
+        """ the names of the audited entity's properties stored in this record """
+        return sorted(self._property_groups().iterkeys())
+
+    def to_dict(self):
+        """ all of the audited entity's properties stored in this record """
+        return dict([(name, self._property_value(name)) for name in self._property_groups()])
+
+    @ndb.tasklet
+    def entity_dict_async(self):
+        """ see Audit.entity_dict_async, 'delta' records are read again in full to rebuild them """
+        if not self._delta:
+            if self._needs_content():
+                content = yield self.content.get_async()
+                self._set_content(content)
+            raise ndb.Return(self.to_dict())
+        audit = yield self.key.get_async()
+        props = yield audit.entity_dict_async()
+        raise ndb.Return(props)
+
+    def _needs_content(self):
+        return self.content is not None and self._groups is None and self._payload is not None
+
+    def _set_content(self, content):
+        if content is None:
+            raise ValueError('audit content %s of %s is missing' % (self.content, self.rev_hash))
+        self._payload = content.payload
+
+    def _property_groups(self):
+        if self._groups is None:
+            if self._needs_content():
+                self._set_content(self.content.get())
+            if isinstance(self._payload, basestring):
+                self._groups = _payload_property_pbs(self._payload)
+            else:
+                # properties of 'expando' records named like the header are escaped, see Audit._populate_payload
+                groups = {}
+                for is_raw, p in self._payload or []:
+                    groups.setdefault(_unescape_payload_name(p.name().split('.', 1)[0]), []).append((is_raw, p))
+                self._groups = groups
+            self._payload = None
+        return self._groups
+
+    def __getattr__(self, name):
+        # only called for names that are not slots, so these are the audited entity's properties.  Those named like
+        # the header can only be read with to_dict
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return self._property_value(name)
+
+    def _property_value(self, name):
+        values = self._values
+        if name not in values:
+            pbs = self._property_groups().get(name)
+            if pbs is None:
+                raise AttributeError(name)
+            decoded = _decode_payload_properties(pbs)
+            values[name] = decoded[name] if name in decoded else decoded.get(_escape_payload_name(name))
+        return values[name]
+
+    def __repr__(self):
+        return 'RevisionRecord(key=%r, rev_hash=%r, parent_hash=%r, account=%r, timestamp=%r)' % (
+            self.key, self.rev_hash, self.parent_hash, self.account, self.timestamp)
+
+
+class _RecordAdapter(ndb.model.ModelAdapter):
+
+    def __init__(self, with_payload):
+        super(_RecordAdapter, self).__init__()
+        self.with_payload = with_payload
+
+    def pb_to_entity(self, pb):
+        return RevisionRecord._from_pb(pb, self.with_payload)
+
+
+@ndb.tasklet
+def fetch_records_page_async(query, page_size, cursor=None, with_payload=True):
+    """ one page of the results of an Audit query (e.g. Audit.query_history) as RevisionRecords, pass the returned
+    cursor back in to get the next one
+
+    :returns NDB Future for a (list of RevisionRecords, cursor, more) tuple like Query.fetch_page_async
+    """
+    ctx = ndb.get_context()
+    conn = datastore_rpc.Connection(adapter=_RecordAdapter(with_payload), config=ctx._conn.config)
+    # one more than the page to find out if there are more
+    options = datastore_query.QueryOptions(limit=page_size + 1, batch_size=page_size + 1, start_cursor=cursor,
+                                           produce_cursors=True)
+    records = []
+    more = False
+    rpc = query._get_query(ctx._conn).run_async(conn, options)
+    while rpc is not None:
+        batch = yield rpc
+        for i, r in enumerate(batch.results):
+            if len(records) == page_size:
+                more = True
+                break
+            records.append(r)
+            cursor = batch.cursor(i + 1)
+        rpc = batch.next_batch_async(options) if not more else None
+    raise ndb.Return((records, cursor, more))
+
+
+def iter_records(query, page_size=500, cursor=None, with_payload=True):
+    """ generator over the results of an Audit query as RevisionRecords in pages of at most page_size.
+    yields (list of RevisionRecords, cursor) tuples, the cursor resumes the iteration after that page.  The next page
+    is fetched while the caller works on the current one
+    """
+    future = fetch_records_page_async(query, page_size, cursor, with_payload)
+    while future:
+        records, cursor, more = future.get_result()
+        future = None
+        if more:
+            future = fetch_records_page_async(query, page_size, cursor, with_payload)
+        if records:
+            yield records, cursor
+
+
+def iter_history_records(entity_or_key, page_size=500, cursor=None, newest_first=True, with_payload=True):
+    """ iter_records over the audited entity's history, see Audit.iter_history """
+    return iter_records(Audit.query_history(entity_or_key, newest_first), page_size, cursor, with_payload)
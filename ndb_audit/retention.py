@@ -0,0 +1,200 @@
+"""
+Retention of audit history: old revisions are squashed into a single full checkpoint record and the rest deleted,
+and the deduplicated content no audit record refers to any more is deleted in turn
+"""
+
+import datetime
+import logging
+
+from google.appengine.ext import ndb
+
+from ndb_audit import Audit, AuditContent, AuditHead, AuditValueChange, Tag, _encode_payload, _hash_str
+
+
+class RetentionPolicy(object):
+    """ which revisions of an entity to keep.  A revision is kept if it is one of the keep_last newest, or was written
+    at or after keep_after (a datetime), or (with keep_tagged) a Tag points to it.  With neither keep_last nor
+    keep_after set everything is kept """
+
+    def __init__(self, keep_last=None, keep_after=None, keep_tagged=True):
+        self.keep_last = keep_last
+        self.keep_after = keep_after
+        self.keep_tagged = keep_tagged
+
+
+class PruneResult(object):
+    """ the outcome of prune_history_async.  Pass cursor back with the same policy to carry on while more is True """
+
+    def __init__(self, squash_rev_hash, deleted, cursor, more):
+        self.squash_rev_hash = squash_rev_hash
+        self.deleted = deleted
+        self.cursor = cursor
+        self.more = more
+
+
+@ndb.tasklet
+def prune_history_async(entity_or_key, policy, batch_size=100, max_in_flight=5, max_batches=None, cursor=None):
+    """ applies the retention policy to the audit history of the entity.  The newest revision that is not kept
+    becomes the squash checkpoint: it is rewritten as a full record marked squashed, so the parent_hash chain of the
+    kept revisions still ends at a stored record.  If the oldest kept revision is a 'delta' its checkpoint is used
+    instead, so every kept delta can still be rebuilt.  The AuditHead of 'delta' storage is moved on to start at the
+    squash checkpoint, so later deltas never chain to deleted records.  Everything older is deleted in keys only
+    batches of batch_size, max_in_flight of them at a time, except tagged revisions which are rewritten as full records.
+    At most max_batches batches are deleted per call, the returned cursor resumes from there.
+    Records written before Audit.timestamp was indexed are not seen, see Audit.reindex_history_async
+
+    :returns NDB Future for a PruneResult
+    """
+    if not isinstance(entity_or_key, ndb.Key):
+        entity_or_key = entity_or_key.key
+    squash = yield _squash_checkpoint_async(entity_or_key, policy)
+    if squash is None:
+        raise ndb.Return(PruneResult(None, 0, None, False))
+    if not squash.squashed:
+        yield _rewrite_full_async(squash, squashed=True)
+    yield _trim_head_async(entity_or_key, squash)
+
+    tagged = set()
+    if policy.keep_tagged:
+        tags = yield Tag.query_by_entity_key(entity_or_key).fetch_async()
+        tagged = set([t.rev_hash for t in tags])
+
+    model = ndb.Model._kind_map.get(entity_or_key.kind())
+    tracked = getattr(model, '_audit_tracked_properties', ())
+    q = Audit.query_history(entity_or_key).filter(Audit.timestamp < squash.timestamp)
+    deleted = 0
+    batches = 0
+    in_flight = []
+    more = True
+    while more and (max_batches is None or batches < max_batches):
+        keys, cursor, more = yield q.fetch_page_async(batch_size, start_cursor=cursor, keys_only=True)
+        to_delete = []
+        for k in keys:
+            if _hash_str(k.string_id()) in tagged:
+                # newest first, so this is rebuilt before the delta chain it may need is deleted
+                a = yield k.get_async()
+                if a.delta:
+                    yield _rewrite_full_async(a)
+            else:
+                to_delete.append(k)
+        deleted += len(to_delete)
+        # along with their entries in the index of tracked property changes
+        to_delete += [AuditValueChange.build_key(k, name) for k in to_delete for name in tracked]
+        if len(in_flight) >= max_in_flight:
+            yield in_flight.pop(0)
+        in_flight.append(ndb.delete_multi_async(to_delete))
+        batches += 1
+    yield in_flight
+    logging.info('ndb_audit pruned %d audit records of %s' % (deleted, entity_or_key))
+    raise ndb.Return(PruneResult(squash.rev_hash, deleted, cursor if more else None, more))
+
+
+@ndb.tasklet
+def prune_content_async(older_than=datetime.timedelta(days=30), batch_size=100, cursor=None):
+    """ deletes the AuditContent (see AuditMixin._audit_payload_dedup) no longer referenced by any audit record, e.g.
+    once prune_history_async has deleted them.  Only content not used by a put for older_than is considered, which
+    must be well over AuditContent.REFRESH_AFTER: every audit record written since then refreshed last_used, so the
+    (eventually consistent) reference check only has to find records written longer ago than that.  Each content is
+    deleted in a transaction that checks last_used again, so a put reusing it meanwhile keeps it.  Checks one batch of
+    batch_size, pass the returned cursor back in to carry on while more is True
+
+    :returns NDB Future for a (number deleted, cursor, more) tuple
+    """
+    if older_than <= AuditContent.REFRESH_AFTER:
+        raise ValueError('older_than must be longer than AuditContent.REFRESH_AFTER (%s)' % AuditContent.REFRESH_AFTER)
+    cutoff = datetime.datetime.utcnow() - older_than
+    keys, cursor, more = yield AuditContent.query(AuditContent.last_used < cutoff).fetch_page_async(
+        batch_size, start_cursor=cursor, keys_only=True)
+    deleted = yield [_delete_unused_content_async(k, cutoff) for k in keys]
+    deleted = sum(deleted)
+    logging.info('ndb_audit pruned %d unused audit contents' % deleted)
+    raise ndb.Return((deleted, cursor if more else None, more))
+
+
+@ndb.tasklet
+def _delete_unused_content_async(content_key, cutoff):
+    """ :returns NDB Future for 1 if the content was deleted, 0 if it is still in use """
+    referenced = yield Audit.query(Audit.content == content_key).get_async(keys_only=True)
+    if referenced is not None:
+        raise ndb.Return(0)
+
+    @ndb.tasklet
+    def txn():
+        content = yield content_key.get_async()
+        if content is None or content.last_used >= cutoff:
+            raise ndb.Return(0) # gone already, or reused since it was queried
+        yield content_key.delete_async()
+        raise ndb.Return(1)
+    deleted = yield ndb.transaction_async(txn, propagation=ndb.TransactionOptions.INDEPENDENT)
+    raise ndb.Return(deleted)
+
+
+@ndb.tasklet
+def _squash_checkpoint_async(entity_key, policy):
+    """ the audit record to squash the history before it into, or None when nothing ages out """
+    if policy.keep_last is None and policy.keep_after is None:
+        raise ndb.Return(None)
+    keep_last = policy.keep_last or 0
+    q = Audit.query_history(entity_key)
+    kept_after = None
+    if policy.keep_after is not None:
+        if keep_last:
+            recent = yield q.filter(Audit.timestamp >= policy.keep_after).count_async(limit=keep_last)
+            keep_last -= recent
+        if not keep_last:
+            # the revisions kept for their timestamp are all that is kept
+            kept_after = Audit.query_history(entity_key, newest_first=False).filter(
+                Audit.timestamp >= policy.keep_after).get_async()
+        q = q.filter(Audit.timestamp < policy.keep_after)
+    # the oldest kept revision along with the newest one that ages out
+    if keep_last:
+        newest = yield q.fetch_async(2, offset=keep_last - 1)
+        kept, squash = (newest + [None, None])[:2]
+    else:
+        squash = yield q.get_async()
+        kept = (yield kept_after) if kept_after else None
+    if squash is not None and kept is not None and kept.delta:
+        squash = yield ndb.Key(parent=kept.key.parent(), pairs=[('Audit', kept.delta['chain'][0])]).get_async()
+    raise ndb.Return(squash)
+
+
+@ndb.tasklet
+def _trim_head_async(entity_key, squash):
+    """ drops the records older than the squash checkpoint, which is now a full record, from the head's chain """
+    squash_id = squash.key.string_id()
+
+    @ndb.tasklet
+    def txn():
+        head = yield AuditHead._build_head_key(entity_key).get_async()
+        if head is None or squash_id not in head.chain[1:]:
+            return
+        head.chain = head.chain[head.chain.index(squash_id):]
+        if len(head.chain) == 1:
+            head.delta_bytes = 0
+        yield head.put_async()
+    yield ndb.transaction_async(txn, propagation=ndb.TransactionOptions.INDEPENDENT)
+
+
+@ndb.tasklet
+def _rewrite_full_async(audit, squashed=None):
+    """ stores the full properties in the record itself so it no longer needs its delta chain """
+    props = yield audit.entity_dict_async()
+    if audit.delta:
+        audit.delta = None
+        if audit.payload is not None:
+            audit.payload = _encode_payload(dict([(k, _model_value(v)) for k, v in props.iteritems()]))
+        else:
+            audit._populate_payload(dict([(k, _model_value(v)) for k, v in props.iteritems()]))
+    audit.squashed = squashed
+    yield audit.put_async()
+
+
+def _model_value(value):
+    """ structured values can read back as dicts, Expando only stores them as models """
+    if isinstance(value, dict):
+        e = ndb.Expando()
+        e.populate(**dict([(k, _model_value(v)) for k, v in value.iteritems()]))
+        return e
+    if isinstance(value, list):
+        return [_model_value(v) for v in value]
+    return value
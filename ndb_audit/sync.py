@@ -0,0 +1,64 @@
+"""
+Finds which audited entities have moved past the revision a Tag label points to, for incremental replication
+"""
+
+from google.appengine.ext import ndb
+
+from ndb_audit import Tag, _latest_rev_hashes_async
+
+
+@ndb.tasklet
+def changed_since_tag_async(entities, label, batch_size=500):
+    """ which of the entities are no longer at the revision tagged with label, including those never tagged.
+    entities is a list of keys, an ndb.Query or an AuditMixin model class (all of its entities).  Tags are read with
+    batched gets.  A query whose model redefines rev_hash as indexed is run as a projection on it, otherwise the
+    current revision of each entity is read as current_rev_hashes_async does.  Entities without any audit history are
+    never returned
+
+    :returns NDB Future for a list of the keys of the changed entities, in the order they were given or queried
+    (projections are ordered by rev_hash)
+    """
+    if isinstance(entities, type):
+        entities = entities.query()
+    changed = []
+    if isinstance(entities, ndb.Query):
+        model = ndb.Model._kind_map.get(entities.kind)
+        projected = model is not None and model.rev_hash._indexed
+        cursor = None
+        more = True
+        while more:
+            if projected:
+                page, cursor, more = yield entities.fetch_page_async(batch_size, start_cursor=cursor,
+                                                                     projection=[model.rev_hash])
+                rev_hashes = [e.rev_hash for e in page]
+                keys = [e.key for e in page]
+            else:
+                keys, cursor, more = yield entities.fetch_page_async(batch_size, start_cursor=cursor,
+                                                                     keys_only=True)
+                rev_hashes = yield current_rev_hashes_async(keys)
+            changed.extend((yield _changed_async(keys, rev_hashes, label)))
+    else:
+        for i in xrange(0, len(entities), batch_size):
+            keys = entities[i:i + batch_size]
+            rev_hashes = yield current_rev_hashes_async(keys)
+            changed.extend((yield _changed_async(keys, rev_hashes, label)))
+    raise ndb.Return(changed)
+
+
+@ndb.tasklet
+def current_rev_hashes_async(entity_keys):
+    """ the rev_hash of the latest revision of each entity (None when it has none), from its AuditHead where the model
+    keeps one, otherwise from its newest audit record, or the entity itself when its history is not in the timestamp
+    index (see ndb_audit._latest_revisions_async).  The reads run concurrently
+
+    :returns NDB Future for a list of rev_hashes in the same order as entity_keys
+    """
+    rev_hashes = yield _latest_rev_hashes_async(entity_keys)
+    raise ndb.Return(rev_hashes)
+
+
+@ndb.tasklet
+def _changed_async(keys, rev_hashes, label):
+    tags = yield ndb.get_multi_async([Tag._build_tag_key(k, label) for k in keys])
+    raise ndb.Return([k for k, r, t in zip(keys, rev_hashes, tags)
+                      if r is not None and (t is None or t.rev_hash != r)])
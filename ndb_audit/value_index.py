@@ -0,0 +1,63 @@
+"""
+Queries over the index of changes to the tracked properties of audited models (see
+AuditMixin._audit_tracked_properties), answering questions like "which revisions set status to closed, and who did
+it" without reading any history.  Each AuditValueChange found names the audit record of the revision, the entity,
+the account and the timestamp of the change.
+
+These are global queries, so they are eventually consistent, and need the index.yaml entry listed in the
+AuditValueChange docstring.  Changes written before the property was tracked are not indexed
+"""
+
+from google.appengine.ext import ndb
+
+from ndb_audit import Audit, AuditValueChange
+
+
+def query_value_changes(kind, name, value, since=None, until=None, newest_first=True):
+    """ the changes that set the property name of entities of kind to value, optionally only those at or after since
+    and before until
+    returns a query object
+    """
+    q = AuditValueChange.query(AuditValueChange.kind == kind, AuditValueChange.name == name,
+                               AuditValueChange.value == value)
+    if since is not None:
+        q = q.filter(AuditValueChange.timestamp >= since)
+    if until is not None:
+        q = q.filter(AuditValueChange.timestamp < until)
+    return q.order(-AuditValueChange.timestamp if newest_first else AuditValueChange.timestamp)
+
+
+def fetch_value_changes_async(kind, name, value, page_size=100, cursor=None, since=None, until=None,
+                              newest_first=True):
+    """ one page of query_value_changes, pass the returned cursor back in to get the next one
+
+    :returns NDB Future for a (list of AuditValueChange, cursor, more) tuple like Query.fetch_page_async
+    """
+    return query_value_changes(kind, name, value, since, until, newest_first).fetch_page_async(page_size,
+                                                                                              start_cursor=cursor)
+
+
+def iter_value_changes(kind, name, value, page_size=100, cursor=None, since=None, until=None, newest_first=True):
+    """ generator over query_value_changes in pages of at most page_size.  yields (list of AuditValueChange, cursor)
+    tuples, the cursor resumes the iteration after that page.  The next page is fetched while the caller works on the
+    current one
+    """
+    future = fetch_value_changes_async(kind, name, value, page_size, cursor, since, until, newest_first)
+    while future:
+        changes, cursor, more = future.get_result()
+        future = None
+        if more:
+            future = fetch_value_changes_async(kind, name, value, page_size, cursor, since, until, newest_first)
+        if changes:
+            yield changes, cursor
+
+
+@ndb.tasklet
+def get_audits_async(changes):
+    """ the audit records of the revisions of changes, None for those pruned since
+
+    :returns NDB Future for a list of Audit entities in the same order as changes
+    """
+    audits = yield ndb.get_multi_async([c.audit for c in changes])
+    yield Audit.load_content_multi_async(audits)
+    raise ndb.Return(audits)
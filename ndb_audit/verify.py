@@ -0,0 +1,244 @@
+"""
+Verifies the integrity of audit history.  The audit records of each entity are rebuilt into their revision DAG from
+the parent_hash of each record and checked for:
+- 'rev_hash': the parent_hash, account or data_hash stored in the record differ from those its key id (which the
+  rev_hash is the hash of, see Audit.build_audit_record_key) was built from
+- 'data_hash': the data_hash recomputed from the stored properties, by the rules of any data_hash version, differs
+  from the one stored, or the properties could not be rebuilt
+- 'break': the parent revision is not stored.  Not reported for records older than a squashed record, whose history
+  was pruned (see ndb_audit.retention)
+- 'fork': more than one revision has the same parent
+- 'orphan': a revision that starts a new chain although older revisions are stored, as a blind put does
+
+Records are streamed in key order from concurrent queries, each over a range of keys, so the records of an entity are
+read together.  v1 data_hashes depend on the str() of each value, so values that do not read back the same as they
+were put (e.g. lists of byte strings, which read back as unicode) are also tried as byte strings
+"""
+
+import logging
+
+from google.appengine.ext import ndb
+
+from ndb_audit import Audit, AuditMixin, _audit_root_key, _entity_dict, _v1_data_hash
+from ndb_audit.history import _restore_properties
+from ndb_audit.records import RevisionRecord, fetch_records_page_async
+
+_DATA_HASH_VERSIONS = ('v1', 'v2', 'v3')
+_SPLIT_OVERSAMPLING = 32
+
+
+class ChainIssue(object):
+    """ a problem found in the audit history of an entity, see the module docstring for the kinds of problems """
+
+    def __init__(self, entity_key, rev_hash, problem, detail=None):
+        self.entity_key = entity_key
+        self.rev_hash = rev_hash
+        self.problem = problem
+        self.detail = detail
+
+    def __repr__(self):
+        return 'ChainIssue(entity_key=%r, rev_hash=%r, problem=%r, detail=%r)' % (
+            self.entity_key, self.rev_hash, self.problem, self.detail)
+
+
+class VerifyReport(object):
+    """ the outcome of verify_async: how many audit records and entities were checked, how many records' data_hash
+    could not be checked because their model is not imported, and the issues found """
+
+    def __init__(self):
+        self.audits = 0
+        self.entities = 0
+        self.unchecked = 0
+        self.issues = []
+
+    @property
+    def ok(self):
+        return not self.issues
+
+    def __repr__(self):
+        return 'VerifyReport(audits=%d, entities=%d, unchecked=%d, issues=%d)' % (
+            self.audits, self.entities, self.unchecked, len(self.issues))
+
+
+@ndb.tasklet
+def verify_async(kind=None, start=None, end=None, shards=8, page_size=500, check_data_hash=True):
+    """ verifies the audit records of the audited entities of kind (any kind when None), optionally only those whose
+    parent key (the audited entity, or its AuditLog root for _audit_log = 'log') is at or after start and before end.
+    The key range is split in up to shards ranges read by concurrent queries, in pages of page_size records, the next
+    one fetched while the current one is checked.  With check_data_hash=False only the headers are read and checked.
+    These are global queries, so records written very recently may be missed
+
+    :returns NDB Future for a VerifyReport
+    """
+    report = VerifyReport()
+    bounds = yield _split_points_async(shards, start, end)
+    ranges = zip([start] + bounds, bounds + [end])
+    yield [_verify_query_async(_range_query(kind, lo, hi), page_size, check_data_hash, report) for lo, hi in ranges]
+    logging.info('ndb_audit verified %d audit records of %d entities of %s, %d issues' % (
+        report.audits, report.entities, kind or 'all kinds', len(report.issues)))
+    raise ndb.Return(report)
+
+
+@ndb.tasklet
+def verify_entity_async(entity_or_key, page_size=500, check_data_hash=True):
+    """ verify_async of the audit history of a single entity, read with a strongly consistent ancestor query
+
+    :returns NDB Future for a VerifyReport
+    """
+    if not isinstance(entity_or_key, ndb.Key):
+        entity_or_key = entity_or_key.key
+    report = VerifyReport()
+    q = Audit.query(ancestor=_audit_root_key(entity_or_key)).order(Audit.key)
+    yield _verify_query_async(q, page_size, check_data_hash, report)
+    raise ndb.Return(report)
+
+
+@ndb.tasklet
+def _split_points_async(shards, start, end):
+    """ up to shards - 1 keys splitting the audit records between start and end in ranges of about the same size,
+    sampled from the __scatter__ property like mapreduce does.  Each is the parent of an audit record, so the records
+    of an entity all fall in the same range """
+    if shards <= 1:
+        raise ndb.Return([])
+    sample = yield Audit.query().order(ndb.GenericProperty('__scatter__')).fetch_async(
+        shards * _SPLIT_OVERSAMPLING, keys_only=True)
+    parents = sorted(set([k.parent() for k in sample]))
+    parents = [k for k in parents if (start is None or k > start) and (end is None or k < end)]
+    if len(parents) < shards:
+        bounds = parents[1:]
+    else:
+        step = len(parents) / float(shards)
+        bounds = sorted(set([parents[int(i * step)] for i in xrange(1, shards)]))
+    raise ndb.Return(bounds)
+
+
+def _range_query(kind, start, end):
+    q = Audit.query()
+    if kind is not None:
+        q = q.filter(Audit.kind == kind)
+    if start is not None:
+        q = q.filter(Audit.key >= start)
+    if end is not None:
+        q = q.filter(Audit.key < end)
+    return q.order(Audit.key)
+
+
+@ndb.tasklet
+def _verify_query_async(q, page_size, check_data_hash, report):
+    """ checks the audit records returned by q, which must be in key order so that those of an entity are together """
+    group = []
+    future = fetch_records_page_async(q, page_size, None, check_data_hash)
+    while future:
+        records, cursor, more = yield future
+        future = fetch_records_page_async(q, page_size, cursor, check_data_hash) if more else None
+        if check_data_hash:
+            yield RevisionRecord.load_content_multi_async(records)
+        for r in records:
+            if group and r.key.parent() != group[0].key.parent():
+                _check_entity(group, check_data_hash, report)
+                group = []
+            group.append(r)
+    if group:
+        _check_entity(group, check_data_hash, report)
+
+
+def _check_entity(records, check_data_hash, report):
+    """ checks the audit records of one entity """
+    entity_key = records[0].entity_key or records[0].key.parent()
+    report.entities += 1
+    report.audits += len(records)
+
+    def issue(r, problem, detail=None):
+        report.issues.append(ChainIssue(entity_key, r.rev_hash, problem, detail))
+
+    by_rev = dict([(r.rev_hash, r) for r in records])
+    squashed = [r.timestamp for r in records if r.squashed]
+    pruned_before = max(squashed) if squashed else None
+    children = {}
+    roots = []
+    for r in records:
+        header = _parse_record_id(r.key.string_id())
+        if header != (r.parent_hash, r.account, r.data_hash):
+            issue(r, 'rev_hash', 'key id %r does not match the stored header' % r.key.string_id())
+        if r.parent_hash is None:
+            roots.append(r)
+        elif r.parent_hash in by_rev:
+            children.setdefault(r.parent_hash, []).append(r)
+        elif pruned_before is None or r.timestamp > pruned_before:
+            issue(r, 'break', 'parent revision %s is missing' % r.parent_hash)
+    for parent_hash, revs in children.iteritems():
+        if len(revs) > 1:
+            issue(by_rev[parent_hash], 'fork', 'revisions %s have this parent' % ', '.join(
+                sorted([r.rev_hash for r in revs])))
+    first = min([r.timestamp for r in records])
+    for r in roots:
+        if r.timestamp > first:
+            issue(r, 'orphan', 'starts a new chain')
+
+    if check_data_hash:
+        model = ndb.Model._kind_map.get(records[0].kind)
+        if model is None or not issubclass(model, AuditMixin):
+            report.unchecked += len(records)
+            return
+        by_id = dict([(r.key.string_id(), r) for r in records])
+        for r in records:
+            try:
+                props = _record_props(r, by_id)
+            except Exception, e:
+                issue(r, 'data_hash', 'properties cannot be rebuilt: %s' % e)
+                continue
+            if not _data_hash_matches(model, entity_key, props, r.data_hash):
+                issue(r, 'data_hash', 'does not match the stored properties')
+
+
+def _parse_record_id(record_id):
+    """ (parent_hash, account, data_hash) the audit record key id was built from, see Audit.build_audit_record_key """
+    if not record_id or not record_id.startswith('{v1}'):
+        return None
+    parts = record_id[len('{v1}'):].split('|', 1)
+    if len(parts) < 2 or '|' not in parts[1]:
+        return None
+    parent_hash = parts[0] if parts[0] != 'None' else None
+    account, data_hash = parts[1].rsplit('|', 1)
+    return parent_hash, account, data_hash
+
+
+def _record_props(record, by_id):
+    """ the audited entity's properties as of the record, 'delta' records are rebuilt from the records of their chain
+    like Audit.entity_dict_async does """
+    if not record.delta:
+        return record.to_dict()
+    props = {}
+    for audit_id in record.delta['chain'] + [record.key.string_id()]:
+        a = by_id.get(audit_id)
+        if a is None:
+            raise ValueError('audit record %s is missing' % audit_id)
+        props.update(a.to_dict())
+        for k in (a.delta or {}).get('removed', []):
+            props.pop(k, None)
+    return props
+
+
+def _data_hash_matches(model, entity_key, props, data_hash):
+    """ whether any data_hash version, the model's own first, hashes the properties to data_hash """
+    versions = [model._data_hash_version] + [v for v in _DATA_HASH_VERSIONS if v != model._data_hash_version]
+    for version in versions:
+        # a new entity each time, 'v2' and 'v3' cache per property digests on it
+        entity = model(key=entity_key)
+        _restore_properties(entity, props)
+        if entity._compute_data_hash(version=version) == data_hash:
+            return True
+        if version == 'v1' and _v1_data_hash(_byte_strings(_entity_dict(entity))) == data_hash:
+            return True
+    return False
+
+
+def _byte_strings(value):
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    if isinstance(value, list):
+        return [_byte_strings(v) for v in value]
+    if isinstance(value, dict):
+        return dict([(k, _byte_strings(v)) for k, v in value.iteritems()])
+    return value
+
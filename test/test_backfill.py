@@ -0,0 +1,50 @@
+from google.appengine.api import datastore
+from google.appengine.ext import ndb
+
+from ndb_audit import Audit, AuditMixin, _hash_str
+from ndb_audit.backfill import backfill_async
+from test import NDBUnitTest
+
+
+class FooBackfillModel(AuditMixin, ndb.Model):
+    foo = ndb.StringProperty()
+
+    def _account(self):
+        return 'foo-account'
+
+
+class BackfillTest(NDBUnitTest):
+
+    def test_backfill(self):
+        self.policy.SetProbability(1) # backfills run global queries
+        # entities written before the model was audited
+        raw = []
+        for i in xrange(25):
+            e = datastore.Entity('FooBackfillModel', name='foo%02d' % i)
+            e['foo'] = 'a%d' % i
+            raw.append(e)
+        datastore.Put(raw)
+
+        progress = []
+        state = backfill_async(FooBackfillModel.query(), batch_size=10, max_in_flight=2, max_batches=2,
+                               account='backfill', progress=lambda p: progress.append((p.scanned, p.audited))
+                               ).get_result()
+        self.assertEqual(progress, [(10, 10), (20, 20)])
+        self.assertEqual((state.scanned, state.more), (20, True))
+        state = backfill_async(FooBackfillModel.query(), batch_size=10, cursor=state.cursor, account='backfill'
+                               ).get_result()
+        self.assertEqual((state.scanned, state.audited, state.more), (5, 5, False))
+
+        ndb.get_context().clear_cache()
+        for i in xrange(25):
+            ent = FooBackfillModel.get_by_id('foo%02d' % i)
+            data_hash = _hash_str('{v1}foo=a%d' % i)
+            self.assertEqual(ent.data_hash, data_hash)
+            self.assertEqual(ent.rev_hash, _hash_str('{v1}None|backfill|%s' % data_hash))
+            a = Audit.get_by_rev_hash_async(ent.key, ent.rev_hash).get_result()
+            self.assertEqual((a.foo, a.account, a.parent_hash), ('a%d' % i, 'backfill', None))
+
+        # everything is current now, so nothing is written again
+        state = backfill_async(FooBackfillModel.query(), batch_size=10).get_result()
+        self.assertEqual((state.scanned, state.audited), (25, 0))
+        self.assertEqual(Audit.query().count(), 25)
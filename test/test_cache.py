@@ -0,0 +1,119 @@
+import mock
+from google.appengine.api import datastore
+from google.appengine.ext import ndb
+
+from ndb_audit import Audit, AuditMixin
+from ndb_audit.cache import EntityCache, _properties_pb, validate_multi
+from ndb_audit.verify import verify_entity_async
+from test import NDBUnitTest
+
+
+class FooCacheModel(AuditMixin, ndb.Model):
+    foo = ndb.StringProperty()
+    bar = ndb.IntegerProperty(repeated=True)
+
+    def _account(self):
+        return 'foo-account'
+
+
+class CacheTest(NDBUnitTest):
+
+    def _put_ents(self, n):
+        ents = [FooCacheModel(id='foo%d' % i, foo='a%d' % i, bar=[i]) for i in xrange(n)]
+        for e in ents:
+            self._trans_put(e)
+        return ents
+
+    def test_read_through(self):
+        ents = self._put_ents(3)
+        keys = [e.key for e in ents]
+        hashes = [e.data_hash for e in ents]
+        cache = EntityCache()
+        got = cache.get_multi_async(keys, hashes).get_result()
+        self.assertEqual([e.foo for e in got], ['a0', 'a1', 'a2'])
+
+        # served from the local LRU, then from memcache by a second instance, without datastore reads
+        with mock.patch('google.appengine.ext.ndb.get_multi_async', side_effect=AssertionError('datastore read')):
+            got = cache.get_multi_async(keys, hashes).get_result()
+            self.assertEqual([(e.key, e.foo, e.bar, e.data_hash, e.rev_hash) for e in got],
+                             [(e.key, e.foo, e.bar, e.data_hash, e.rev_hash) for e in ents])
+            got = EntityCache().get_cached_multi_async(keys, hashes).get_result()
+            self.assertEqual([e.foo for e in got], ['a0', 'a1', 'a2'])
+
+        # an out of date data_hash falls through to the current entity, which is not cached under the old hash
+        ents[0].foo = 'b'
+        self._trans_put(ents[0])
+        self.assertEqual(cache.get_multi_async(keys[:1], ['nope']).get_result()[0].foo, 'b')
+        self.assertEqual(cache.get_cached_multi_async(keys[:1], ['nope']).get_result(), [None])
+
+    def test_rev_hash_not_shared(self):
+        # entities with the same properties share an entry, but not their revision
+        ents = [FooCacheModel(id='foo%d' % i, foo='a') for i in xrange(2)]
+        for e in ents:
+            self._trans_put(e)
+        self.assertEqual(ents[0].data_hash, ents[1].data_hash)
+        cache = EntityCache()
+        cache.put(ents[0])
+        keys = [e.key for e in ents]
+        hashes = [e.data_hash for e in ents]
+        got = cache.get_multi_async(keys, hashes).get_result()
+        self.assertEqual([e.rev_hash for e in got], [e.rev_hash for e in ents])
+        got = cache.get_cached_multi_async(keys, hashes, ['r0', 'r1']).get_result()
+        self.assertEqual([(e.data_hash, e.rev_hash) for e in got], [(hashes[0], 'r0'), (hashes[1], 'r1')])
+
+        # back at an earlier data_hash, the entity gets the rev_hash of its newest revision
+        first_rev = ents[0].rev_hash
+        ents[0].foo = 'b'
+        self._trans_put(ents[0])
+        ents[0].foo = 'a'
+        self._trans_put(ents[0])
+        self.assertNotEqual(ents[0].rev_hash, first_rev)
+        got = cache.get_multi_async(keys[:1], hashes[:1]).get_result()
+        self.assertEqual(got[0].rev_hash, ents[0].rev_hash)
+        got[0].foo = 'c'
+        self._trans_put(got[0])
+        self.assertTrue(verify_entity_async(ents[0]).get_result().ok)
+
+    def test_lru_eviction(self):
+        ents = self._put_ents(3)
+        size = len(_properties_pb(ents[0]).Encode())
+        cache = EntityCache(max_bytes=size * 2 + 1, use_memcache=False)
+        for e in ents[:2]:
+            cache.put(e)
+        keys = [e.key for e in ents]
+        hashes = [e.data_hash for e in ents]
+        cache.get_cached_multi_async(keys[:1], hashes[:1]).get_result() # ents[0] is now most recently used
+        cache.put(ents[2])
+        got = cache.get_cached_multi_async(keys, hashes).get_result()
+        self.assertEqual([e is not None for e in got], [True, False, True])
+
+    def test_validate_multi(self):
+        ents = self._put_ents(3)
+        known = [e.data_hash for e in ents]
+        ents[1].foo = 'b'
+        self._trans_put(ents[1])
+        keys = [e.key for e in ents] + [ndb.Key(FooCacheModel, 'nope')]
+        self.assertEqual(validate_multi(keys, known + ['x']), [False, True, False, True])
+
+    def test_unindexed_history(self):
+        ents = self._put_ents(2)
+        cache = EntityCache()
+        for e in ents:
+            cache.put(e)
+        stale = [e.data_hash for e in ents]
+        ents[1].foo = 'b'
+        self._trans_put(ents[1])
+        # as written before Audit.timestamp was indexed
+        for e in ents:
+            records = datastore.Get([a.key.to_old_key() for a in Audit.query_by_entity_key(e.key)])
+            for r in records:
+                r.set_unindexed_properties(['ts'])
+            datastore.Put(records)
+        keys = [e.key for e in ents]
+        self.assertEqual(Audit.latest_revision_keys_multi_async(keys).get_result(), [None, None])
+
+        # the stale copy is not served, nor validated
+        self.assertEqual(validate_multi(keys, stale), [False, True])
+        got = cache.get_multi_async(keys, stale).get_result()
+        self.assertEqual([(e.foo, e.data_hash, e.rev_hash) for e in got],
+                         [(e.foo, e.data_hash, e.rev_hash) for e in ents])
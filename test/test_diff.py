@@ -0,0 +1,76 @@
+import mock
+from google.appengine.ext import ndb
+
+import ndb_audit.diff
+from ndb_audit import AuditMixin
+from ndb_audit.diff import Change, diff_async, diff_multi_async
+from test import NDBUnitTest
+
+
+class Bar(ndb.Model):
+    x = ndb.IntegerProperty()
+    y = ndb.StringProperty()
+
+
+class FooDiffModel(AuditMixin, ndb.Model):
+    foo = ndb.StringProperty()
+    nums = ndb.IntegerProperty(repeated=True)
+    bars = ndb.StructuredProperty(Bar, repeated=True)
+
+    def _account(self):
+        return 'foo-account'
+
+
+class FooDiffBlobModel(FooDiffModel):
+    _audit_payload_format = 'blob'
+
+
+class FooDiffDeltaModel(FooDiffModel):
+    _audit_storage = 'delta'
+
+
+class DiffTest(NDBUnitTest):
+
+    def _revisions(self, cls, key_name='foo'):
+        ent = cls(id=key_name, foo='a', nums=[1, 2, 3], bars=[Bar(x=1, y='a'), Bar(x=2, y='b')])
+        self._trans_put(ent)
+        rev1 = ent.rev_hash
+        ent.foo = 'b'
+        ent.nums = [1, 3, 4]
+        ent.bars = [Bar(x=1, y='a'), Bar(x=2, y='c')]
+        self._trans_put(ent)
+        return ent, rev1, ent.rev_hash
+
+    def test_diff(self):
+        for cls in (FooDiffModel, FooDiffBlobModel, FooDiffDeltaModel):
+            ent, rev1, rev2 = self._revisions(cls)
+            d = diff_async(ent.key, rev1, rev2).get_result()
+            self.assertEqual(d.changed_properties, ['bars', 'foo', 'nums'])
+            self.assertEqual(d.changes, [Change(('bars', 1, 'y'), 'change', 'b', 'c'),
+                                         Change(('foo',), 'change', 'a', 'b'),
+                                         Change(('nums', 1), 'remove', 2, None),
+                                         Change(('nums', 2), 'add', None, 4)])
+            # same revision, and diffing against nothing
+            self.assertFalse(diff_async(ent.key, rev2, rev2).get_result())
+            d = diff_async(ent.key, None, rev1).get_result()
+            self.assertEqual([(c.path, c.op) for c in d.changes], [(('bars',), 'add'), (('foo',), 'add'),
+                                                                   (('nums',), 'add')])
+            self.assertRaises(ValueError, diff_async(ent.key, 'missing', rev2).get_result)
+
+    def test_diff_blob_decodes_changed_only(self):
+        ent, rev1, rev2 = self._revisions(FooDiffBlobModel)
+        ent.foo = 'c'
+        self._trans_put(ent)
+        with mock.patch('ndb_audit.diff._decode_payload_properties',
+                        side_effect=ndb_audit.diff._decode_payload_properties) as decode:
+            d = diff_async(ent.key, rev2, ent.rev_hash).get_result()
+        self.assertEqual(d.changes, [Change(('foo',), 'change', 'b', 'c')])
+        self.assertEqual(decode.call_count, 2)
+        for args, _ in decode.call_args_list:
+            self.assertEqual(set([p.name() for _, p in args[0]]), set(['foo']))
+
+    def test_diff_multi(self):
+        revs = [self._revisions(FooDiffModel, 'foo%d' % i) for i in xrange(5)]
+        diffs = [f.get_result() for f in diff_multi_async(*zip(*revs))]
+        self.assertEqual([d.entity_key for d in diffs], [r[0] for r in revs])
+        self.assertEqual([d.changed_properties for d in diffs], [['bars', 'foo', 'nums']] * 5)
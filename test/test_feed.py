@@ -0,0 +1,64 @@
+import datetime
+
+from google.appengine.ext import ndb
+
+from ndb_audit import AuditMixin
+from ndb_audit.feed import fetch_changes_async, iter_changes
+from test import NDBUnitTest
+
+
+class FooFeedModel(AuditMixin, ndb.Model):
+    foo = ndb.StringProperty()
+
+    def _account(self):
+        return 'foo-account'
+
+
+class BarFeedModel(FooFeedModel):
+    pass
+
+
+NO_SETTLE = datetime.timedelta(0)
+
+
+class FeedTest(NDBUnitTest):
+
+    def setUp(self):
+        super(FeedTest, self).setUp()
+        self.policy.SetProbability(1) # the feed is read with global queries
+
+    def _put(self, cls, name, foo):
+        ent = cls(id=name, foo=foo)
+        self._trans_put(ent)
+        return ent.rev_hash
+
+    def test_feed(self):
+        revs = []
+        for i in xrange(3):
+            revs.append(self._put(FooFeedModel, 'foo%d' % i, 'a'))
+            revs.append(self._put(BarFeedModel, 'bar%d' % i, 'a'))
+
+        batches = list(iter_changes(batch_size=4, settle=NO_SETTLE))
+        self.assertEqual([[a.rev_hash for a in audits] for audits, cursor in batches], [revs[:4], revs[4:]])
+        foo_changes = [a for audits, cursor in iter_changes('FooFeedModel', batch_size=2, settle=NO_SETTLE)
+                       for a in audits]
+        self.assertEqual([a.rev_hash for a in foo_changes], revs[0::2])
+        self.assertEqual([a.key.parent().id() for a in foo_changes], ['foo0', 'foo1', 'foo2'])
+
+        # a consumer that has caught up picks up only what was written since from its cursor
+        audits, cursor, more = fetch_changes_async('BarFeedModel', settle=NO_SETTLE).get_result()
+        self.assertEqual(([a.rev_hash for a in audits], more), (revs[1::2], False))
+        self.assertEqual(fetch_changes_async('BarFeedModel', cursor=cursor, settle=NO_SETTLE).get_result()[0], [])
+        new_rev = self._put(BarFeedModel, 'bar0', 'b')
+        audits, cursor, more = fetch_changes_async('BarFeedModel', cursor=cursor, settle=NO_SETTLE).get_result()
+        self.assertEqual([a.rev_hash for a in audits], [new_rev])
+
+        # revisions newer than settle ago or than until are left for later
+        self.assertEqual(fetch_changes_async().get_result()[0], [])
+        start = foo_changes[1].timestamp
+        audits, cursor, more = fetch_changes_async('FooFeedModel', since=start, until=start,
+                                                   settle=NO_SETTLE).get_result()
+        self.assertEqual(([a.rev_hash for a in audits], more), ([revs[2]], False))
+        audits, cursor, more = fetch_changes_async('FooFeedModel', since=start, cursor=cursor,
+                                                   settle=NO_SETTLE).get_result()
+        self.assertEqual([a.rev_hash for a in audits], [revs[4]])
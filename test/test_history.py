@@ -0,0 +1,88 @@
+import datetime
+import marshal
+
+from google.appengine.ext import ndb
+
+from ndb_audit import AuditMixin
+from ndb_audit.history import get_as_of_multi_async, get_at_rev_multi_async
+from test import NDBUnitTest
+
+
+class FooMarshalProperty(ndb.BlobProperty):
+    def _to_base_type(self, value):
+        return marshal.dumps(value)
+
+    def _from_base_type(self, value):
+        return marshal.loads(value)
+
+
+class FooHistoryInside(ndb.Model):
+    foo = ndb.StringProperty()
+    custom = FooMarshalProperty()
+
+
+class FooHistoryModel(AuditMixin, ndb.Model):
+    foo = ndb.StringProperty()
+    bar = ndb.IntegerProperty(repeated=True)
+    custom = FooMarshalProperty()
+    inside = ndb.StructuredProperty(FooHistoryInside, repeated=True)
+    upper = ndb.ComputedProperty(lambda self: self.foo and self.foo.upper())
+
+    def _account(self):
+        return 'foo-account'
+
+
+class FooHistoryDeltaExpando(AuditMixin, ndb.Expando):
+    _audit_storage = 'delta'
+    _audit_checkpoint_revisions = 2
+
+    def _account(self):
+        return 'foo-account'
+
+
+class HistoryTest(NDBUnitTest):
+
+    def _put_round(self, ents, i):
+        """ puts revision i of each entity, returns the time after and the (rev_hash, properties) of each """
+        revs = []
+        for ent in ents:
+            ent.foo = 'v%d' % i
+            ent.bar = range(i + 1)
+            ent.custom = {'i': i}
+            if isinstance(ent, FooHistoryModel):
+                ent.inside = [FooHistoryInside(foo='in%d' % i, custom=[i])]
+            self._trans_put(ent)
+            revs.append((ent.rev_hash, ent._to_dict()))
+        return datetime.datetime.utcnow(), revs
+
+    def test_as_of_and_at_rev(self):
+        ents = [FooHistoryModel(id='foo%d' % i) for i in xrange(3)] + [FooHistoryDeltaExpando(id='delta')]
+        before = datetime.datetime.utcnow()
+        rounds = [self._put_round(ents, i) for i in xrange(4)]
+        keys = [e.key for e in ents] + [ndb.Key(FooHistoryModel, 'missing')]
+
+        for clear in (False, True):
+            if clear:
+                ndb.get_context().clear_cache()
+            for timestamp, revs in rounds:
+                as_of = get_as_of_multi_async(keys, timestamp, max_in_flight=2).get_result()
+                self.assertEqual([e and e._to_dict() for e in as_of], [props for _, props in revs] + [None])
+                self.assertEqual([type(e) for e in as_of], [FooHistoryModel] * 3 + [FooHistoryDeltaExpando] +
+                                 [type(None)])
+
+                at_rev = get_at_rev_multi_async(keys, [rev_hash for rev_hash, _ in revs] + [None]).get_result()
+                self.assertEqual([e and e._to_dict() for e in at_rev], [props for _, props in revs] + [None])
+                self.assertEqual([e and e.key for e in at_rev], [e.key for e in ents] + [None])
+
+        self.assertEqual(get_as_of_multi_async(keys, before).get_result(), [None] * 5)
+        self.assertEqual(get_at_rev_multi_async(keys[:1], ['nosuchrev']).get_result(), [None])
+
+        # an entity read at a revision can be put back to revert to it
+        old = get_at_rev_multi_async(keys[:1], [rounds[1][1][0][0]]).get_result()[0]
+        old.rev_hash = ents[0].rev_hash
+        self._trans_put(old)
+        ndb.get_context().clear_cache()
+        reverted = old.key.get()
+        self.assertEqual((reverted.custom, reverted.inside[0].custom), ({'i': 1}, [1]))
+        self.assertEqual(get_as_of_multi_async(keys[:1], datetime.datetime.utcnow()).get_result()[0].rev_hash,
+                         reverted.rev_hash)
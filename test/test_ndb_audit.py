@@ -1,13 +1,20 @@
 import base64
+import copy
 import datetime
 import hashlib
 import json
 import logging
 import marshal
 
+import mock
+
+from google.appengine.api import datastore, datastore_errors
 from google.appengine.ext import ndb
 
-from ndb_audit import Audit, AuditMixin, Tag, audit_put_multi_async, tag_multi_from_rev_hash_async, _hash_str
+import ndb_audit
+from ndb_audit import Audit, AuditContent, AuditHead, AuditMetrics, AuditMixin, Tag, audit_put_bulk_async, audit_put_multi_async, delete_tags_multi_async, get_tags_multi_async, put_if_rev_multi_async, set_metrics, tag_multi_async, tag_multi_from_rev_hash_async, _AUDIT_HEADER_PROPS, _canonical_encode, _entity_dict, _hash_str
+from ndb_audit.records import iter_history_records
+from ndb_audit.verify import verify_entity_async
 from test import NDBUnitTest
 
 
@@ -39,6 +46,111 @@ class FooStructuredModel(AuditMixin, ndb.Model):
         return 'foo-structured-account'
 
 
+class FooV2Model(AuditMixin, ndb.Model):
+    _data_hash_version = 'v2'
+
+    foo = ndb.StringProperty()
+    bar = ndb.IntegerProperty(repeated=True)
+    custom_prop = FooProperty()
+
+    def _account(self):
+        return 'foo-v2-account'
+
+
+class FooV3Expando(AuditMixin, ndb.Expando):
+    _data_hash_version = 'v3'
+
+    def _account(self):
+        return 'foo-v3-account'
+
+
+class FooV3Sha256Expando(FooV3Expando):
+    _data_hash_algorithm = 'sha256'
+
+
+class FooRequiredModel(AuditMixin, ndb.Model):
+    foo = ndb.StringProperty(required=True)
+
+    def _account(self):
+        return 'foo-account'
+
+
+class FooDeltaExpando(AuditMixin, ndb.Expando):
+    _audit_storage = 'delta'
+    _audit_checkpoint_revisions = 3
+
+    def _account(self):
+        return 'foo-delta-account'
+
+
+class FooBlobModel(AuditMixin, ndb.Model):
+    _audit_payload_format = 'blob'
+
+    foo = ndb.StringProperty()
+    baz = ndb.StructuredProperty(FooInsideModel, repeated=True)
+    custom_prop = FooProperty()
+
+    def _account(self):
+        return 'foo-blob-account'
+
+
+class FooDeltaBlobExpando(FooDeltaExpando):
+    _audit_payload_format = 'blob'
+
+
+class FooLogModel(AuditMixin, ndb.Model):
+    _audit_log = 'log'
+
+    foo = ndb.StringProperty()
+
+    def _account(self):
+        return 'foo-account'
+
+
+class FooLogDeltaModel(FooLogModel):
+    _audit_storage = 'delta'
+
+
+class FooDedupExpando(AuditMixin, ndb.Expando):
+    _audit_payload_dedup = 'entity'
+
+    def _account(self):
+        return 'foo-account'
+
+
+class FooDedupKindModel(AuditMixin, ndb.Model):
+    _audit_payload_dedup = 'kind'
+
+    foo = ndb.StringProperty()
+
+    def _account(self):
+        return 'foo-account'
+
+
+class RecordingMetrics(AuditMetrics):
+
+    def __init__(self):
+        self.counters = {}
+        self.samples = {}
+        self.spans = []
+
+    def increment(self, name, value=1, kind=None):
+        self.counters[(name, kind)] = self.counters.get((name, kind), 0) + value
+
+    def observe(self, name, value, kind=None):
+        self.samples.setdefault((name, kind), []).append(value)
+
+    def start_span(self, name, key):
+        span = mock.Mock()
+        self.spans.append((name, key, span))
+        return span
+
+
+def _v2_data_hash(**props):
+    leaves = sorted([(k, hashlib.sha1('%s=%s' % (k, str(v))).digest()) for k, v in props.iteritems()])
+    return _hash_str('{v2}%s' % ''.join(['%s=%s|' % leaf for leaf in leaves]))
+
+
 class NDBAuditUnitTest(NDBUnitTest):
 
     class FooExpando(AuditMixin, ndb.Expando):
@@ -255,6 +367,36 @@ class NDBAuditUnitTest(NDBUnitTest):
                 self.assertEqual(tag.rev_hash, expected_hash)
                 self.assertEqual(tag.entity_key, expected_k)
 
+    def test_tag_multi_batched(self):
+        ents = [self.FooModel(key=ndb.Key('FooModel', 'foo%d' % i), foo='a', bar=i) for i in range(4)]
+        ents.append(self.FooModel(key=ndb.Key('FooModel', 'foo0', 'FooModel', 'child'), foo='a', bar=4))
+        audit_put_bulk_async(ents).get_result()
+        labels = ['l1', 'l2']
+        with mock.patch('ndb_audit._TAG_BATCH_SIZE', 3):
+            tags = tag_multi_async(ents, labels).get_result()
+            self.assertEqual([(t.entity_key, t.label) for t in tags],
+                             [(e.key, label) for e in ents for label in labels])
+            matrix = get_tags_multi_async([e.key for e in ents] + [ndb.Key('FooModel', 'none')],
+                                          labels + ['l3']).get_result()
+            self.assertEqual([[t and (t.rev_hash, t.account) for t in row] for row in matrix],
+                             [[(e.rev_hash, 'foo-account')] * 2 + [None] for e in ents] + [[None] * 3])
+
+            # move l1 along with the entities, atomically per entity group
+            for e in ents:
+                e.bar += 10
+            audit_put_bulk_async(ents).get_result()
+            ndb.transaction(lambda: tag_multi_async(ents, ['l1'], account='mover', atomic=True, max_in_flight=2),
+                            xg=True)
+            matrix = get_tags_multi_async(ents, labels).get_result()
+            for e, (l1, l2) in zip(ents, matrix):
+                self.assertEqual((l1.rev_hash, l1.account), (e.rev_hash, 'mover'))
+                self.assertNotEqual(l2.rev_hash, e.rev_hash)
+
+            delete_tags_multi_async(ents, ['l2', 'l3']).get_result()
+        self.assertEqual([[t and t.label for t in row] for row in get_tags_multi_async(ents, labels).get_result()],
+                         [['l1', None]] * len(ents))
+        self.assertEqual(get_tags_multi_async(ents, []).get_result(), [[]] * len(ents))
+
     def test_tag_query_by_entity_key(self):
         for cls in self._TEST_CLASSES:
             fookey = ndb.Key(cls.__name__, 'parentfoo')
@@ -315,7 +457,7 @@ class NDBAuditUnitTest(NDBUnitTest):
         g.foo.append('qux')
         self._trans_put(g)
 
-        a = sorted(list(Audit.query_by_entity_key(foo_key)), key=lambda x: x.timestamp, reverse=True)
+        a = Audit.latest_revisions_async(foo_key, 2).get_result()
         self.assertEqual(a[0].foo, ['foo', 'bar', 'baz', 'qux'])
         self.assertEqual(a[1].foo, ['foo', 'bar', 'baz'])
 
@@ -324,3 +466,684 @@ class NDBAuditUnitTest(NDBUnitTest):
         self.assertEqual(_hash_str(None), None)
         self.assertEqual(_hash_str(''), '')
         self.assertEqual(_hash_str('foo'), base64.urlsafe_b64encode(hashlib.sha1('foo').digest()[0:8]).rstrip('='))
+
+    def test_v2_data_hash(self):
+        fookey = ndb.Key(FooV2Model, 'parentfoo')
+        ent1 = FooV2Model(key=fookey, foo='a', bar=[1, 2], custom_prop=self.CUSTOM_VAL_1)
+        self._trans_put(ent1)
+        expected_data_hash = _v2_data_hash(foo='a', bar=[1, 2], custom_prop=self.CUSTOM_ENC_1)
+        self.assertEqual(ent1.data_hash, expected_data_hash)
+        self.assertEqual(ent1.rev_hash, _hash_str('{v1}None|foo-v2-account|%s' % expected_data_hash))
+        # scalar digests are cached, repeated ones are not.  the audit is built from the values the hash converted,
+        # so the stored custom_prop value is not handed out again and its digest is kept
+        self.assertEqual(sorted(ent1._values.digests.keys()), ['custom_prop', 'foo'])
+
+        # a fresh load hashes the same as the instance that was put
+        ent2 = fookey.get()
+        self._trans_put(ent2)
+        self.assertEqual(ent2.data_hash, expected_data_hash)
+        self.assertEqual(len(list(Audit.query_by_entity_key(fookey))), 1)
+        self.assertEqual(sorted(ent2._values.digests.keys()), ['custom_prop', 'foo'])
+
+        # assigning drops only that property's digest
+        ent2.foo = 'b'
+        self.assertEqual(sorted(ent2._values.digests.keys()), ['custom_prop'])
+        self._trans_put(ent2)
+        self.assertEqual(ent2.data_hash, _v2_data_hash(foo='b', bar=[1, 2], custom_prop=self.CUSTOM_ENC_1))
+        self.assertEqual(len(list(Audit.query_by_entity_key(fookey))), 2)
+
+        # in place changes are picked up for repeated and custom properties
+        ent2.bar.append(3)
+        ent2.custom_prop['qux'] = 2
+        self._trans_put(ent2)
+        expected_data_hash = _v2_data_hash(foo='b', bar=[1, 2, 3],
+                                           custom_prop=FooProperty()._to_base_type({'baz': 1, 'qux': 2}))
+        self.assertEqual(ent2.data_hash, expected_data_hash)
+        self.assertEqual(fookey.get().data_hash, expected_data_hash)
+        self.assertEqual(len(list(Audit.query_by_entity_key(fookey))), 3)
+
+    def test_unchanged_put_skips_account(self):
+        class FooV2AccountModel(FooV2Model):
+            accounts = 0
+
+            def _account(self):
+                FooV2AccountModel.accounts += 1
+                return 'foo-account'
+
+        ent = FooV2AccountModel(id='parentfoo', foo='a')
+        self._trans_put(ent)
+        self.assertEqual(FooV2AccountModel.accounts, 1)
+        self._trans_put(ent) # unchanged, no audit record needs the account
+        self.assertEqual(FooV2AccountModel.accounts, 1)
+        ent.foo = 'b'
+        self._trans_put(ent)
+        self.assertEqual(FooV2AccountModel.accounts, 2)
+
+    def test_v2_snapshot_reuses_hash_work(self):
+        class FooV2DeltaModel(FooV2Model):
+            _audit_storage = 'delta'
+
+        ent = FooV2DeltaModel(id='parentfoo', foo='a', bar=[1], custom_prop=self.CUSTOM_VAL_1)
+        with mock.patch('ndb_audit._entity_dict_value', side_effect=ndb_audit._entity_dict_value) as convert:
+            self._trans_put(ent)
+        # each property is converted once for both the data_hash and the delta bookkeeping
+        self.assertEqual(sorted([args[1]._code_name for args, _ in convert.call_args_list]),
+                         ['bar', 'custom_prop', 'foo'])
+        head = AuditHead._build_head_key(ent).get()
+        self.assertEqual(head.digests, dict([(k, _hash_str('%s=%s' % (k, str(v))))
+                                             for k, v in _entity_dict(ent).iteritems()]))
+        ent.foo = 'b'
+        self._trans_put(ent)
+        a = Audit.get_by_rev_hash_async(ent.key, ent.rev_hash).get_result()
+        self.assertEqual(a._payload_dict(), {'foo': 'b'})
+
+    def test_dedup_hashes_once(self):
+        ent = FooDedupExpando(id='parentfoo', foo='a')
+        with mock.patch('ndb_audit._v1_data_hash', side_effect=ndb_audit._v1_data_hash) as hashed:
+            self._trans_put(ent)
+            self.assertEqual(hashed.call_count, 1)
+            ent.foo = 'b'
+            ndb.transaction(lambda: audit_put_multi_async([ent]).get_result(), xg=True)
+            self.assertEqual(hashed.call_count, 2)
+            self._trans_put(ent) # unchanged
+            self.assertEqual(hashed.call_count, 3)
+        self.assertEqual(Audit.get_by_rev_hash_async(ent.key, ent.rev_hash).get_result().foo, 'b')
+
+        # the data_hash worked out before the put is dropped when a property is assigned meanwhile
+        ent.foo = 'c'
+        ent._audit_prefetch_keys()
+        self.assertIsNotNone(ent._audit_snapshot)
+        ent.foo = 'd'
+        self.assertIsNone(ent._audit_snapshot)
+        ent._batch_put_hook()
+        self.assertEqual(ent.data_hash, ent._compute_data_hash())
+
+    def test_v2_data_hash_computed_property(self):
+        class FooV2ComputedModel(FooV2Model):
+            upper = ndb.ComputedProperty(lambda self: self.foo.upper() if self.foo else None)
+
+        fookey = ndb.Key(FooV2ComputedModel, 'parentfoo')
+        self._trans_put(FooV2ComputedModel(key=fookey, foo='a'))
+        ent = fookey.get()
+        ent.foo = 'b'
+        self._trans_put(ent)
+        self.assertNotIn('upper', ent._values.digests)
+        ndb.get_context().clear_cache()
+        fresh = fookey.get()
+        # the hash depends on the content only, not on what was hashed before
+        self.assertEqual(fresh._compute_data_hash(), ent.data_hash)
+        self.assertEqual(fresh.data_hash, ent.data_hash)
+
+    def test_v3_data_hash(self):
+        ent = FooV3Expando(id='v3foo', foo='a', bar=[1, 2])
+        # pins the 'v3' encoding, changing it changes the data_hash of every entity
+        self.assertEqual(ent._update_data_hash(), 'f8ffWCHMCYA')
+        self.assertEqual(FooV3Expando(id='v3foo', foo=u'a', bar=[1L, 2L])._update_data_hash(), ent.data_hash)
+        # str() of '1' and 1 are the same but their encodings are not
+        self.assertNotEqual(FooV3Expando(foo='1')._update_data_hash(), FooV3Expando(foo=1)._update_data_hash())
+        self.assertNotEqual(FooV3Sha256Expando(id='v3foo', foo='a', bar=[1, 2])._update_data_hash(), ent.data_hash)
+
+        # large values go to the hasher without being copied
+        big = 'x' * 100000
+        written = []
+        _canonical_encode({'foo': big}, written.append)
+        self.assertTrue(any(w is big for w in written))
+
+        ent = FooV3Expando(id='v3foo', foo='a', bar=[1, 2])
+        self._trans_put(ent)
+        self.assertEqual(ent.data_hash, 'f8ffWCHMCYA')
+        self.assertEqual(ent.key.get().data_hash, ent.data_hash)
+        self.assertEqual(ent.rev_hash, _hash_str('{v1}None|foo-v3-account|%s' % ent.data_hash))
+
+    def test_put_snapshot(self):
+        # each entity's properties and account are worked out once per put, and a batch shares one timestamp
+        ents = [self.FooModel(id='snap%d' % i, foo='a', bar=i) for i in xrange(3)]
+        ents.append(FooDeltaExpando(id='snapdelta', foo='a', bar=3))
+        with mock.patch('ndb_audit._entity_dict', side_effect=_entity_dict) as entity_dict, \
+                mock.patch.object(self.FooModel, '_account', return_value='foo-account') as account:
+            self.t_put_multi(ents)
+        self.assertEqual(entity_dict.call_count, 4)
+        self.assertEqual(account.call_count, 3)
+        audits = [Audit.query_by_entity_key(e).get() for e in ents]
+        self.assertEqual(len(set([a.timestamp for a in audits])), 1)
+        self.assertEqual([a.rev_hash for a in audits], [e.rev_hash for e in ents])
+
+    def test_audit_log(self):
+        for cls in (FooLogModel, FooLogDeltaModel):
+            fookey = ndb.Key(cls, 'logfoo')
+            ent = cls(key=fookey, foo='a')
+            self._trans_put(ent)
+            rev1 = ent.rev_hash
+            ent.foo = 'b'
+            self._trans_put(ent)
+            Tag.create_from_entity(ent, 'latest').put()
+
+            # nothing but the entity itself is in its entity group
+            self.assertEqual(ndb.Query(ancestor=fookey).fetch(keys_only=True),
+                             [fookey, Tag._build_tag_key(ent, 'latest')])
+            history = Audit.query_history(fookey).fetch()
+            self.assertEqual([a.rev_hash for a in history], [ent.rev_hash, rev1])
+            self.assertEqual([a.foo for a in history], ['b', 'a'])
+            for a in history:
+                self.assertEqual(a.key.parent().kind(), 'AuditLog')
+                self.assertEqual(a.entity_key, fookey)
+            self.assertEqual(a.key, Audit.build_audit_record_key(fookey, a.data_hash, None, 'foo-account'))
+            self.assertEqual(len(Audit.query_by_entity_key(fookey).fetch()), 2)
+            self.assertEqual(Audit.get_by_rev_hash_async(fookey, rev1).get_result().foo, 'a')
+            self.assertEqual(Tag.get_by_entity_key_label_async(fookey, 'latest').get_result().get_audit_async()
+                             .get_result().rev_hash, ent.rev_hash)
+            self.assertEqual(history[0].entity_dict_async().get_result(), {'foo': 'b'})
+
+        # each entity's AuditLog root counts against the cross-group transaction limit
+        ents = [FooLogModel(id='bulk%d' % i, foo='a') for i in range(6)]
+        with mock.patch('ndb_audit.audit_put_multi_async', side_effect=audit_put_multi_async) as put_multi:
+            results = audit_put_bulk_async(ents, max_entity_groups=4).get_result()
+        self.assertTrue(all([r.ok for r in results]))
+        self.assertEqual([len(args[0]) for args, _ in put_multi.call_args_list], [2, 2, 2])
+
+    def test_delta_storage(self):
+        fookey = ndb.Key(FooDeltaExpando, 'parentfoo')
+        ent = FooDeltaExpando(key=fookey, foo='a', bar=1, baz=['x' * 100])
+        expected = []
+
+        def put_and_get_audit():
+            self._trans_put(ent)
+            expected.append(copy.deepcopy(_entity_dict(ent)))
+            audits = dict([(a.rev_hash, a) for a in Audit.query_by_entity_key(fookey)])
+            return audits[ent.rev_hash]
+
+        a1 = put_and_get_audit()
+        self.assertIsNone(a1.delta) # first revision is a checkpoint
+        self.assertEqual(a1._payload_dict(), {'foo': 'a', 'bar': 1, 'baz': ['x' * 100]})
+
+        ent.foo = 'b'
+        a2 = put_and_get_audit()
+        self.assertEqual(a2.delta, {'chain': [a1.key.string_id()], 'removed': []})
+        self.assertEqual(a2._payload_dict(), {'foo': 'b'})
+        self.assertEqual(a2.parent_hash, a1.rev_hash)
+
+        del ent.bar
+        a3 = put_and_get_audit()
+        self.assertEqual(a3.delta, {'chain': [a1.key.string_id(), a2.key.string_id()], 'removed': ['bar']})
+        self.assertEqual(a3._payload_dict(), {})
+
+        ent.foo = 'c'
+        a4 = put_and_get_audit()
+        self.assertIsNone(a4.delta) # _audit_checkpoint_revisions reached
+        self.assertEqual(a4._payload_dict(), {'foo': 'c', 'baz': ['x' * 100]})
+
+        ent.baz.append('y')
+        a5 = put_and_get_audit()
+        self.assertEqual(a5._payload_dict(), {'baz': ['x' * 100, 'y']})
+        self.assertEqual(AuditHead._build_head_key(fookey).get().chain, [a4.key.string_id(), a5.key.string_id()])
+
+        for a, props in zip([a1, a2, a3, a4, a5], expected):
+            self.assertEqual(a.entity_dict_async().get_result(), props)
+
+        # a blind put is not based on the head so it starts again from a checkpoint
+        ent = FooDeltaExpando(key=fookey, foo='d')
+        a6 = put_and_get_audit()
+        self.assertIsNone(a6.delta)
+        self.assertIsNone(a6.parent_hash)
+        self.assertEqual(a6._payload_dict(), {'foo': 'd'})
+
+    def test_delta_storage_checkpoint_bytes(self):
+        class FooDeltaBytesExpando(FooDeltaExpando):
+            _audit_checkpoint_bytes = 500
+
+        fookey = ndb.Key(FooDeltaBytesExpando, 'parentfoo')
+        ent = FooDeltaBytesExpando(key=fookey, foo='a', bar='x' * 1000)
+        self._trans_put(ent)
+        ent.foo = 'b'
+        self._trans_put(ent)
+        ent.bar = 'y' * 1000
+        self.t_put_multi([ent])
+        audits = sorted(list(Audit.query_by_entity_key(fookey)), key=lambda x: x.timestamp)
+        self.assertEqual([a.delta for a in audits], [None, {'chain': [audits[0].key.string_id()], 'removed': []}, None])
+        self.assertEqual(audits[2]._payload_dict(), {'foo': 'b', 'bar': 'y' * 1000})
+
+    def test_delta_storage_reserved_names(self):
+        # properties named like the header of the audit record are stored apart from it
+        fookey = ndb.Key(FooDeltaExpando, 'parentfoo')
+        ent = FooDeltaExpando(key=fookey, delta='a', dl=1, foo='a')
+        setattr(ent, '~x', 'b')
+        self._trans_put(ent)
+        ent.delta = 'b'
+        self._trans_put(ent)
+        ndb.get_context().clear_cache()
+        audits = sorted(list(Audit.query_by_entity_key(fookey)), key=lambda x: x.timestamp)
+        self.assertEqual(audits[1].delta, {'chain': [audits[0].key.string_id()], 'removed': []})
+        self.assertEqual(audits[1]._payload_dict(), {'delta': 'b'})
+        self.assertEqual(audits[0].entity_dict_async().get_result(), {'delta': 'a', 'dl': 1, 'foo': 'a', '~x': 'b'})
+        self.assertEqual(audits[1].entity_dict_async().get_result(), _entity_dict(ent))
+        records = [r for page, cursor in iter_history_records(fookey, newest_first=False) for r in page]
+        self.assertEqual(records[0].to_dict(), audits[0]._payload_dict())
+        self.assertEqual((records[1].delta, records[1].to_dict()), (audits[1].delta, {'delta': 'b'}))
+
+    def test_blob_payload(self):
+        fookey = ndb.Key(FooBlobModel, 'parentfoo')
+        baz = [FooInsideModel(foo='foomodela', bar=11), FooInsideModel(foo='foomodelb', bar=22)]
+        ent = FooBlobModel(key=fookey, foo='a', baz=baz, custom_prop=self.CUSTOM_VAL_1)
+        self._trans_put(ent)
+        ndb.get_context().clear_cache()
+        a = Audit.query_by_entity_key(fookey).get()
+        self.assertIsNotNone(a.payload)
+        self.assertIsNone(a._payload_values) # not decoded until a property is read
+        self.assertEqual(a.foo, 'a')
+        # structured values come back as Expandos, as they do for 'expando' records loaded from the datastore
+        self.assertEqual([m._to_dict() for m in a.baz], [m._to_dict() for m in baz])
+        self.assertEqual(a.custom_prop, self.CUSTOM_ENC_1)
+        self.assertEqual(a.data_hash, ent.data_hash)
+        self.assertRaises(AttributeError, getattr, a, 'qux')
+
+        # reads the same as a record with one property per field
+        expando_a = Audit(key=ndb.Key(parent=fookey, pairs=[('Audit', 'expando')]), kind='FooBlobModel', data_hash='d',
+                          account='foo-blob-account', timestamp=a.timestamp)
+        expando_a.populate(**_entity_dict(ent))
+        expando_a.put()
+        ndb.get_context().clear_cache()
+        self.assertEqual(a._payload_dict(), expando_a.key.get()._payload_dict())
+        self.assertEqual(a.entity_dict_async().get_result(), expando_a.key.get().entity_dict_async().get_result())
+
+    def test_payload_property(self):
+        class FooPayloadModel(AuditMixin, ndb.Model):
+            payload = ndb.BlobProperty()
+            pl = ndb.StringProperty()
+
+            def _account(self):
+                return 'foo-account'
+
+        class FooPayloadBlobModel(FooPayloadModel):
+            _audit_payload_format = 'blob'
+
+        for cls in (FooPayloadModel, FooPayloadBlobModel):
+            ent = cls(id='foo', payload='\x02not an audit payload', pl='x')
+            self._trans_put(ent)
+            ndb.get_context().clear_cache()
+            a = Audit.query_by_entity_key(ent.key).get()
+            self.assertEqual(a.entity_dict_async().get_result(), {'payload': '\x02not an audit payload', 'pl': 'x'})
+            record = [r for page, cursor in iter_history_records(ent.key) for r in page][0]
+            self.assertEqual(record.to_dict(), {'payload': '\x02not an audit payload', 'pl': 'x'})
+
+    def test_blob_payload_delta(self):
+        fookey = ndb.Key(FooDeltaBlobExpando, 'parentfoo')
+        ent = FooDeltaBlobExpando(key=fookey, foo='a', bar=1)
+        self._trans_put(ent)
+        ent.foo = 'b'
+        self._trans_put(ent)
+        ndb.get_context().clear_cache()
+        audits = sorted(list(Audit.query_by_entity_key(fookey)), key=lambda x: x.timestamp)
+        self.assertEqual(audits[1]._payload_dict(), {'foo': 'b'})
+        self.assertEqual(audits[1].entity_dict_async().get_result(), {'foo': 'b', 'bar': 1})
+
+    def test_payload_dedup(self):
+        fookey = ndb.Key(FooDedupExpando, 'parentfoo')
+        ent = FooDedupExpando(key=fookey, foo='a', bar=1)
+        states = []
+        for foo in ('a', 'b', 'a', 'b', 'a'):
+            ent.foo = foo
+            self._trans_put(ent)
+            states.append(ent.data_hash)
+        self.assertEqual(states[0::2], [states[0]] * 3)
+        self.assertEqual(len(AuditContent.query(ancestor=fookey).fetch()), 2) # one per distinct state
+
+        ndb.get_context().clear_cache()
+        audits = list(Audit.query_history(fookey, newest_first=False))
+        self.assertEqual([a.content for a in audits], [AuditContent.build_key(fookey, h) for h in states])
+        self.assertEqual([a._to_dict(exclude=_AUDIT_HEADER_PROPS) for a in audits], [{}] * 5) # header only
+        Audit.load_content_multi_async(audits).get_result()
+        self.assertEqual([a.foo for a in audits], ['a', 'b', 'a', 'b', 'a'])
+        self.assertEqual(audits[1].entity_dict_async().get_result(), {'foo': 'b', 'bar': 1})
+        ndb.get_context().clear_cache()
+        records = [r for page, cursor in iter_history_records(fookey, newest_first=False) for r in page]
+        self.assertEqual([r.to_dict() for r in records], [{'foo': foo, 'bar': 1} for foo in 'ababa'])
+        self.assertEqual(list(iter_history_records(fookey, with_payload=False))[0][0][0].to_dict(), {})
+
+        # unchanged puts need no content, and content that has not been used for a while is marked used again
+        content = AuditContent.build_key(fookey, states[1]).get()
+        content.last_used -= AuditContent.REFRESH_AFTER
+        content.put()
+        self._trans_put(ent)
+        self.assertEqual(len(Audit.query_by_entity_key(fookey).fetch()), 5)
+        ent.foo = 'b'
+        self._trans_put(ent)
+        self.assertEqual(AuditContent.build_key(fookey, states[1]).get().last_used,
+                         Audit.get_by_rev_hash_async(fookey, ent.rev_hash).get_result().timestamp)
+
+    def test_payload_dedup_kind(self):
+        ents = [FooDedupKindModel(id='foo%d' % i, foo='a') for i in range(3)]
+        self.assertTrue(all([r.ok for r in audit_put_bulk_async(ents).get_result()]))
+        content_key = AuditContent.build_key(ents[0].key, ents[0].data_hash)
+        self.assertIsNone(content_key.parent())
+        ndb.get_context().clear_cache()
+        for e in ents:
+            a = Audit.get_by_rev_hash_async(e.key, e.rev_hash).get_result()
+            self.assertEqual(a.content, content_key)
+            self.assertEqual(a.foo, 'a')
+
+    def test_reserved_property_names(self):
+        class FooReservedModel(AuditMixin, ndb.Model):
+            content = ndb.StringProperty()
+            payload = ndb.StringProperty()
+            delta = ndb.JsonProperty()
+            squashed = ndb.BooleanProperty()
+            entity_key = ndb.KeyProperty()
+            foo = ndb.StringProperty()
+
+            def _account(self):
+                return 'foo-account'
+
+        class FooReservedBlobModel(FooReservedModel):
+            _audit_payload_format = 'blob'
+
+        class FooReservedDeltaModel(FooReservedModel):
+            _audit_storage = 'delta'
+
+        class FooReservedDedupModel(FooReservedModel):
+            _audit_payload_dedup = 'entity'
+
+        class FooReservedLogModel(FooReservedModel):
+            _audit_log = 'log'
+
+        for cls in (FooReservedModel, FooReservedBlobModel, FooReservedDeltaModel, FooReservedDedupModel,
+                    FooReservedLogModel):
+            ent = cls(id='foo', content='c', payload='p', delta={'chain': []}, squashed=False,
+                      entity_key=ndb.Key('Other', 1), foo='a')
+            self._trans_put(ent)
+            first = _entity_dict(ent)
+            ent.foo = 'b'
+            self._trans_put(ent)
+            self.assertIsNotNone(ent.rev_hash)
+            ndb.get_context().clear_cache()
+
+            audits = list(Audit.query_history(ent, newest_first=False))
+            self.assertEqual(len(audits), 2)
+            self.assertEqual([a.entity_dict_async().get_result() for a in audits], [first, _entity_dict(ent)])
+            self.assertEqual(audits[1].parent_hash, audits[0].rev_hash)
+            self.assertEqual(audits[0].squashed, None)
+            self.assertEqual(audits[0].entity_key, ent.key if cls._audit_log == 'log' else None)
+            records = [r for page, cursor in iter_history_records(ent, newest_first=False) for r in page]
+            self.assertEqual(records[0].to_dict(), first)
+            self.assertEqual([r.rev_hash for r in records], [a.rev_hash for a in audits])
+            self.assertTrue(verify_entity_async(ent).get_result().ok)
+
+    def test_audit_failure_fails_put(self):
+        class FooFailingModel(AuditMixin, ndb.Model):
+            foo = ndb.StringProperty()
+
+            def _account(self):
+                raise ValueError('no account')
+
+        fookey = ndb.Key(FooFailingModel, 'parentfoo')
+        self.assertRaises(ValueError, self._trans_put, FooFailingModel(key=fookey, foo='a'))
+        self.assertIsNone(fookey.get())
+        self.assertEqual(Audit.query_by_entity_key(fookey).fetch(), [])
+
+    def test_get_by_rev_hash(self):
+        for cls in self._TEST_CLASSES:
+            fookey = ndb.Key(cls.__name__, 'parentfoo')
+            ent = cls(key=fookey, foo='a', bar=1)
+            self._trans_put(ent)
+            rev1 = ent.rev_hash
+            ent.foo = 'b'
+            self._trans_put(ent)
+            rev2 = ent.rev_hash
+            ndb.get_context().clear_cache()
+
+            a1 = Audit.get_by_rev_hash_async(fookey, rev1, legacy_scan=False).get_result()
+            self.assertEqual(a1.rev_hash, rev1)
+            self.assertEqual(a1.foo, 'a')
+            a2 = Audit.get_by_rev_hash_async(ent, rev2, legacy_scan=False).get_result()
+            self.assertEqual(a2.foo, 'b')
+            self.assertIsNone(Audit.get_by_rev_hash_async(fookey, 'wronghash').get_result())
+
+            otherkey = ndb.Key(cls.__name__, 'parentfoo2')
+            self._trans_put(cls(key=otherkey, foo='c', bar=3))
+            futures = Audit.get_by_rev_hash_multi_async([fookey, otherkey, otherkey],
+                                                        [rev2, otherkey.get().rev_hash, rev1])
+            self.assertEqual([f.get_result() and f.get_result().foo for f in futures], ['b', 'c', None])
+
+            t = Tag.create_from_rev_hash(fookey, 'foo-account', 'abc123', rev1)
+            self.assertEqual(t.get_audit_async().get_result().foo, 'a')
+
+    def test_get_by_rev_hash_legacy(self):
+        # records written before rev_hash was stored can only be found by hashing the keys of the history
+        fookey = ndb.Key(self.FooModel.__name__, 'parentfoo')
+        audit_id = '{v1}None|foo-account|legacyhash'
+        legacy = datastore.Entity('Audit', name=audit_id, parent=fookey.to_old_key(), unindexed_properties=['k'])
+        legacy.update({'k': 'FooModel', 'd': 'legacyhash', 'p': None, 'a': 'foo-account',
+                       'ts': datetime.datetime.utcnow(), 'foo': 'a'})
+        datastore.Put(legacy)
+        rev_hash = _hash_str(audit_id)
+        self.assertIsNone(Audit.get_by_rev_hash_async(fookey, rev_hash).get_result())
+        a = Audit.get_by_rev_hash_async(fookey, rev_hash, legacy_scan=True).get_result()
+        self.assertEqual(a.rev_hash, rev_hash)
+        self.assertEqual(a.foo, 'a')
+        t = Tag.create_from_rev_hash(fookey, 'foo-account', 'abc123', rev_hash)
+        self.assertIsNone(t.get_audit_async().get_result())
+        self.assertEqual(t.get_audit_async(legacy_scan=True).get_result().foo, 'a')
+        # once reindexed they are found without scanning
+        Audit.reindex_history_async(fookey).get_result()
+        self.assertEqual(Audit.get_by_rev_hash_async(fookey, rev_hash).get_result().foo, 'a')
+
+    def test_history(self):
+        fookey = ndb.Key(self.FooModel.__name__, 'parentfoo')
+        ent = self.FooModel(key=fookey, foo='a', bar=0)
+        for i in range(7):
+            ent.bar = i
+            self._trans_put(ent)
+
+        self.assertEqual([a.bar for a in Audit.query_history(fookey)], [6, 5, 4, 3, 2, 1, 0])
+        self.assertEqual([a.bar for a in Audit.query_history(fookey, newest_first=False)], [0, 1, 2, 3, 4, 5, 6])
+        self.assertEqual([a.bar for a in Audit.latest_revisions_async(fookey, 2).get_result()], [6, 5])
+        self.assertEqual(Audit.latest_revisions_async(ent).get_result()[0].rev_hash, ent.rev_hash)
+
+        pages = list(Audit.iter_history(fookey, page_size=3))
+        self.assertEqual([[a.bar for a in audits] for audits, cursor in pages], [[6, 5, 4], [3, 2, 1], [0]])
+        # resume after the first page
+        audits, cursor, more = Audit.fetch_history_page_async(fookey, 3, cursor=pages[0][1]).get_result()
+        self.assertEqual([a.bar for a in audits], [3, 2, 1])
+        self.assertTrue(more)
+        resumed = list(Audit.iter_history(fookey, page_size=4, cursor=pages[1][1], newest_first=True))
+        self.assertEqual([[a.bar for a in audits] for audits, cursor in resumed], [[0]])
+        oldest_first = list(Audit.iter_history(fookey, page_size=4, newest_first=False))
+        self.assertEqual([[a.bar for a in audits] for audits, cursor in oldest_first], [[0, 1, 2, 3], [4, 5, 6]])
+
+    def test_reindex_history(self):
+        fookey = ndb.Key(self.FooModel.__name__, 'parentfoo')
+        audit_id = '{v1}None|foo-account|legacyhash'
+        legacy = datastore.Entity('Audit', name=audit_id, parent=fookey.to_old_key(), unindexed_properties=['ts'])
+        legacy.update({'k': 'FooModel', 'd': 'legacyhash', 'p': None, 'a': 'foo-account',
+                       'ts': datetime.datetime.utcnow(), 'foo': 'a'})
+        datastore.Put(legacy)
+        self.assertEqual(Audit.latest_revisions_async(fookey).get_result(), [])
+        self.assertEqual(Audit.reindex_history_async(fookey).get_result(), 1)
+        self.assertEqual(Audit.latest_revisions_async(fookey).get_result()[0].foo, 'a')
+        self.assertIsNotNone(Audit.get_by_rev_hash_async(fookey, _hash_str(audit_id), legacy_scan=False).get_result())
+
+    def test_put_bulk(self):
+        ents = [self.FooModel(key=ndb.Key('FooModel', 'foo%d' % i), foo='a', bar=i) for i in range(40)]
+        # children share their parent's entity group
+        ents += [self.FooModel(key=ndb.Key('FooModel', 'foo0', 'FooModel', 'child%d' % i), foo='b', bar=i)
+                 for i in range(5)]
+        ents.append(FooRequiredModel(key=ndb.Key(FooRequiredModel, 'bad'))) # missing required property
+        results = audit_put_bulk_async(ents, max_entity_groups=7, max_entities=10, max_in_flight=3).get_result()
+        self.assertEqual([r.entity for r in results], ents)
+        self.assertTrue(all([r.ok for r in results[:-1]]))
+        self.assertFalse(results[-1].ok)
+        self.assertIsInstance(results[-1].error, datastore_errors.BadValueError)
+        self.assertIsNone(results[-1].rev_hash)
+        for r in results[:-1]:
+            self.assertEqual(r.key, r.entity.key)
+            self.assertEqual(r.rev_hash, r.key.get().rev_hash)
+            self.assertEqual(Audit.get_by_rev_hash_async(r.key, r.rev_hash).get_result().bar, r.entity.bar)
+
+    def test_put_bulk_retries_contention(self):
+        ents = [self.FooModel(key=ndb.Key('FooModel', 'foo%d' % i), foo='a', bar=i) for i in range(3)]
+        real_put = audit_put_multi_async
+        calls = []
+
+        def flaky_put(entities, **ctx_options):
+            calls.append(len(entities))
+            if len(calls) == 1:
+                # the hashes are updated before the transaction fails, they must be rolled back for the retry
+                real_put(entities, **ctx_options)
+                raise datastore_errors.TransactionFailedError('too much contention')
+            return real_put(entities, **ctx_options)
+
+        with mock.patch('ndb_audit.audit_put_multi_async', side_effect=flaky_put):
+            results = audit_put_bulk_async(ents, backoff=0.001).get_result()
+        self.assertEqual(calls, [3, 3])
+        self.assertTrue(all([r.ok for r in results]))
+        for r in results:
+            self.assertEqual(len(list(Audit.query_by_entity_key(r.key))), 1)
+
+        with mock.patch('ndb_audit.audit_put_multi_async',
+                        side_effect=datastore_errors.TransactionFailedError('too much contention')):
+            for e in ents:
+                e.foo = 'b'
+            results = audit_put_bulk_async(ents, retries=2, backoff=0.001).get_result()
+        self.assertEqual([type(r.error) for r in results], [datastore_errors.TransactionFailedError] * 3)
+
+    def test_put_if_rev(self):
+        keys = [ndb.Key('FooModel', 'foo%d' % i) for i in range(4)]
+        revs = []
+        for k in keys[:3]:
+            ent = self.FooModel(key=k, foo='a')
+            self._trans_put(ent)
+            revs.append(ent.rev_hash)
+        moved_on = self.FooModel(key=keys[1], foo='b')
+        self._trans_put(moved_on)
+
+        # not read first, only the expected revisions are known
+        ents = [self.FooModel(key=k, foo='c') for k in keys]
+        expected = [revs[0], revs[1], 'someotherrev', None]
+        results = put_if_rev_multi_async(ents, expected).get_result()
+        self.assertEqual([r is None for r in results], [True, False, False, True])
+        self.assertEqual([(r.entity, r.expected_rev_hash, r.rev_hash) for r in results[1:3]],
+                         [(ents[1], revs[1], moved_on.rev_hash), (ents[2], 'someotherrev', revs[2])])
+        ndb.get_context().clear_cache()
+        self.assertEqual([k.get().foo for k in keys], ['c', 'b', 'a', 'c'])
+        # chained to the expected revision, not a new chain
+        self.assertEqual(Audit.get_by_rev_hash_async(keys[0], ents[0].rev_hash).get_result().parent_hash, revs[0])
+        self.assertIsNone(Audit.get_by_rev_hash_async(keys[3], ents[3].rev_hash).get_result().parent_hash)
+        self.assertEqual(ents[2].rev_hash, None) # untouched
+
+        # every entity needs its expected revision
+        extra = self.FooModel(key=keys[0], foo='e')
+        self.assertRaises(ValueError, put_if_rev_multi_async([extra, ents[1]], [ents[0].rev_hash]).get_result)
+        self.assertRaises(ValueError, put_if_rev_multi_async([extra], [ents[0].rev_hash, None]).get_result)
+        self.assertEqual(keys[0].get().foo, 'c')
+
+        # a failed put leaves the hashes as they were, so it can be tried again
+        ents[1].foo = 'd'
+        real_put = audit_put_multi_async
+
+        def failed_put(entities, **ctx_options):
+            real_put(entities, **ctx_options)
+            raise datastore_errors.TransactionFailedError('too much contention')
+
+        with mock.patch('ndb_audit.audit_put_multi_async', side_effect=failed_put):
+            future = put_if_rev_multi_async([ents[1]], [moved_on.rev_hash])
+            self.assertRaises(datastore_errors.TransactionFailedError, future.get_result)
+        self.assertEqual((ents[1].data_hash, ents[1].rev_hash), (None, None))
+        self.assertEqual(put_if_rev_multi_async([ents[1]], [moved_on.rev_hash]).get_result(), [None])
+        self.assertEqual(Audit.get_by_rev_hash_async(keys[1], ents[1].rev_hash).get_result().parent_hash,
+                         moved_on.rev_hash)
+
+    def test_put_if_rev_head(self):
+        class FooHeadModel(AuditMixin, ndb.Model):
+            _audit_keep_head = True
+
+            foo = ndb.StringProperty()
+
+            def _account(self):
+                return 'foo-account'
+
+        fookey = ndb.Key(FooHeadModel, 'parentfoo')
+        ent = FooHeadModel(key=fookey, foo='a')
+        self._trans_put(ent)
+        first = ent.rev_hash
+        ent.foo = 'b'
+        self._trans_put(ent)
+        self.assertEqual(AuditHead._build_head_key(fookey).get().rev_hash, ent.rev_hash)
+        # the newest record by timestamp is not the latest revision, e.g. because of clock skew
+        latest = Audit.get_by_rev_hash_async(fookey, ent.rev_hash).get_result()
+        latest.timestamp -= datetime.timedelta(hours=1)
+        latest.put()
+        self.assertEqual(Audit.latest_revision_keys_multi_async([fookey]).get_result()[0].string_id(),
+                         Audit.get_by_rev_hash_async(fookey, first).get_result().key.string_id())
+
+        with mock.patch.object(Audit, 'latest_revision_keys_multi_async', side_effect=AssertionError('query')):
+            results = put_if_rev_multi_async([FooHeadModel(key=fookey, foo='c')], [first]).get_result()
+            self.assertEqual(results[0].rev_hash, latest.rev_hash)
+            new = FooHeadModel(key=fookey, foo='c')
+            self.assertEqual(put_if_rev_multi_async([new], [latest.rev_hash]).get_result(), [None])
+        self.assertEqual(Audit.get_by_rev_hash_async(fookey, new.rev_hash).get_result().parent_hash, latest.rev_hash)
+        self.assertEqual(AuditHead._build_head_key(fookey).get().rev_hash, new.rev_hash)
+
+    def test_put_if_rev_unindexed_history(self):
+        # without an AuditHead the latest revision is queried by timestamp, which needs the history reindexed
+        fookey = ndb.Key(self.FooModel.__name__, 'parentfoo')
+        audit_id = '{v1}None|foo-account|legacyhash'
+        legacy = datastore.Entity('Audit', name=audit_id, parent=fookey.to_old_key(), unindexed_properties=['ts'])
+        legacy.update({'k': 'FooModel', 'd': 'legacyhash', 'p': None, 'a': 'foo-account',
+                       'ts': datetime.datetime.utcnow(), 'foo': 'a'})
+        datastore.Put(legacy)
+        rev_hash = _hash_str(audit_id)
+        results = put_if_rev_multi_async([self.FooModel(key=fookey, foo='b')], [rev_hash]).get_result()
+        self.assertEqual(results[0].rev_hash, None)
+        Audit.reindex_history_async(fookey).get_result()
+        ent = self.FooModel(key=fookey, foo='b')
+        self.assertEqual(put_if_rev_multi_async([ent], [rev_hash]).get_result(), [None])
+        self.assertEqual(Audit.get_by_rev_hash_async(fookey, ent.rev_hash).get_result().parent_hash, rev_hash)
+
+    def test_metrics(self):
+        fookey = ndb.Key(self.FooModel.__name__, 'parentfoo')
+        ent = self.FooModel(key=fookey, foo='a', bar=1)
+        self._trans_put(ent) # nothing is measured without metrics installed
+        metrics = RecordingMetrics()
+        set_metrics(metrics)
+        try:
+            ent.bar = 2
+            self._trans_put(ent)
+            self._trans_put(ent)
+            others = [self.FooModel(key=ndb.Key('FooModel', 'foo%d' % i), foo='a', bar=i) for i in range(3)]
+            ndb.transaction(lambda: audit_put_multi_async(others), xg=True)
+            tag_multi_from_rev_hash_async([fookey], [ent.rev_hash], 'foo-account', 'label')[0].get_result()
+            Audit.latest_revisions_async(fookey, 5).get_result()
+            list(Audit.iter_history(fookey, page_size=1))
+        finally:
+            set_metrics(None)
+
+        self.assertEqual(metrics.counters, {('audit_records', 'FooModel'): 4, ('puts_unchanged', 'FooModel'): 1,
+                                            ('tags_written', 'FooModel'): 1})
+        self.assertEqual(len(metrics.samples[('hash_ms', 'FooModel')]), 5)
+        self.assertEqual(len(metrics.samples[('snapshot_bytes', 'FooModel')]), 4)
+        self.assertTrue(all([b > 0 for b in metrics.samples[('snapshot_bytes', 'FooModel')]]))
+        self.assertEqual(metrics.samples[('put_multi_batch_size', None)], [3])
+        self.assertEqual(metrics.samples[('history_query_results', 'FooModel')], [2, 1, 1])
+        self.assertEqual(len(metrics.samples[('history_query_ms', 'FooModel')]), 3)
+        self.assertEqual([(name, key) for name, key, span in metrics.spans],
+                         [('put', fookey), ('put', fookey)] + [('put', e.key) for e in others])
+        for name, key, span in metrics.spans:
+            span.finish.assert_called_once_with(None)
+
+    def test_metrics_delta_checkpoint(self):
+        class FooDeltaBytesModel(self.FooModel):
+            _audit_storage = 'delta'
+            _audit_checkpoint_bytes = 1 # each delta is dropped for a full checkpoint
+
+        ent = FooDeltaBytesModel(id='parentfoo', foo='a', bar=1)
+        metrics = RecordingMetrics()
+        set_metrics(metrics)
+        try:
+            for bar in (1, 2, 3):
+                ent.bar = bar
+                self._trans_put(ent)
+        finally:
+            set_metrics(None)
+        # only the records written are measured
+        audits = Audit.query_history(ent, newest_first=False).fetch()
+        self.assertEqual([a.delta for a in audits], [None] * 3)
+        self.assertEqual(len(metrics.samples[('snapshot_bytes', 'FooDeltaBytesModel')]), len(audits))
@@ -0,0 +1,123 @@
+import mock
+from google.appengine.ext import ndb
+
+from ndb_audit import Audit, AuditContent, AuditHead, AuditJournal, AuditMixin, AuditValueChange, audit_put_multi_async
+from ndb_audit.outbox import InProcessOutboxQueue, drain_async, drain_outbox_async
+from test import NDBUnitTest
+
+
+class FooOutboxModel(AuditMixin, ndb.Model):
+    _audit_write = 'outbox'
+
+    foo = ndb.StringProperty()
+    bar = ndb.IntegerProperty(repeated=True)
+
+    account = 'foo-account'
+
+    def _account(self):
+        return self.account
+
+
+class FooOutboxDeltaLogModel(FooOutboxModel):
+    _audit_storage = 'delta'
+    _audit_checkpoint_revisions = 2
+    _audit_log = 'log'
+
+
+class FooOutboxTrackedModel(FooOutboxModel):
+    _audit_tracked_properties = ('foo',)
+    _audit_payload_dedup = 'entity'
+
+
+class OutboxTest(NDBUnitTest):
+
+    def setUp(self):
+        super(OutboxTest, self).setUp()
+        self.queue = FooOutboxModel._audit_outbox_queue = InProcessOutboxQueue()
+
+    def tearDown(self):
+        FooOutboxModel._audit_outbox_queue = None
+        super(OutboxTest, self).tearDown()
+
+    def _drain_batched(self, ent):
+        # the bookkeeping of all the revisions is read in one batch, and none of it on its own
+        get_multi_async = ndb.get_multi_async
+        with mock.patch.object(ndb.Key, 'get', side_effect=AssertionError('single get')), \
+                mock.patch('google.appengine.ext.ndb.get_multi_async', side_effect=get_multi_async) as batches:
+            self.queue.run()
+        self.assertEqual(batches.call_count, 1)
+        ndb.get_context().clear_cache()
+
+    def _put_revisions(self, ent, n):
+        revs = []
+        for i in xrange(n):
+            ent.foo = 'v%d' % i
+            ent.bar = range(i + 1)
+            ent.account = 'account%d' % i
+            self._trans_put(ent)
+            revs.append(ent.rev_hash)
+        return revs
+
+    def test_outbox(self):
+        for cls in (FooOutboxModel, FooOutboxDeltaLogModel):
+            ent = cls(id='foo')
+            revs = self._put_revisions(ent, 3)
+            # only journal entries in the entity's own group until drained
+            self.assertEqual(Audit.query_by_entity_key(ent).fetch(), [])
+            self.assertEqual(len(AuditJournal.query(ancestor=ent.key).fetch()), 3)
+            self.assertEqual(self.queue.pending, [ent.key] * 3)
+
+            self.assertEqual(self.queue.run(), 3)
+            ndb.get_context().clear_cache()
+            history = Audit.query_history(ent, newest_first=False).fetch()
+            self.assertEqual([a.rev_hash for a in history], revs)
+            self.assertEqual([a.parent_hash for a in history], [None] + revs[:-1])
+            self.assertEqual([a.account for a in history], ['account0', 'account1', 'account2'])
+            for i, a in enumerate(history):
+                self.assertEqual(a.entity_dict_async().get_result(), {'foo': 'v%d' % i, 'bar': range(i + 1)})
+            self.assertEqual(AuditJournal.query(ancestor=ent.key).fetch(), [])
+            self.assertEqual(ent.key.get().rev_hash, revs[-1])
+
+            # draining again is a no-op, and later revisions chain on
+            self.assertEqual(drain_async([ent.key]).get_result(), 0)
+            ent.foo = 'w'
+            self._trans_put(ent)
+            self.queue.run()
+            self.assertEqual(Audit.latest_revisions_async(ent).get_result()[0].parent_hash, revs[-1])
+
+    def test_outbox_batched_bookkeeping(self):
+        for cls in (FooOutboxDeltaLogModel, FooOutboxTrackedModel):
+            ent = cls(id='foo')
+            revs = self._put_revisions(ent, 3)
+            ent.foo, ent.bar = 'v0', [0] # back to the first state
+            self._trans_put(ent)
+            revs.append(ent.rev_hash)
+            self._drain_batched(ent)
+            history = Audit.query_history(ent, newest_first=False).fetch()
+            self.assertEqual([a.rev_hash for a in history], revs)
+            for a, foo in zip(history, ['v0', 'v1', 'v2', 'v0']):
+                self.assertEqual(a.entity_dict_async().get_result()['foo'], foo)
+            self.assertEqual(AuditHead._build_head_key(ent).get().rev_hash, revs[-1])
+
+            # later revisions chain on from the head written
+            ent.foo = 'w'
+            self._trans_put(ent)
+            self._drain_batched(ent)
+            self.assertEqual(Audit.latest_revisions_async(ent).get_result()[0].parent_hash, revs[-1])
+
+        changes = AuditValueChange.query(ancestor=ent.key).fetch()
+        self.assertEqual(sorted([c.value for c in changes]), ['v0', 'v0', 'v1', 'v2', 'w'])
+        self.assertEqual(len(AuditContent.query(ancestor=ent.key).fetch()), 4)
+
+    def test_outbox_put_multi_and_sweep(self):
+        self.policy.SetProbability(1) # the sweep is a global query
+        FooOutboxModel._audit_outbox_queue = None
+        ents = [FooOutboxModel(id='foo%d' % i, foo='a') for i in xrange(5)]
+        ndb.transaction(lambda: audit_put_multi_async(ents), xg=True)
+        self.assertEqual(Audit.query().fetch(), [])
+        written, cursor, more = drain_outbox_async(batch_size=3).get_result()
+        self.assertEqual((written, more), (3, True))
+        written, cursor, more = drain_outbox_async(batch_size=3, cursor=cursor).get_result()
+        self.assertEqual((written, more), (2, False))
+        for e in ents:
+            self.assertEqual(Audit.latest_revisions_async(e).get_result()[0].rev_hash, e.rev_hash)
@@ -0,0 +1,79 @@
+from google.appengine.ext import ndb
+
+from ndb_audit import Audit, AuditMixin
+from ndb_audit.feed import query_changes
+from ndb_audit.records import RevisionRecord, fetch_records_page_async, iter_history_records, iter_records
+from test import NDBUnitTest
+
+
+class FooRecordInside(ndb.Model):
+    foo = ndb.StringProperty()
+    bar = ndb.IntegerProperty()
+
+
+class FooRecordModel(AuditMixin, ndb.Model):
+    foo = ndb.StringProperty()
+    bar = ndb.IntegerProperty(repeated=True)
+    baz = ndb.StructuredProperty(FooRecordInside, repeated=True)
+
+    def _account(self):
+        return 'foo-account'
+
+
+class FooRecordBlobModel(FooRecordModel):
+    _audit_payload_format = 'blob'
+
+
+class FooRecordDeltaModel(FooRecordModel):
+    _audit_storage = 'delta'
+    _audit_log = 'log'
+
+
+class RecordsTest(NDBUnitTest):
+
+    def test_history_records(self):
+        for cls in (FooRecordModel, FooRecordBlobModel, FooRecordDeltaModel):
+            ent = cls(id='foo')
+            for i in xrange(5):
+                ent.foo = 'v%d' % i
+                ent.bar = range(i + 1)
+                ent.baz = [FooRecordInside(foo='in', bar=i)]
+                self._trans_put(ent)
+            ndb.get_context().clear_cache()
+            pages = list(iter_history_records(ent, page_size=2))
+            self.assertEqual([len(page) for page, cursor in pages], [2, 2, 1])
+            records = [r for page, cursor in pages for r in page]
+            # the records are not cached in the context
+            self.assertIsNone(ndb.get_context()._cache.get(records[0].key))
+
+            audits = Audit.query_history(ent).fetch()
+            self.assertTrue(all([isinstance(r, RevisionRecord) for r in records]))
+            for r, a in zip(records, audits):
+                for name in ('key', 'kind', 'data_hash', 'parent_hash', 'account', 'timestamp', 'rev_hash',
+                             'entity_key', 'squashed', 'delta'):
+                    self.assertEqual(getattr(r, name), getattr(a, name))
+                self.assertEqual(r.entity_dict_async().get_result(), a.entity_dict_async().get_result())
+            self.assertEqual(records[0].foo, 'v4')
+            self.assertEqual([b._to_dict() for b in records[0].baz], [{'foo': 'in', 'bar': 4}])
+            props = records[-1].to_dict()
+            self.assertEqual((props['foo'], props['bar'], props['baz'][0].bar), ('v0', [0], 0))
+            self.assertEqual(records[-1].property_names(), ['bar', 'baz', 'foo'])
+            self.assertRaises(AttributeError, getattr, records[0], 'nosuchproperty')
+
+            # resume after the first page, oldest first and headers only
+            rest, cursor, more = fetch_records_page_async(Audit.query_history(ent), 10,
+                                                          cursor=pages[0][1]).get_result()
+            self.assertEqual(([r.rev_hash for r in rest], more), ([r.rev_hash for r in records[2:]], False))
+            oldest = [r for page, cursor in iter_history_records(ent, newest_first=False, with_payload=False)
+                      for r in page]
+            self.assertEqual([r.rev_hash for r in oldest], [r.rev_hash for r in reversed(records)])
+            self.assertEqual(oldest[0].property_names(), [])
+            self.assertRaises(AttributeError, getattr, oldest[0], 'foo')
+
+    def test_feed_records(self):
+        self.policy.SetProbability(1)
+        ents = [FooRecordModel(id='foo%d' % i, foo='a') for i in xrange(3)]
+        for e in ents:
+            self._trans_put(e)
+        records = [r for page, cursor in iter_records(query_changes('FooRecordModel'), page_size=2) for r in page]
+        self.assertEqual([(r.key.parent(), r.rev_hash) for r in records], [(e.key, e.rev_hash) for e in ents])
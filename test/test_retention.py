@@ -0,0 +1,143 @@
+import datetime
+
+from google.appengine.ext import ndb
+
+from ndb_audit import Audit, AuditContent, AuditMixin, Tag
+from ndb_audit.retention import RetentionPolicy, prune_content_async, prune_history_async
+from test import NDBUnitTest
+
+
+class Bar(ndb.Model):
+    x = ndb.IntegerProperty()
+
+
+class FooRetentionModel(AuditMixin, ndb.Model):
+    foo = ndb.IntegerProperty()
+    bars = ndb.StructuredProperty(Bar, repeated=True)
+
+    def _account(self):
+        return 'foo-account'
+
+
+class FooRetentionDeltaModel(FooRetentionModel):
+    _audit_storage = 'delta'
+    _audit_checkpoint_revisions = 3
+
+
+class FooRetentionDeltaBlobModel(FooRetentionDeltaModel):
+    _audit_payload_format = 'blob'
+
+
+class FooRetentionDedupModel(FooRetentionModel):
+    _audit_payload_dedup = 'entity'
+
+
+class RetentionTest(NDBUnitTest):
+
+    def _revisions(self, cls, n=6):
+        """ puts n revisions, returns their rev_hashes oldest first """
+        ent = cls(id='foo', bars=[Bar(x=0)])
+        revs = []
+        for i in xrange(n):
+            ent.foo = i
+            ent.bars = ent.bars + [Bar(x=i)]
+            self._trans_put(ent)
+            revs.append(ent.rev_hash)
+        return ent, revs
+
+    def _history(self, ent):
+        return [a.rev_hash for a in Audit.query_history(ent, newest_first=False)]
+
+    def _assert_readable(self, ent, revs):
+        ndb.get_context().clear_cache()
+        for i in revs:
+            a = Audit.get_by_rev_hash_async(ent.key, self.revs[i]).get_result()
+            props = a.entity_dict_async().get_result()
+            self.assertEqual(props['foo'], i)
+            self.assertEqual([b.x for b in props['bars']], [0] + range(i + 1))
+
+    def test_keep_last(self):
+        ent, self.revs = self._revisions(FooRetentionModel)
+        Tag.create_from_rev_hash(ent.key, 'acct', 'release', self.revs[0]).put()
+        result = prune_history_async(ent, RetentionPolicy(keep_last=2)).get_result()
+        # revision 3 is squashed, 1 and 2 deleted, the tagged one kept
+        self.assertEqual(result.squash_rev_hash, self.revs[3])
+        self.assertEqual((result.deleted, result.more), (2, False))
+        self.assertEqual(self._history(ent), [self.revs[i] for i in (0, 3, 4, 5)])
+        self.assertTrue(Audit.get_by_rev_hash_async(ent.key, self.revs[3]).get_result().squashed)
+        self._assert_readable(ent, (0, 3, 4, 5))
+
+        # nothing more to do
+        self.assertEqual(prune_history_async(ent, RetentionPolicy(keep_last=2)).get_result().deleted, 0)
+        self.assertEqual(prune_history_async(ent, RetentionPolicy()).get_result().squash_rev_hash, None)
+
+    def test_keep_after_resumable(self):
+        ent, self.revs = self._revisions(FooRetentionModel)
+        keep_after = Audit.get_by_rev_hash_async(ent.key, self.revs[4]).get_result().timestamp
+        policy = RetentionPolicy(keep_after=keep_after, keep_tagged=False)
+        result = prune_history_async(ent, policy, batch_size=1, max_batches=2).get_result()
+        self.assertEqual((result.squash_rev_hash, result.deleted, result.more), (self.revs[3], 2, True))
+        result = prune_history_async(ent, policy, batch_size=1, cursor=result.cursor).get_result()
+        self.assertEqual((result.deleted, result.more), (1, False))
+        self.assertEqual(self._history(ent), self.revs[3:])
+        # keep_last can keep more than keep_after, 3 is now kept so nothing ages out
+        result = prune_history_async(ent, RetentionPolicy(keep_last=3, keep_after=keep_after)).get_result()
+        self.assertEqual(result.squash_rev_hash, None)
+
+    def test_delta(self):
+        for cls in (FooRetentionDeltaModel, FooRetentionDeltaBlobModel):
+            # revisions 0 and 3 are checkpoints, 5 is a delta chained to 3 and 4
+            ent, self.revs = self._revisions(cls)
+            Tag.create_from_rev_hash(ent.key, 'acct', 'release', self.revs[1]).put()
+            result = prune_history_async(ent, RetentionPolicy(keep_last=1)).get_result()
+            self.assertEqual(result.squash_rev_hash, self.revs[3])
+            self.assertEqual(self._history(ent), [self.revs[i] for i in (1, 3, 4, 5)])
+            self.assertEqual(Audit.get_by_rev_hash_async(ent.key, self.revs[1]).get_result().delta, None)
+            self._assert_readable(ent, (1, 3, 4, 5))
+            # the head still chains to stored records, so more deltas can be written
+            ent.foo = 6
+            self._trans_put(ent)
+            self.assertEqual(self._history(ent)[-1], ent.rev_hash)
+
+    def test_delta_keep_after(self):
+        for cls in (FooRetentionDeltaModel, FooRetentionDeltaBlobModel):
+            # 5 is the only revision kept, a delta chained to the checkpoint 3 and 4
+            ent, self.revs = self._revisions(cls)
+            keep_after = Audit.get_by_rev_hash_async(ent.key, self.revs[5]).get_result().timestamp
+            result = prune_history_async(ent, RetentionPolicy(keep_after=keep_after)).get_result()
+            self.assertEqual(result.squash_rev_hash, self.revs[3])
+            self.assertEqual(self._history(ent), self.revs[3:])
+            self._assert_readable(ent, (3, 4, 5))
+
+            # every revision ages out, the newest becomes the squash checkpoint and the next put chains to it
+            result = prune_history_async(ent, RetentionPolicy(
+                keep_after=datetime.datetime.utcnow() + datetime.timedelta(days=1))).get_result()
+            self.assertEqual(result.squash_rev_hash, self.revs[5])
+            self.assertEqual(self._history(ent), self.revs[5:])
+            ent.foo = 6
+            ent.bars = ent.bars + [Bar(x=6)]
+            self._trans_put(ent)
+            self.revs.append(ent.rev_hash)
+            self.assertEqual(Audit.get_by_rev_hash_async(ent.key, ent.rev_hash).get_result().delta['chain'],
+                             [Audit.get_by_rev_hash_async(ent.key, self.revs[5]).get_result().key.string_id()])
+            self._assert_readable(ent, (5, 6))
+
+    def test_prune_content(self):
+        self.policy.SetProbability(1) # unused content is found with global queries
+        ent, self.revs = self._revisions(FooRetentionDedupModel, 3)
+        prune_history_async(ent, RetentionPolicy(keep_last=1)).get_result()
+        self.assertEqual(self._history(ent), self.revs[1:])
+        contents = AuditContent.query(ancestor=ent.key).fetch()
+        self.assertEqual(len(contents), 3)
+        self.assertEqual(prune_content_async().get_result(), (0, None, False)) # all used recently
+
+        for c in contents:
+            c.last_used -= datetime.timedelta(days=31)
+        ndb.put_multi(contents)
+        deleted, cursor, more = prune_content_async(batch_size=2).get_result()
+        self.assertTrue(more)
+        deleted += prune_content_async(batch_size=2, cursor=cursor).get_result()[0]
+        self.assertEqual(deleted, 1) # only the first revision's, which prune_history_async deleted
+        self.assertEqual(len(AuditContent.query(ancestor=ent.key).fetch()), 2)
+        self._assert_readable(ent, (1, 2))
+        self.assertRaises(ValueError, prune_content_async(older_than=AuditContent.REFRESH_AFTER).get_result)
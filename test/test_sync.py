@@ -0,0 +1,77 @@
+import datetime
+
+from google.appengine.api import datastore
+from google.appengine.ext import ndb
+
+from ndb_audit import Audit, AuditMixin, tag_multi_from_rev_hash_async
+from ndb_audit.sync import changed_since_tag_async, current_rev_hashes_async
+from test import NDBUnitTest
+
+
+class FooSyncModel(AuditMixin, ndb.Model):
+    foo = ndb.StringProperty()
+
+    def _account(self):
+        return 'foo-account'
+
+
+class FooSyncIndexedModel(FooSyncModel):
+    rev_hash = ndb.StringProperty(indexed=True, default=None, name='h')
+
+
+class FooSyncHeadModel(FooSyncModel):
+    _audit_keep_head = True
+
+
+class SyncTest(NDBUnitTest):
+
+    def _setup(self, cls):
+        ents = [cls(id='foo%d' % i, foo='a') for i in xrange(6)]
+        for e in ents:
+            self._trans_put(e)
+        # tag the first five, then move two of them past the tag
+        ndb.Future.wait_all(tag_multi_from_rev_hash_async([e.key for e in ents[:5]], [e.rev_hash for e in ents[:5]],
+                                                          'acct', 'replicated'))
+        for e in (ents[1], ents[3]):
+            e.foo = 'b'
+            self._trans_put(e)
+        return ents, [ents[1].key, ents[3].key, ents[5].key]
+
+    def test_changed_since_tag(self):
+        ents, expected = self._setup(FooSyncModel)
+        keys = [e.key for e in ents]
+        self.assertEqual(current_rev_hashes_async(keys + [ndb.Key(FooSyncModel, 'nope')]).get_result(),
+                         [e.rev_hash for e in ents] + [None])
+        self.assertEqual(changed_since_tag_async(keys, 'replicated', batch_size=4).get_result(), expected)
+        self.assertEqual(changed_since_tag_async(FooSyncModel, 'replicated', batch_size=4).get_result(), expected)
+        self.assertEqual(changed_since_tag_async(keys, 'other').get_result(), keys)
+
+    def test_changed_since_tag_projection(self):
+        self.policy.SetProbability(1) # the projection is a global query, so only eventually consistent
+        ents, expected = self._setup(FooSyncIndexedModel)
+        # projections come back in rev_hash order
+        changed = changed_since_tag_async(FooSyncIndexedModel.query(), 'replicated', batch_size=4).get_result()
+        self.assertEqual(sorted(changed), expected)
+
+    def test_changed_since_tag_unindexed_history(self):
+        ents, expected = self._setup(FooSyncModel)
+        # as written before Audit.timestamp was indexed
+        for e in ents:
+            records = datastore.Get([a.key.to_old_key() for a in Audit.query_by_entity_key(e.key)])
+            for r in records:
+                r.set_unindexed_properties(['ts'])
+            datastore.Put(records)
+        self.assertEqual(Audit.latest_revision_keys_multi_async([ents[1].key]).get_result(), [None])
+        keys = [e.key for e in ents]
+        self.assertEqual(current_rev_hashes_async(keys).get_result(), [e.rev_hash for e in ents])
+        self.assertEqual(changed_since_tag_async(keys, 'replicated').get_result(), expected)
+
+    def test_changed_since_tag_head(self):
+        ents, expected = self._setup(FooSyncHeadModel)
+        # the newest record by timestamp is not the latest revision, e.g. because of clock skew
+        latest = Audit.get_by_rev_hash_async(ents[1].key, ents[1].rev_hash).get_result()
+        latest.timestamp -= datetime.timedelta(hours=1)
+        latest.put()
+        keys = [e.key for e in ents]
+        self.assertEqual(current_rev_hashes_async(keys).get_result(), [e.rev_hash for e in ents])
+        self.assertEqual(changed_since_tag_async(keys, 'replicated').get_result(), expected)
@@ -0,0 +1,120 @@
+import mock
+from google.appengine.ext import ndb
+
+from ndb_audit import AuditMixin, AuditValueChange, audit_put_multi_async
+from ndb_audit.retention import RetentionPolicy, prune_history_async
+from ndb_audit.value_index import fetch_value_changes_async, get_audits_async, iter_value_changes
+from test import NDBUnitTest
+
+
+class FooTrackedModel(AuditMixin, ndb.Model):
+    _audit_tracked_properties = ('status',)
+
+    status = ndb.StringProperty()
+    note = ndb.StringProperty()
+
+    who = 'foo-account'
+
+    def _account(self):
+        return self.who
+
+
+class FooTrackedDeltaModel(FooTrackedModel):
+    _audit_storage = 'delta'
+
+
+class FooTrackedRepeatedModel(AuditMixin, ndb.Model):
+    _audit_tracked_properties = ('tags',)
+
+    tags = ndb.StringProperty(repeated=True)
+
+    def _account(self):
+        return 'foo-account'
+
+
+class FooTrackedTextModel(FooTrackedRepeatedModel):
+    _audit_tracked_properties = ('body',)
+
+    body = ndb.TextProperty()
+
+
+class FooTrackedMissingModel(FooTrackedRepeatedModel):
+    _audit_tracked_properties = ('nope',)
+
+
+class ValueIndexTest(NDBUnitTest):
+
+    def setUp(self):
+        super(ValueIndexTest, self).setUp()
+        self.policy.SetProbability(1) # the index is read with global queries
+
+    def _put(self, ent, who, **values):
+        ent.populate(**values)
+        ent.who = who
+        self._trans_put(ent)
+        return ent.rev_hash
+
+    def _changes(self, kind, value, **kwargs):
+        return [c for changes, cursor in iter_value_changes(kind, 'status', value, **kwargs) for c in changes]
+
+    def test_value_changes(self):
+        for cls in (FooTrackedModel, FooTrackedDeltaModel):
+            kind = cls._get_kind()
+            ent = cls(id='foo')
+            self._put(ent, 'ann', note='new') # not set yet
+            opened = self._put(ent, 'ann', status='open')
+            self._put(ent, 'bob', note='looked at it') # status unchanged
+            closed = self._put(ent, 'bob', status='closed')
+            reopened = self._put(ent, 'cat', status='open')
+            closed_again = self._put(ent, 'ann', status='closed', note='done')
+            other = cls(id='bar')
+            other_closed = self._put(other, 'dan', status='closed')
+
+            changes = self._changes(kind, 'closed', page_size=1)
+            self.assertEqual([c.rev_hash for c in changes], [other_closed, closed_again, closed])
+            self.assertEqual([c.account for c in changes], ['dan', 'ann', 'bob'])
+            self.assertEqual([c.entity_key for c in changes], [other.key, ent.key, ent.key])
+            self.assertEqual([c.rev_hash for c in self._changes(kind, 'open', newest_first=False)], [opened, reopened])
+            self.assertEqual(self._changes(kind, 'done'), [])
+
+            audits = get_audits_async(changes).get_result()
+            self.assertEqual([a.rev_hash for a in audits], [c.rev_hash for c in changes])
+            self.assertEqual([a.status for a in audits], ['closed'] * 3)
+
+            # a time window, a page at a time
+            changes, cursor, more = fetch_value_changes_async(kind, 'status', 'closed', page_size=1,
+                                                              until=changes[0].timestamp).get_result()
+            self.assertEqual(([c.rev_hash for c in changes], more), ([closed_again], True))
+            changes, cursor, more = fetch_value_changes_async(kind, 'status', 'closed', page_size=1, cursor=cursor,
+                                                              until=changes[0].timestamp).get_result()
+            self.assertEqual(([c.rev_hash for c in changes], more), ([closed], False))
+
+    def test_prune(self):
+        ent = FooTrackedModel(id='foo')
+        for status in ('a', 'b', 'c', 'd'):
+            self._put(ent, 'ann', status=status)
+        prune_history_async(ent, RetentionPolicy(keep_last=1)).get_result()
+        # the squashed revision is kept along with its change
+        self.assertEqual(sorted([c.value for c in AuditValueChange.query(ancestor=ent.key)]), ['c', 'd'])
+
+    def test_prefetched_head(self):
+        for cls in (FooTrackedModel, FooTrackedDeltaModel):
+            ent = cls(id='foo')
+            self._put(ent, 'ann', status='open')
+            # the AuditHead read before the put is used, the hook does not read it again
+            with mock.patch.object(ndb.Key, 'get', side_effect=AssertionError('blocking get')):
+                self._put(ent, 'bob', status='closed')
+                ent.status = 'open'
+                ndb.transaction(lambda: audit_put_multi_async([ent]).get_result(), xg=True)
+            self.assertEqual(sorted([c.value for c in AuditValueChange.query(ancestor=ent.key)]),
+                             ['closed', 'open', 'open'])
+
+    def test_invalid_tracked_properties(self):
+        for cls, message in ((FooTrackedRepeatedModel, 'must not be repeated'),
+                             (FooTrackedTextModel, 'must be indexed'),
+                             (FooTrackedMissingModel, 'is not a property')):
+            ent = cls(id='foo')
+            with self.assertRaises(ValueError) as raised:
+                self._trans_put(ent)
+            self.assertIn(message, str(raised.exception))
+            self.assertIsNone(ent.key.get())
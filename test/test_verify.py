@@ -0,0 +1,106 @@
+from google.appengine.ext import ndb
+
+from ndb_audit import Audit, AuditMixin
+from ndb_audit.verify import _split_points_async, verify_async, verify_entity_async
+from test import NDBUnitTest
+
+
+class Bar(ndb.Model):
+    x = ndb.IntegerProperty()
+
+
+class FooVerifyModel(AuditMixin, ndb.Model):
+    foo = ndb.StringProperty()
+    tags = ndb.StringProperty(repeated=True)
+    bars = ndb.StructuredProperty(Bar, repeated=True)
+
+    def _account(self):
+        return 'foo-account'
+
+
+class FooVerifyV3Model(FooVerifyModel):
+    _data_hash_version = 'v3'
+
+
+class FooVerifyDeltaModel(FooVerifyModel):
+    _audit_storage = 'delta'
+    _audit_payload_format = 'blob'
+
+
+class FooVerifyDedupModel(FooVerifyModel):
+    _audit_payload_dedup = 'entity'
+
+
+class FooVerifyLogModel(FooVerifyModel):
+    _audit_log = 'log'
+
+
+class VerifyTest(NDBUnitTest):
+
+    def setUp(self):
+        super(VerifyTest, self).setUp()
+        self.policy.SetProbability(1) # verify_async reads with global queries
+
+    def _revisions(self, cls, name='foo', n=4):
+        ent = cls(id=name, tags=['a'], bars=[Bar(x=0)])
+        for i in xrange(n):
+            ent.foo = 'foo%d' % (i % 2) # goes back to earlier states
+            ent.tags = ent.tags + ['t%d' % i]
+            self._trans_put(ent)
+        return ent
+
+    def _problems(self, report):
+        return sorted([(i.problem, i.rev_hash) for i in report.issues])
+
+    def test_valid_history(self):
+        for cls in (FooVerifyModel, FooVerifyV3Model, FooVerifyDeltaModel, FooVerifyDedupModel, FooVerifyLogModel):
+            ent = self._revisions(cls)
+            ndb.get_context().clear_cache()
+            report = verify_async(cls._get_kind()).get_result()
+            self.assertEqual((report.audits, report.entities, report.unchecked, report.issues), (4, 1, 0, []))
+            report = verify_entity_async(ent).get_result()
+            self.assertTrue(report.ok)
+            self.assertEqual(report.audits, 4)
+
+    def test_issues(self):
+        ent = self._revisions(FooVerifyModel)
+        audits = list(Audit.query_history(ent, newest_first=False))
+
+        # tampered properties and header
+        audits[1].foo = 'tampered'
+        audits[2].account = 'someone-else'
+        ndb.put_multi(audits[1:3])
+        # a missing revision
+        audits[0].key.delete()
+        # two revisions based on the same one
+        ndb.get_context().clear_cache()
+        stale = ent.key.get()
+        ent.foo = 'x'
+        self._trans_put(ent)
+        stale.foo = 'y'
+        self._trans_put(stale)
+        # a blind put
+        blind = FooVerifyModel(id='foo', foo='z')
+        self._trans_put(blind)
+
+        report = verify_async('FooVerifyModel').get_result()
+        self.assertEqual(self._problems(report), sorted([
+            ('data_hash', audits[1].rev_hash),
+            ('rev_hash', audits[2].rev_hash),
+            ('break', audits[1].rev_hash),
+            ('fork', audits[3].rev_hash),
+            ('orphan', blind.rev_hash),
+        ]))
+        self.assertEqual(report.issues[0].entity_key, ent.key)
+        self.assertEqual(self._problems(verify_async('FooVerifyModel', check_data_hash=False).get_result()),
+                         [p for p in self._problems(report) if p[0] != 'data_hash'])
+
+    def test_shards(self):
+        ents = [self._revisions(FooVerifyModel, 'foo%02d' % i, 2) for i in xrange(30)]
+        self._revisions(FooVerifyV3Model, 'other', 2)
+        bounds = _split_points_async(4, None, None).get_result()
+        self.assertTrue(0 < len(bounds) <= 3)
+        report = verify_async('FooVerifyModel', shards=4, page_size=7).get_result()
+        self.assertEqual((report.audits, report.entities, report.issues), (60, 30, []))
+        report = verify_async(start=ents[10].key, end=ents[20].key, shards=3).get_result()
+        self.assertEqual((report.audits, report.entities), (20, 10))